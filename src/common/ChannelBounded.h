@@ -2,9 +2,15 @@
 #ifndef CHANNEL_BOUNDED_H
 #define CHANNEL_BOUNDED_H
 
+#include <atomic>
 #include <thread>
 #include <mutex>
 #include <condition_variable>
+#include <cstddef>
+#include <initializer_list>
+#include <stdexcept>
+
+#include "Utils.h"
 
 
 // By default sends and receives block until both the sender and receiver are ready : https://gobyexample.com/channels
@@ -21,9 +27,17 @@ class ChannelBounded
     std::condition_variable m_notEmptyCondition;
 
     bool m_isClosed = false;
-    bool m_isEmpty = true;
+    // Written under `m_mutex`, read without it by `pollRead` and `pollWrite`
+    std::atomic<bool> m_isEmpty{true};
+
+    // Blocking selects waiting for this channel to change
+    SelectWaiterList m_waiters;
+
+    CSP_INSTRUMENT(ChannelCounters& m_counters = InstrumentationRegistry::instance().addChannel("ChannelBounded", 1);)
 
 public:
+    using value_type = T;
+
     ChannelBounded() 
     {
         m_isClosed = false;
@@ -36,6 +50,7 @@ public:
         m_isClosed = true;
         m_notFullCondition.notify_all();
         m_notEmptyCondition.notify_all();
+        m_waiters.notifyAll();
     }
 
     bool isClosed() 
@@ -52,7 +67,7 @@ public:
     */
     bool write(const T& value, const bool wait = true) 
     {
-        std::unique_lock<std::mutex> lock(m_mutex);
+        CSP_LOCK(lock, m_mutex, m_counters);
         if (m_isClosed) 
         {
             throw std::logic_error("Cannot write to a closed channel.\n");
@@ -65,12 +80,15 @@ public:
 
         if (!m_isEmpty)
         {
+            CSP_INSTRUMENT(m_counters.rejectFull();)
             return false;
         }
 
         m_element = value;
         m_isEmpty = false;
+        CSP_INSTRUMENT(m_counters.depth(1);)
         m_notEmptyCondition.notify_one();
+        m_waiters.notifyAll();
         return true;
     }
 
@@ -94,7 +112,7 @@ public:
     */
     bool read(T* value, bool wait = true) 
     {
-        std::unique_lock<std::mutex> lock(m_mutex);
+        CSP_LOCK(lock, m_mutex, m_counters);
 
         if (wait) 
         {
@@ -103,6 +121,7 @@ public:
 
         if (m_isEmpty)
         {
+            CSP_INSTRUMENT(m_counters.rejectEmpty();)
             return false;
         }
 
@@ -113,8 +132,118 @@ public:
         }
 
         m_isEmpty = true;
+        // A writer may be waiting for the element to be taken
+        m_notFullCondition.notify_one();
+        m_waiters.notifyAll();
         return true;
     }
+
+    /**
+    * @brief
+    *        Same as `read(value, false)`, without taking the lock when the channel
+    *        is empty. The selects poll their `ChannelBounded` cases with it, as
+    *        most of the polls find nothing to read.
+    */
+    bool pollRead(T* value)
+    {
+        if (m_isEmpty.load(std::memory_order_acquire))
+        {
+            CSP_INSTRUMENT(m_counters.rejectEmpty();)
+            return false;
+        }
+        return read(value, false);
+    }
+
+    /**
+    * @brief
+    *        Same as `write(value, false)`, without taking the lock when the channel
+    *        is full. A full channel which is closed meanwhile is reported as full.
+    */
+    bool pollWrite(const T& value)
+    {
+        if (!m_isEmpty.load(std::memory_order_acquire))
+        {
+            CSP_INSTRUMENT(m_counters.rejectFull();)
+            return false;
+        }
+        return write(value, false);
+    }
+
+    /**
+    * @brief
+    *        Write the values from `first` to `last`, one after the other as the
+    *        channel holds a single value, without releasing the lock in between
+    *        unless it has to wait for a reader.
+    * @return
+    *        How many values were written. With `wait`, all of them unless the
+    *        channel is closed meanwhile.
+    */
+    template <class InputIt>
+    std::size_t writeMany(InputIt first, InputIt last, const bool wait = true)
+    {
+        CSP_LOCK(lock, m_mutex, m_counters);
+        if (m_isClosed)
+        {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+
+        std::size_t written = 0;
+        for (; first != last; ++first, ++written)
+        {
+            if (wait)
+            {
+                m_notFullCondition.wait(lock, [this]() { return m_isClosed || m_isEmpty == true; });
+            }
+
+            if (!m_isEmpty || m_isClosed)
+            {
+                CSP_INSTRUMENT(if (!m_isEmpty) m_counters.rejectFull();)
+                break;
+            }
+
+            m_element = *first;
+            m_isEmpty = false;
+            CSP_INSTRUMENT(m_counters.depth(1);)
+            m_notEmptyCondition.notify_one();
+            m_waiters.notifyAll();
+        }
+        return written;
+    }
+
+    // `channel1 <- a; channel1 <- b;` is translated to `channel1.writeMany({a, b}, false);`
+    std::size_t writeMany(std::initializer_list<T> values, const bool wait = true)
+    {
+        return writeMany(values.begin(), values.end(), wait);
+    }
+
+    /**
+    * @brief
+    *        Same as `read`, for `ChannelRange`: the channel holds a single value, so
+    *        at most one is read whatever `count` is.
+    * @return
+    *        How many values were read, 0 once the channel is closed and drained.
+    */
+    std::size_t readMany(T* values, const std::size_t count, const bool wait = true)
+    {
+        return count != 0 && read(values, wait) ? 1 : 0;
+    }
+
+    /**
+    * @brief
+    *        Register `waiter` to be notified, with `caseIndex`, each time a value is
+    *        written or read or the channel is closed. Used by the blocking selects.
+    */
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_waiters.add(waiter, caseIndex);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_waiters.remove(waiter);
+    }
 };
 
 #endif
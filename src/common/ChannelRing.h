@@ -0,0 +1,480 @@
+#pragma once
+#ifndef CHANNEL_RING_H
+#define CHANNEL_RING_H
+
+#include <atomic>
+#include <array>
+#include <cstddef>
+#include <initializer_list>
+#include <mutex>
+#include <stdexcept>
+
+#include "Utils.h"
+
+
+// Size of a cache line, the cursors of a ring are kept on lines of their own to avoid false sharing.
+#define CHANNEL_RING_CACHE_LINE 64
+
+// The smallest power of two at least `value`, so a ring index is masked instead of taken modulo.
+constexpr std::size_t ringCapacity(const std::size_t value, const std::size_t power = 1)
+{
+    return power >= value ? power : ringCapacity(value, power * 2);
+}
+
+/**
+* @brief
+*        The waiters of a ring channel: blocking selects, and the blocking `read`s and
+*        `write`s once they are done spinning. A `read` or `write` only takes the mutex
+*        when someone is registered, so the channel stays lock-free otherwise.
+*/
+class RingChannelWaiters
+{
+public:
+    RingChannelWaiters()
+        : m_count(0)
+    {
+    }
+
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_waiters.add(waiter, caseIndex);
+        m_count.fetch_add(1, std::memory_order_seq_cst);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_waiters.remove(waiter);
+        m_count.fetch_sub(1, std::memory_order_seq_cst);
+    }
+
+    void notifyAll()
+    {
+        // Pairs with the registration: either the waiter is seen here, or it sees the new state
+        // when it polls again after registering.
+        std::atomic_thread_fence(std::memory_order_seq_cst);
+        if (m_count.load(std::memory_order_relaxed) == 0)
+        {
+            return;
+        }
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_waiters.notifyAll();
+    }
+
+    /**
+    * @brief
+    *        Call `attempt` until it succeeds: spin with a `SelectBackoff` first, then
+    *        park on a `SelectWaiter` registered with the channel.
+    * @return
+    *        `true` once `attempt` succeeded, `false` if `isClosed` became true first.
+    *        A reader passes `drainOnClose` to try once more, the values written before
+    *        the channel was closed can still be read.
+    */
+    template <class Attempt, class IsClosed>
+    bool block(Attempt attempt, IsClosed isClosed, const bool drainOnClose)
+    {
+        SelectBackoff backoff;
+        do
+        {
+            if (attempt())
+            {
+                return true;
+            }
+            if (isClosed())
+            {
+                return drainOnClose && attempt();
+            }
+        } while (backoff.spin());
+
+        SelectWaiter waiter;
+        SelectWaiterRegistration registration(*this, waiter);
+        while (true)
+        {
+            if (attempt())
+            {
+                return true;
+            }
+            if (isClosed())
+            {
+                return drainOnClose && attempt();
+            }
+            waiter.waitFor();
+        }
+    }
+
+private:
+    std::atomic<int> m_count;
+    std::mutex m_mutex;
+    SelectWaiterList m_waiters;
+};
+
+/**
+* @brief
+*        Lock-free channel with one writing and one reading thread.
+*        Same interface as `ChannelUnbounded`, it holds up to `CAPACITY` values rounded
+*        up to a power of two. Each cursor is written by one thread only.
+*/
+template <class T, int CAPACITY>
+class ChannelRingSPSC
+{
+    static_assert(CAPACITY > 0, "The capacity of a channel must be positive.");
+    static constexpr std::size_t SIZE = ringCapacity(CAPACITY);
+    static constexpr std::size_t MASK = SIZE - 1;
+
+    // Next index to read from, moved by the reader
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<std::size_t> m_head;
+    // Next index to write on, moved by the writer
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<std::size_t> m_tail;
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<bool> m_isClosed;
+    std::array<T, SIZE> m_buffer;
+    RingChannelWaiters m_waiters;
+
+    bool tryWrite(const T& value)
+    {
+        const std::size_t tail = m_tail.load(std::memory_order_relaxed);
+        if (tail - m_head.load(std::memory_order_acquire) == SIZE)
+        {
+            return false;
+        }
+        m_buffer[tail & MASK] = value;
+        m_tail.store(tail + 1, std::memory_order_release);
+        m_waiters.notifyAll();
+        return true;
+    }
+
+    bool tryRead(T* value)
+    {
+        const std::size_t head = m_head.load(std::memory_order_relaxed);
+        if (head == m_tail.load(std::memory_order_acquire))
+        {
+            return false;
+        }
+        if (value != nullptr)
+        {
+            *value = m_buffer[head & MASK];
+        }
+        m_head.store(head + 1, std::memory_order_release);
+        m_waiters.notifyAll();
+        return true;
+    }
+
+public:
+    using value_type = T;
+
+    ChannelRingSPSC()
+        : m_head(0)
+        , m_tail(0)
+        , m_isClosed(false)
+    {
+    }
+
+    void close()
+    {
+        m_isClosed.store(true, std::memory_order_seq_cst);
+        m_waiters.notifyAll();
+    }
+
+    bool isClosed()
+    {
+        return m_isClosed.load(std::memory_order_acquire);
+    }
+
+    /**
+    * @brief
+    *        Write a value to a channel.
+    * @return
+    *        `true`, if the value was written.
+    *        `false`, if the channel was full and `wait` is `false`, or it was
+    *                 closed while waiting.
+    */
+    bool write(const T& value, const bool wait = true)
+    {
+        if (isClosed())
+        {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+        if (!wait)
+        {
+            return tryWrite(value);
+        }
+        return m_waiters.block([this, &value]() { return tryWrite(value); },
+                               [this]() { return isClosed(); }, false);
+    }
+
+    /**
+    * @brief
+    *        Read the first value from a channel, into `value` unless it is `nullptr`.
+    * @return
+    *        `true`, if an item was received.
+    *        `false`, if the channel was empty and `wait` is `false`, or it is
+    *                 closed and drained.
+    */
+    bool read(T* value, bool wait = true)
+    {
+        if (!wait)
+        {
+            return tryRead(value);
+        }
+        return m_waiters.block([this, value]() { return tryRead(value); },
+                               [this]() { return isClosed(); }, true);
+    }
+
+    /**
+    * @brief
+    *        Write the values from `first` to `last`, until the channel is full
+    *        unless `wait` is given.
+    * @return
+    *        How many values were written. With `wait`, all of them unless the
+    *        channel is closed meanwhile.
+    */
+    template <class InputIt>
+    std::size_t writeMany(InputIt first, InputIt last, const bool wait = true)
+    {
+        if (isClosed())
+        {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+        std::size_t written = 0;
+        for (; first != last; ++first, ++written)
+        {
+            const T& value = *first;
+            if (!(wait ? m_waiters.block([this, &value]() { return tryWrite(value); },
+                                         [this]() { return isClosed(); }, false)
+                       : tryWrite(value)))
+            {
+                break;
+            }
+        }
+        return written;
+    }
+
+    std::size_t writeMany(std::initializer_list<T> values, const bool wait = true)
+    {
+        return writeMany(values.begin(), values.end(), wait);
+    }
+
+    /**
+    * @brief
+    *        Read up to `count` values into `values`. With `wait`, blocks until there
+    *        is at least one value or the channel is closed.
+    * @return
+    *        How many values were read, 0 once the channel is closed and drained.
+    */
+    std::size_t readMany(T* values, const std::size_t count, const bool wait = true)
+    {
+        if (count == 0 || !read(values, wait))
+        {
+            return 0;
+        }
+        std::size_t fetched = 1;
+        while (fetched < count && tryRead(values != nullptr ? values + fetched : nullptr))
+        {
+            ++fetched;
+        }
+        return fetched;
+    }
+
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        m_waiters.addWaiter(waiter, caseIndex);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        m_waiters.removeWaiter(waiter);
+    }
+};
+
+/**
+* @brief
+*        Lock-free channel with any number of writing and reading threads.
+*        Same interface as `ChannelUnbounded`, it holds up to `CAPACITY` values rounded
+*        up to a power of two. Each cell has a sequence number telling whether it waits
+*        for a writer or a reader of the current lap, the cursors are claimed with a CAS.
+*/
+template <class T, int CAPACITY>
+class ChannelRingMPMC
+{
+    static_assert(CAPACITY > 0, "The capacity of a channel must be positive.");
+    static constexpr std::size_t SIZE = ringCapacity(CAPACITY);
+    static constexpr std::size_t MASK = SIZE - 1;
+
+    struct Cell
+    {
+        std::atomic<std::size_t> sequence;
+        T value;
+    };
+
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<std::size_t> m_head;
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<std::size_t> m_tail;
+    alignas(CHANNEL_RING_CACHE_LINE) std::atomic<bool> m_isClosed;
+    std::array<Cell, SIZE> m_cells;
+    RingChannelWaiters m_waiters;
+
+    bool tryWrite(const T& value)
+    {
+        std::size_t tail = m_tail.load(std::memory_order_relaxed);
+        while (true)
+        {
+            Cell& cell = m_cells[tail & MASK];
+            const std::size_t sequence = cell.sequence.load(std::memory_order_acquire);
+            if (sequence == tail)
+            {
+                if (m_tail.compare_exchange_weak(tail, tail + 1, std::memory_order_relaxed))
+                {
+                    cell.value = value;
+                    cell.sequence.store(tail + 1, std::memory_order_release);
+                    m_waiters.notifyAll();
+                    return true;
+                }
+            }
+            else if (sequence < tail)
+            {
+                // The cell still holds the value of the previous lap, the channel is full
+                return false;
+            }
+            else
+            {
+                tail = m_tail.load(std::memory_order_relaxed);
+            }
+        }
+    }
+
+    bool tryRead(T* value)
+    {
+        std::size_t head = m_head.load(std::memory_order_relaxed);
+        while (true)
+        {
+            Cell& cell = m_cells[head & MASK];
+            const std::size_t sequence = cell.sequence.load(std::memory_order_acquire);
+            if (sequence == head + 1)
+            {
+                if (m_head.compare_exchange_weak(head, head + 1, std::memory_order_relaxed))
+                {
+                    if (value != nullptr)
+                    {
+                        *value = cell.value;
+                    }
+                    cell.sequence.store(head + SIZE, std::memory_order_release);
+                    m_waiters.notifyAll();
+                    return true;
+                }
+            }
+            else if (sequence < head + 1)
+            {
+                // Nothing was written in the cell during this lap, the channel is empty
+                return false;
+            }
+            else
+            {
+                head = m_head.load(std::memory_order_relaxed);
+            }
+        }
+    }
+
+public:
+    using value_type = T;
+
+    ChannelRingMPMC()
+        : m_head(0)
+        , m_tail(0)
+        , m_isClosed(false)
+    {
+        for (std::size_t index = 0; index < SIZE; ++index)
+        {
+            m_cells[index].sequence.store(index, std::memory_order_relaxed);
+        }
+    }
+
+    void close()
+    {
+        m_isClosed.store(true, std::memory_order_seq_cst);
+        m_waiters.notifyAll();
+    }
+
+    bool isClosed()
+    {
+        return m_isClosed.load(std::memory_order_acquire);
+    }
+
+    // See `ChannelRingSPSC::write`
+    bool write(const T& value, const bool wait = true)
+    {
+        if (isClosed())
+        {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+        if (!wait)
+        {
+            return tryWrite(value);
+        }
+        return m_waiters.block([this, &value]() { return tryWrite(value); },
+                               [this]() { return isClosed(); }, false);
+    }
+
+    // See `ChannelRingSPSC::read`
+    bool read(T* value, bool wait = true)
+    {
+        if (!wait)
+        {
+            return tryRead(value);
+        }
+        return m_waiters.block([this, value]() { return tryRead(value); },
+                               [this]() { return isClosed(); }, true);
+    }
+
+    // See `ChannelRingSPSC::writeMany`
+    template <class InputIt>
+    std::size_t writeMany(InputIt first, InputIt last, const bool wait = true)
+    {
+        if (isClosed())
+        {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+        std::size_t written = 0;
+        for (; first != last; ++first, ++written)
+        {
+            const T& value = *first;
+            if (!(wait ? m_waiters.block([this, &value]() { return tryWrite(value); },
+                                         [this]() { return isClosed(); }, false)
+                       : tryWrite(value)))
+            {
+                break;
+            }
+        }
+        return written;
+    }
+
+    std::size_t writeMany(std::initializer_list<T> values, const bool wait = true)
+    {
+        return writeMany(values.begin(), values.end(), wait);
+    }
+
+    // See `ChannelRingSPSC::readMany`
+    std::size_t readMany(T* values, const std::size_t count, const bool wait = true)
+    {
+        if (count == 0 || !read(values, wait))
+        {
+            return 0;
+        }
+        std::size_t fetched = 1;
+        while (fetched < count && tryRead(values != nullptr ? values + fetched : nullptr))
+        {
+            ++fetched;
+        }
+        return fetched;
+    }
+
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        m_waiters.addWaiter(waiter, caseIndex);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        m_waiters.removeWaiter(waiter);
+    }
+};
+
+#endif
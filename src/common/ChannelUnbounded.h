@@ -2,21 +2,31 @@
 #ifndef CHANNEL_UNBOUNDED_H
 #define CHANNEL_UNBOUNDED_H
 
+#include <cstddef>
+#include <initializer_list>
+#include <stdexcept>
+
+#include "Utils.h"
+
 
 // TODO: make this respect the size property
 template <class T, int MAXSIZE>
 class ChannelUnbounded 
 {
+    // With `CSP_INSTRUMENTATION`, the counters of the channel are the ones of its buffer
     BoundedBuffer<T,MAXSIZE> m_buffer;
     bool m_isClosed;
 
 public:
+    using value_type = T;
+
     ChannelUnbounded() {
         m_isClosed = false;
     }
 
     void close() {
         m_isClosed = true;
+        m_buffer.close();
     }
 
     bool isClosed() {
@@ -62,6 +72,58 @@ public:
         const bool res = m_buffer.fetch(value, wait);
         return res;
     }
+
+    /**
+    * @brief
+    *        Write the values from `first` to `last`, as many as there is room for
+    *        on each acquisition of the lock.
+    * @return
+    *        How many values were written. With `wait`, all of them unless the
+    *        channel is closed meanwhile.
+    */
+    template <class InputIt>
+    std::size_t writeMany(InputIt first, InputIt last, const bool wait = true)
+    {
+        if (m_isClosed) {
+            throw std::logic_error("Cannot write to a closed channel.\n");
+        }
+
+        return m_buffer.depositMany(first, last, wait);
+    }
+
+    // `channel1 <- a; channel1 <- b;` is translated to `channel1.writeMany({a, b}, false);`
+    std::size_t writeMany(std::initializer_list<T> values, const bool wait = true)
+    {
+        return writeMany(values.begin(), values.end(), wait);
+    }
+
+    /**
+    * @brief
+    *        Read up to `count` values into `values` under a single acquisition of
+    *        the lock. With `wait`, blocks until there is at least one value or the
+    *        channel is closed.
+    * @return
+    *        How many values were read, 0 once the channel is closed and drained.
+    */
+    std::size_t readMany(T* values, const std::size_t count, const bool wait = true)
+    {
+        return m_buffer.fetchMany(values, count, wait);
+    }
+
+    /**
+    * @brief
+    *        Register `waiter` to be notified, with `caseIndex`, each time a value is
+    *        written or read or the channel is closed. Used by the blocking selects.
+    */
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        m_buffer.addWaiter(waiter, caseIndex);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        m_buffer.removeWaiter(waiter);
+    }
 };
 
 #endif
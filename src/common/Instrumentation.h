@@ -0,0 +1,332 @@
+#pragma once
+#ifndef INSTRUMENTATION_H
+#define INSTRUMENTATION_H
+
+#include <mutex>
+
+/**
+* Counters of the selects and of the channels, compiled in with `-DCSP_INSTRUMENTATION`.
+* Without it, whatever is given to `CSP_INSTRUMENT` is left out and `CSP_LOCK` is a plain
+* `std::unique_lock`, so nothing is left of them in the program.
+*
+* The selects are instrumented once translated with `--instrument`. The counters are written
+* as JSON at exit, to `$CSP_INSTRUMENTATION_FILE` or else `csp_instrumentation.json`.
+*/
+#ifdef CSP_INSTRUMENTATION
+#define CSP_INSTRUMENT(...) __VA_ARGS__
+// Declares `lockName` holding `lockedMutex`, the time spent waiting for it is added to `counters`.
+#define CSP_LOCK(lockName, lockedMutex, counters) \
+    std::unique_lock<std::mutex> lockName(lockedMutex, std::defer_lock); \
+    (counters).lock(lockName)
+#else
+#define CSP_INSTRUMENT(...)
+#define CSP_LOCK(lockName, lockedMutex, counters) std::unique_lock<std::mutex> lockName(lockedMutex)
+#endif
+
+
+#ifdef CSP_INSTRUMENTATION
+
+#include <atomic>
+#include <chrono>
+#include <cstddef>
+#include <cstdlib>
+#include <deque>
+#include <fstream>
+#include <memory>
+#include <ostream>
+#include <string>
+
+class InstrumentationClock
+{
+public:
+    using Clock = std::chrono::steady_clock;
+
+    static unsigned long long nanosecondsSince(const Clock::time_point start)
+    {
+        return static_cast<unsigned long long>(
+            std::chrono::duration_cast<std::chrono::nanoseconds>(Clock::now() - start).count()
+        );
+    }
+
+    // `value` as a JSON string
+    static std::string quote(const std::string& value)
+    {
+        std::string quoted = "\"";
+        for (const char character : value)
+        {
+            if (character == '"' || character == '\\')
+            {
+                quoted += '\\';
+            }
+            quoted += character;
+        }
+        return quoted + "\"";
+    }
+};
+
+/**
+* @brief
+*        The counters of one select of the program: how many times each case was
+*        taken, how many polling rounds it took, and how long it was blocked.
+*/
+class SelectCounters
+{
+public:
+    SelectCounters(const std::string& name, const std::string& file, const int line, const int cases)
+        : m_name(name)
+        , m_file(file)
+        , m_line(line)
+        , m_cases(cases)
+        , m_fired(new std::atomic<unsigned long long>[cases + 1])
+        , m_passes(0)
+        , m_rounds(0)
+        , m_blocked(0)
+        , m_blockedNanoseconds(0)
+    {
+        for (int position = 0; position <= cases; ++position)
+        {
+            m_fired[position] = 0;
+        }
+    }
+
+    // `caseIndex` is the position of the case taken among the polled ones, -1 for `default`.
+    int fired(const int caseIndex)
+    {
+        m_fired[caseIndex + 1].fetch_add(1, std::memory_order_relaxed);
+        return caseIndex;
+    }
+
+    // A select which found no case ready on its first polling round was blocked until it returned.
+    void addPass(const unsigned long long rounds, const unsigned long long nanoseconds)
+    {
+        m_passes.fetch_add(1, std::memory_order_relaxed);
+        m_rounds.fetch_add(rounds, std::memory_order_relaxed);
+        if (rounds > 1)
+        {
+            m_blocked.fetch_add(1, std::memory_order_relaxed);
+            m_blockedNanoseconds.fetch_add(nanoseconds, std::memory_order_relaxed);
+        }
+    }
+
+    void write(std::ostream& output) const
+    {
+        output << "{\"name\": " << InstrumentationClock::quote(m_name)
+               << ", \"file\": " << InstrumentationClock::quote(m_file)
+               << ", \"line\": " << m_line
+               << ", \"passes\": " << m_passes.load()
+               << ", \"rounds\": " << m_rounds.load()
+               << ", \"blocked\": " << m_blocked.load()
+               << ", \"blockedNanoseconds\": " << m_blockedNanoseconds.load()
+               << ", \"default\": " << m_fired[0].load()
+               << ", \"fired\": [";
+        for (int position = 1; position <= m_cases; ++position)
+        {
+            output << (position == 1 ? "" : ", ") << m_fired[position].load();
+        }
+        output << "]}";
+    }
+
+private:
+    const std::string m_name;
+    const std::string m_file;
+    const int m_line;
+    const int m_cases;
+    // The `default` case first, then the polled ones
+    std::unique_ptr<std::atomic<unsigned long long>[]> m_fired;
+    std::atomic<unsigned long long> m_passes;
+    std::atomic<unsigned long long> m_rounds;
+    std::atomic<unsigned long long> m_blocked;
+    std::atomic<unsigned long long> m_blockedNanoseconds;
+};
+
+// One call of the polling function of a select, counted once it returns.
+class SelectPass
+{
+public:
+    explicit SelectPass(SelectCounters& counters)
+        : m_counters(counters)
+        , m_rounds(0)
+        , m_start(InstrumentationClock::Clock::now())
+    {
+    }
+
+    SelectPass(const SelectPass&) = delete;
+    SelectPass& operator=(const SelectPass&) = delete;
+
+    ~SelectPass()
+    {
+        m_counters.addPass(m_rounds, InstrumentationClock::nanosecondsSince(m_start));
+    }
+
+    void round()
+    {
+        ++m_rounds;
+    }
+
+private:
+    SelectCounters& m_counters;
+    unsigned long long m_rounds;
+    const InstrumentationClock::Clock::time_point m_start;
+};
+
+/**
+* @brief
+*        The counters of one channel: how long its operations waited for its lock,
+*        the most values it held at once, and the non-blocking writes and reads
+*        rejected because it was full or empty.
+*/
+class ChannelCounters
+{
+public:
+    ChannelCounters(const int id, const std::string& kind, const std::size_t capacity)
+        : m_id(id)
+        , m_kind(kind)
+        , m_capacity(capacity)
+        , m_lockAcquisitions(0)
+        , m_lockContentions(0)
+        , m_lockWaitNanoseconds(0)
+        , m_highWaterMark(0)
+        , m_fullRejections(0)
+        , m_emptyRejections(0)
+    {
+    }
+
+    // The lock is timed only when it is contended, an uncontended acquisition costs a `try_lock`.
+    void lock(std::unique_lock<std::mutex>& lock)
+    {
+        m_lockAcquisitions.fetch_add(1, std::memory_order_relaxed);
+        if (lock.try_lock())
+        {
+            return;
+        }
+        const InstrumentationClock::Clock::time_point start = InstrumentationClock::Clock::now();
+        lock.lock();
+        m_lockContentions.fetch_add(1, std::memory_order_relaxed);
+        m_lockWaitNanoseconds.fetch_add(InstrumentationClock::nanosecondsSince(start), std::memory_order_relaxed);
+    }
+
+    void depth(const std::size_t count)
+    {
+        std::size_t highWaterMark = m_highWaterMark.load(std::memory_order_relaxed);
+        while (count > highWaterMark
+               && !m_highWaterMark.compare_exchange_weak(highWaterMark, count, std::memory_order_relaxed))
+        {
+        }
+    }
+
+    void rejectFull()
+    {
+        m_fullRejections.fetch_add(1, std::memory_order_relaxed);
+    }
+
+    void rejectEmpty()
+    {
+        m_emptyRejections.fetch_add(1, std::memory_order_relaxed);
+    }
+
+    void write(std::ostream& output) const
+    {
+        output << "{\"id\": " << m_id
+               << ", \"kind\": " << InstrumentationClock::quote(m_kind)
+               << ", \"capacity\": " << m_capacity
+               << ", \"lockAcquisitions\": " << m_lockAcquisitions.load()
+               << ", \"lockContentions\": " << m_lockContentions.load()
+               << ", \"lockWaitNanoseconds\": " << m_lockWaitNanoseconds.load()
+               << ", \"highWaterMark\": " << m_highWaterMark.load()
+               << ", \"fullRejections\": " << m_fullRejections.load()
+               << ", \"emptyRejections\": " << m_emptyRejections.load() << "}";
+    }
+
+private:
+    const int m_id;
+    const std::string m_kind;
+    const std::size_t m_capacity;
+    std::atomic<unsigned long long> m_lockAcquisitions;
+    std::atomic<unsigned long long> m_lockContentions;
+    std::atomic<unsigned long long> m_lockWaitNanoseconds;
+    std::atomic<std::size_t> m_highWaterMark;
+    std::atomic<unsigned long long> m_fullRejections;
+    std::atomic<unsigned long long> m_emptyRejections;
+};
+
+/**
+* @brief
+*        Owns the counters of all the selects and channels of the program and writes
+*        them at exit. The counters outlive their channels, so the ones of a channel
+*        destroyed early are written too, and the registry is never destroyed, so a
+*        thread still running at exit can't use freed counters.
+*/
+class InstrumentationRegistry
+{
+public:
+    static InstrumentationRegistry& instance()
+    {
+        static InstrumentationRegistry* registry = create();
+        return *registry;
+    }
+
+    static const char* defaultFileName()
+    {
+        return "csp_instrumentation.json";
+    }
+
+    SelectCounters& addSelect(const std::string& name, const std::string& file, const int line, const int cases)
+    {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_selects.emplace_back(name, file, line, cases);
+        return m_selects.back();
+    }
+
+    ChannelCounters& addChannel(const std::string& kind, const std::size_t capacity)
+    {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_channels.emplace_back(static_cast<int>(m_channels.size()), kind, capacity);
+        return m_channels.back();
+    }
+
+    void write(std::ostream& output)
+    {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        output << "{\"selects\": [";
+        for (std::size_t index = 0; index < m_selects.size(); ++index)
+        {
+            output << (index == 0 ? "\n    " : ",\n    ");
+            m_selects[index].write(output);
+        }
+        output << "],\n \"channels\": [";
+        for (std::size_t index = 0; index < m_channels.size(); ++index)
+        {
+            output << (index == 0 ? "\n    " : ",\n    ");
+            m_channels[index].write(output);
+        }
+        output << "]}\n";
+    }
+
+    // Returns false if the file couldn't be written.
+    bool writeFile()
+    {
+        const char* fileName = std::getenv("CSP_INSTRUMENTATION_FILE");
+        std::ofstream output(fileName != nullptr && *fileName != '\0' ? fileName : defaultFileName());
+        write(output);
+        return static_cast<bool>(output);
+    }
+
+private:
+    InstrumentationRegistry() = default;
+
+    static InstrumentationRegistry* create()
+    {
+        InstrumentationRegistry* registry = new InstrumentationRegistry();
+        std::atexit([]() { instance().writeFile(); });
+        return registry;
+    }
+
+    std::mutex m_mutex;
+    // The counters don't move as more are added
+    std::deque<SelectCounters> m_selects;
+    std::deque<ChannelCounters> m_channels;
+};
+
+#endif
+
+#endif
@@ -7,6 +7,20 @@
 #include <mutex>         
 #include <condition_variable>
 #include <array>
+#include <cstddef>
+#include <atomic>
+#include <vector>
+#include <utility>
+#include <algorithm>
+#include <functional>
+#include <memory>
+#include <thread>
+
+#include "Instrumentation.h"
+
+#if defined(__x86_64__) || defined(__i386__) || defined(_M_X64) || defined(_M_IX86)
+#include <immintrin.h>
+#endif
 
 class RndUtils
 {
@@ -72,6 +86,376 @@ public:
 };
 
 
+/**
+* @brief
+*        Lets a blocking `select` sleep until one of its channels changes, instead of
+*        polling them in a loop. The select registers the same waiter with each of its
+*        channels, which call `notify` after every successful read, write or close.
+*        A notification is remembered until the next wait, so none is lost between
+*        polling the channels and starting to wait.
+*/
+class SelectWaiter
+{
+public:
+    // Upper bound of a single wait, the channels are polled again at least this often.
+    static std::chrono::milliseconds maxWait()
+    {
+        return std::chrono::milliseconds(100);
+    }
+
+    SelectWaiter()
+        : m_isSignaled(false)
+        , m_signaledCase(-1)
+    {
+    }
+
+    SelectWaiter(const SelectWaiter&) = delete;
+    SelectWaiter& operator=(const SelectWaiter&) = delete;
+
+    virtual ~SelectWaiter()
+    {
+    }
+
+    // `caseIndex` tells which case of the select can now make progress, -1 if unknown.
+    virtual void notify(const int caseIndex = -1)
+    {
+        {
+            std::lock_guard<std::mutex> lock(m_mutex);
+            if (!m_isSignaled)
+            {
+                m_isSignaled = true;
+                m_signaledCase = caseIndex;
+            }
+        }
+        m_condition.notify_one();
+    }
+
+    /**
+    * @brief
+    *        Block until `notify` is called or `timeout` passes, then rearm the waiter.
+    * @return
+    *        The index given to the first `notify` since the previous wait, -1 if there
+    *        was none or it was not given.
+    */
+    int waitFor(const std::chrono::milliseconds timeout = maxWait())
+    {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_condition.wait_for(lock, timeout, [this]() { return m_isSignaled; });
+        return rearm();
+    }
+
+    /**
+    * @brief
+    *        Same as `waitFor`, until `deadline` or `maxWait` from now, whichever
+    *        comes first. Used by the selects with a `case <- after(...)`.
+    */
+    int waitUntil(const std::chrono::steady_clock::time_point deadline)
+    {
+        const std::chrono::steady_clock::time_point latest = std::chrono::steady_clock::now() + maxWait();
+        std::unique_lock<std::mutex> lock(m_mutex);
+        m_condition.wait_until(lock, std::min(deadline, latest), [this]() { return m_isSignaled; });
+        return rearm();
+    }
+
+private:
+    // Called with `m_mutex` held.
+    int rearm()
+    {
+        const int signaledCase = m_signaledCase;
+        m_isSignaled = false;
+        m_signaledCase = -1;
+        return signaledCase;
+    }
+
+    std::mutex m_mutex;
+    std::condition_variable m_condition;
+    bool m_isSignaled;
+    int m_signaledCase;
+};
+
+/**
+* @brief
+*        Waiter of a `select[ready]`, for the wide selects: it keeps the index of every
+*        case its channels notify in a bitmap, so that after a wake-up the select polls
+*        the cases which changed, one `pop` each, instead of all of its cases.
+*        Every case is ready at first, as the channels may be before they know the waiter.
+*/
+class SelectReadySet : public SelectWaiter
+{
+public:
+    explicit SelectReadySet(const int cases)
+        : m_cases(cases)
+        , m_words((cases + WORD_BITS - 1) / WORD_BITS)
+        , m_ready(new std::atomic<unsigned long long>[m_words]())
+        , m_next(0)
+    {
+        markAll();
+    }
+
+    void notify(const int caseIndex = -1) override
+    {
+        if (caseIndex < 0 || caseIndex >= m_cases)
+        {
+            markAll();
+        }
+        else
+        {
+            m_ready[caseIndex / WORD_BITS].fetch_or(bit(caseIndex), std::memory_order_release);
+        }
+        SelectWaiter::notify(caseIndex);
+    }
+
+    /**
+    * @brief
+    *        Take a ready case out of the set. The search starts after the case taken
+    *        last, so a busy case can't starve the others. Only the select pops.
+    * @return
+    *        The index of the case, -1 if none is ready.
+    */
+    int pop()
+    {
+        for (int visited = 0; visited <= m_words; ++visited)
+        {
+            const int word = (m_next / WORD_BITS + visited) % m_words;
+            unsigned long long ready = m_ready[word].load(std::memory_order_acquire);
+            if (visited == 0)
+            {
+                // The cases of the first word before `m_next` come last, once the search wraps
+                ready &= ~0ULL << (m_next % WORD_BITS);
+            }
+            if (ready == 0)
+            {
+                continue;
+            }
+            const int caseIndex = word * WORD_BITS + lowestBit(ready);
+            m_ready[word].fetch_and(~bit(caseIndex), std::memory_order_acq_rel);
+            m_next = (caseIndex + 1) % m_cases;
+            return caseIndex;
+        }
+        return -1;
+    }
+
+    // Same as `waitFor`. A wait which ends without any case ready, once `maxWait` passes, makes
+    // all of them ready again, so the channels are still polled that often as with `park`.
+    void waitReady(const std::chrono::milliseconds timeout = maxWait())
+    {
+        waitFor(timeout);
+        markAllIfEmpty();
+    }
+
+    void waitReadyUntil(const std::chrono::steady_clock::time_point deadline)
+    {
+        waitUntil(deadline);
+        markAllIfEmpty();
+    }
+
+private:
+    static const int WORD_BITS = 64;
+
+    static unsigned long long bit(const int caseIndex)
+    {
+        return 1ULL << (caseIndex % WORD_BITS);
+    }
+
+    static int lowestBit(unsigned long long bits)
+    {
+#if defined(__GNUC__) || defined(__clang__)
+        return __builtin_ctzll(bits);
+#else
+        int position = 0;
+        for (; (bits & 1) == 0; bits >>= 1)
+        {
+            ++position;
+        }
+        return position;
+#endif
+    }
+
+    void markAll()
+    {
+        for (int word = 0; word < m_words; ++word)
+        {
+            const int bits = m_cases - word * WORD_BITS;
+            m_ready[word].fetch_or(bits >= WORD_BITS ? ~0ULL : (1ULL << bits) - 1, std::memory_order_release);
+        }
+    }
+
+    void markAllIfEmpty()
+    {
+        for (int word = 0; word < m_words; ++word)
+        {
+            if (m_ready[word].load(std::memory_order_acquire) != 0)
+            {
+                return;
+            }
+        }
+        markAll();
+    }
+
+    const int m_cases;
+    const int m_words;
+    std::unique_ptr<std::atomic<unsigned long long>[]> m_ready;
+    // Where the next `pop` starts
+    int m_next;
+};
+
+/**
+* @brief
+*        Deadline of a `case <- after(timeout):`, taken once when the select starts,
+*        which the select checks on each polling round instead of sleeping.
+*        `timeout` is a number of milliseconds or a `std::chrono` duration.
+*/
+class SelectDeadline
+{
+public:
+    using Clock = std::chrono::steady_clock;
+
+    static Clock::time_point after(const long long milliseconds)
+    {
+        return after(std::chrono::milliseconds(milliseconds));
+    }
+
+    template <class Rep, class Period>
+    static Clock::time_point after(const std::chrono::duration<Rep, Period> timeout)
+    {
+        return Clock::now() + std::chrono::duration_cast<Clock::duration>(timeout);
+    }
+
+    static bool hasPassed(const Clock::time_point deadline)
+    {
+        return Clock::now() >= deadline;
+    }
+};
+
+/**
+* @brief
+*        Backoff of a select which spins for a while before parking on its `SelectWaiter`.
+*        The first rounds pause the CPU for exponentially more cycles, the next ones yield
+*        the thread, and once `spinBudget` rounds are spent `spin` tells the select to park.
+*/
+class SelectBackoff
+{
+public:
+    static int defaultSpinBudget()
+    {
+        return 1000;
+    }
+
+    explicit SelectBackoff(const int spinBudget = defaultSpinBudget())
+        : m_rounds(0)
+        , m_spinBudget(spinBudget)
+    {
+    }
+
+    // Returns false once the budget is spent, then the select should park.
+    bool spin()
+    {
+        if (m_rounds >= m_spinBudget)
+        {
+            return false;
+        }
+
+        if (m_rounds < PAUSE_ROUNDS)
+        {
+            for (int pause = 0; pause < (1 << m_rounds); ++pause)
+            {
+                cpuRelax();
+            }
+        }
+        else
+        {
+            std::this_thread::yield();
+        }
+        ++m_rounds;
+        return true;
+    }
+
+private:
+    // Up to 2^PAUSE_ROUNDS pauses before yielding
+    static const int PAUSE_ROUNDS = 6;
+
+    static void cpuRelax()
+    {
+#if defined(__x86_64__) || defined(__i386__) || defined(_M_X64) || defined(_M_IX86)
+        _mm_pause();
+#elif defined(__aarch64__) || defined(__arm__)
+        __asm__ __volatile__("yield");
+#endif
+    }
+
+    int m_rounds;
+    const int m_spinBudget;
+};
+
+// Where the polling rounds of a select start, so that a busy case can't starve the next ones.
+class SelectOrder
+{
+public:
+    // `turn` belongs to the select, each call moves its start one case further
+    static unsigned roundRobin(std::atomic<unsigned>& turn, const unsigned size)
+    {
+        return turn.fetch_add(1, std::memory_order_relaxed) % size;
+    }
+
+    static unsigned random(const unsigned size)
+    {
+        thread_local std::minstd_rand engine(std::random_device{}());
+        return static_cast<unsigned>(engine()) % size;
+    }
+};
+
+// The waiters registered with a channel, guarded by the channel's own mutex.
+class SelectWaiterList
+{
+public:
+    void add(SelectWaiter* waiter, const int caseIndex)
+    {
+        m_waiters.emplace_back(waiter, caseIndex);
+    }
+
+    void remove(SelectWaiter* waiter)
+    {
+        m_waiters.erase(std::remove_if(m_waiters.begin(), m_waiters.end(),
+                                       [waiter](const std::pair<SelectWaiter*, int>& entry) { return entry.first == waiter; }),
+                        m_waiters.end());
+    }
+
+    void notifyAll() const
+    {
+        for (const std::pair<SelectWaiter*, int>& entry : m_waiters)
+        {
+            entry.first->notify(entry.second);
+        }
+    }
+
+private:
+    std::vector<std::pair<SelectWaiter*, int>> m_waiters;
+};
+
+// Registers a waiter with a channel for the lifetime of the object, so that it is
+// unregistered on every way out of the select, including `break` and exceptions.
+class SelectWaiterRegistration
+{
+public:
+    template <class Channel>
+    SelectWaiterRegistration(Channel& channel, SelectWaiter& waiter, const int caseIndex = -1)
+        : m_unregister([&channel, &waiter]() { channel.removeWaiter(&waiter); })
+    {
+        channel.addWaiter(&waiter, caseIndex);
+    }
+
+    SelectWaiterRegistration(const SelectWaiterRegistration&) = delete;
+    SelectWaiterRegistration& operator=(const SelectWaiterRegistration&) = delete;
+
+    ~SelectWaiterRegistration()
+    {
+        m_unregister();
+    }
+
+private:
+    std::function<void()> m_unregister;
+};
+
 
 template<typename T, int CAPACITY>
 class BoundedBuffer
@@ -82,16 +466,22 @@ public:
     int m_front;    // Next index to read from
     int m_rear;     // Next index to write on
     int m_count;    // Number of elements active
+    bool m_isClosed;
 
     std::mutex m_lock;
 
     std::condition_variable m_notFullCondition;
     std::condition_variable m_notEmptyCondition;
 
+    SelectWaiterList m_waiters;
+
+    CSP_INSTRUMENT(ChannelCounters& m_counters = InstrumentationRegistry::instance().addChannel("BoundedBuffer", CAPACITY);)
+
     BoundedBuffer()
         : m_front(0)
         , m_rear(0)
         , m_count(0)
+        , m_isClosed(false)
     {
     }
 
@@ -102,40 +492,79 @@ public:
     // Returns true if suceeded to deposit the value
     bool deposit(const T& data, bool wait = true)
     {
-        std::unique_lock<std::mutex> l(m_lock);
+        CSP_LOCK(l, m_lock, m_counters);
 
         if (wait)
         {
-            m_notFullCondition.wait(l, [this]() {return m_count != CAPACITY; });
+            m_notFullCondition.wait(l, [this]() {return m_count != CAPACITY || m_isClosed; });
         }
 
         if (m_count == CAPACITY)
         {
+            CSP_INSTRUMENT(m_counters.rejectFull();)
             return false;
         }
 
         m_buffer[m_rear] = data;
         m_rear = (m_rear + 1) % CAPACITY;
         ++m_count;
+        CSP_INSTRUMENT(m_counters.depth(m_count);)
+        m_waiters.notifyAll();
 
         l.unlock();
         m_notEmptyCondition.notify_one();
         return true;
     }
 
+    // Deposits the values from `first` to `last`, as many as there is room for on each
+    // acquisition of the lock. Returns how many were deposited, with `wait` all of them
+    // unless the buffer is closed meanwhile.
+    template <class InputIt>
+    std::size_t depositMany(InputIt first, InputIt last, bool wait = true)
+    {
+        std::size_t deposited = 0;
+        CSP_LOCK(l, m_lock, m_counters);
+        while (first != last)
+        {
+            if (wait)
+            {
+                m_notFullCondition.wait(l, [this]() {return m_count != CAPACITY || m_isClosed; });
+            }
+
+            if (m_count == CAPACITY || m_isClosed)
+            {
+                CSP_INSTRUMENT(if (m_count == CAPACITY) m_counters.rejectFull();)
+                break;
+            }
+
+            for (; first != last && m_count != CAPACITY; ++first)
+            {
+                m_buffer[m_rear] = *first;
+                m_rear = (m_rear + 1) % CAPACITY;
+                ++m_count;
+                ++deposited;
+            }
+            CSP_INSTRUMENT(m_counters.depth(m_count);)
+            m_waiters.notifyAll();
+            m_notEmptyCondition.notify_all();
+        }
+        return deposited;
+    }
+
     bool empty() const { return m_count == 0; }
 
     bool fetch(T* outRes, bool wait = true) // Do not return reference !
     {
-        std::unique_lock<std::mutex> l(m_lock);
+        CSP_LOCK(l, m_lock, m_counters);
 
         if (wait)
         {
-            m_notEmptyCondition.wait(l, [this]() {return m_count != 0; });
+            m_notEmptyCondition.wait(l, [this]() {return m_count != 0 || m_isClosed; });
         }
 
         if (m_count == 0)
         {
+            CSP_INSTRUMENT(m_counters.rejectEmpty();)
             return false;
         }
 
@@ -146,13 +575,165 @@ public:
 
         m_front = (m_front + 1) % CAPACITY;
         --m_count;
+        m_waiters.notifyAll();
 
         l.unlock();
         m_notFullCondition.notify_one();
         return true;
     }
+
+    // Fetches up to `count` values into `outRes` under a single acquisition of the lock,
+    // with `wait` blocks until there is at least one or the buffer is closed.
+    // Returns how many were fetched, `outRes` may be `nullptr` to drop them.
+    std::size_t fetchMany(T* outRes, std::size_t count, bool wait = true)
+    {
+        CSP_LOCK(l, m_lock, m_counters);
+
+        if (wait)
+        {
+            m_notEmptyCondition.wait(l, [this]() {return m_count != 0 || m_isClosed; });
+        }
+
+        std::size_t fetched = 0;
+        for (; fetched < count && m_count != 0; ++fetched)
+        {
+            if (outRes)
+            {
+                outRes[fetched] = m_buffer[m_front];
+            }
+            m_front = (m_front + 1) % CAPACITY;
+            --m_count;
+        }
+
+        if (fetched == 0)
+        {
+            CSP_INSTRUMENT(if (count != 0) m_counters.rejectEmpty();)
+            return 0;
+        }
+        m_waiters.notifyAll();
+
+        l.unlock();
+        m_notFullCondition.notify_all();
+        return fetched;
+    }
+
+    // Wakes up the blocked `deposit`s and `fetch`es, they return once nothing is left to do.
+    void close()
+    {
+        {
+            std::lock_guard<std::mutex> l(m_lock);
+            m_isClosed = true;
+            m_waiters.notifyAll();
+        }
+        m_notFullCondition.notify_all();
+        m_notEmptyCondition.notify_all();
+    }
+
+    void addWaiter(SelectWaiter* waiter, const int caseIndex = -1)
+    {
+        std::lock_guard<std::mutex> l(m_lock);
+        m_waiters.add(waiter, caseIndex);
+    }
+
+    void removeWaiter(SelectWaiter* waiter)
+    {
+        std::lock_guard<std::mutex> l(m_lock);
+        m_waiters.remove(waiter);
+    }
+
+    void notifyWaiters()
+    {
+        std::lock_guard<std::mutex> l(m_lock);
+        m_waiters.notifyAll();
+    }
 };
 
 
+/**
+* @brief
+*        What `for (x : range channel)` iterates on: reads the channel in batches of up
+*        to `BATCH` values with `readMany`, a single lock acquisition each, until the
+*        channel is closed and drained.
+*/
+template <class Channel, std::size_t BATCH = 64>
+class ChannelRange
+{
+public:
+    using value_type = typename Channel::value_type;
+
+    class iterator
+    {
+    public:
+        explicit iterator(ChannelRange* range)
+            : m_range(range)
+        {
+        }
+
+        value_type& operator*() const
+        {
+            return m_range->m_batch[m_range->m_position];
+        }
+
+        iterator& operator++()
+        {
+            if (!m_range->advance())
+            {
+                m_range = nullptr;
+            }
+            return *this;
+        }
+
+        bool operator!=(const iterator& other) const
+        {
+            return m_range != other.m_range;
+        }
+
+    private:
+        // `nullptr` once the channel is drained, like the end iterator
+        ChannelRange* m_range;
+    };
+
+    explicit ChannelRange(Channel& channel)
+        : m_channel(channel)
+        , m_size(0)
+        , m_position(0)
+    {
+    }
+
+    iterator begin()
+    {
+        return iterator(refill() ? this : nullptr);
+    }
+
+    iterator end()
+    {
+        return iterator(nullptr);
+    }
+
+private:
+    bool refill()
+    {
+        m_size = m_channel.readMany(m_batch.data(), BATCH, true);
+        m_position = 0;
+        return m_size != 0;
+    }
+
+    bool advance()
+    {
+        return ++m_position < m_size || refill();
+    }
+
+    Channel& m_channel;
+    std::array<value_type, BATCH> m_batch;
+    std::size_t m_size;
+    std::size_t m_position;
+};
+
+template <class Channel>
+ChannelRange<Channel> channelRange(Channel& channel)
+{
+    return ChannelRange<Channel>(channel);
+}
+
 
 #endif
@@ -21,9 +21,12 @@ void select_0(ChannelUnbounded<std::string>& channel1,
     const bool readFromChannel2,
     int& outVar2)
 {
-    // TODO: run this with two options: spinning lock or as a task lock.
-    // In task lock, create it as a TBB or simple THREAD to avoid the dependency if TBB is not needed elsewhere and wait for it.
-    // In spin lock do exactly what it does now
+    // The wait strategy is chosen by the generator (`--wait-strategy spin|park|hybrid` or `select[hybrid] {`).
+    // This is the `hybrid` one: spin with a backoff for a while, then sleep until one of the channels changes.
+    SelectWaiter selectWaiter;
+    SelectWaiterRegistration selectWaiterRegistration0(channel1, selectWaiter, 0);
+    SelectWaiterRegistration selectWaiterRegistration1(channel2, selectWaiter, 1);
+    SelectBackoff selectBackoff;
     while (true)
     {
         if (readFromChannel1)
@@ -37,6 +40,11 @@ void select_0(ChannelUnbounded<std::string>& channel1,
             if (channel2.read(outVar2, false))
                 break;
         }
+
+        if (!selectBackoff.spin())
+        {
+            selectWaiter.waitFor();
+        }
     }
 }
 
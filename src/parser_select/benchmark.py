@@ -0,0 +1,302 @@
+"""Benchmarks of the translator, run over a synthetic corpus.
+
+    python benchmark.py --lines 2000 --lines 20000 --lines 200000 --save
+    python benchmark.py --lines 2000 --lines 20000 --lines 200000
+
+With `--save`, the results become the baseline. Without it, a run fails when a phase got slower
+or uses more memory than the baseline allows, or when its time no longer grows linearly
+with the size of the input. As long as no baseline was saved, only the scaling is checked.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import click
+
+try:
+    from .parser_select import CppGenerator, HeaderGenerator, SelectParser
+except ImportError:
+    from parser_select import CppGenerator, HeaderGenerator, SelectParser
+
+
+class CorpusOptions(typing.NamedTuple):
+    # Approximate number of lines of each file.
+    lines: int = 10000
+    selects: int = 20
+    cases: int = 4
+    # Fraction of the filler lines which are comments.
+    comment_density: float = 0.2
+    # Number of lines of each case's body.
+    body_lines: int = 3
+
+
+class CorpusGenerator:
+    """Produce C++ files with `select`s and `<-`s, shaped by `CorpusOptions`."""
+    _HEADER: str = "#include <iostream>\n" \
+                   "#include <string>\n" \
+                   "\n" \
+                   '#include "common/ChannelBounded.h"\n' \
+                   '#include "common/ChannelUnbounded.h"\n' \
+                   "\n"
+    _COMMENTS: typing.Tuple[str, ...] = (
+        "    // A comment which mentions select and <- without being code.\n",
+        "    /* A block comment with a case: inside. */\n",
+        "    // Plain comment line.\n",
+    )
+
+    def __init__(self, options: CorpusOptions, seed: int = 0) -> None:
+        self._options: CorpusOptions = options
+        self._random: random.Random = random.Random(seed)
+
+    def _get_filler_line(self, index: int) -> str:
+        if self._random.random() < self._options.comment_density:
+            return self._random.choice(self._COMMENTS)
+        return f'    std::string text_{index} = "{{ literal with select {{ and <- }}";\n'
+
+    def _get_body(self, case_index: int) -> typing.List[str]:
+        return ["        {\n"] + [
+            f'            std::cout << "case {case_index}, line {line}" << std::endl;\n'
+            for line in range(self._options.body_lines)
+        ] + ["        }\n"]
+
+    def _get_select(self, function_index: int) -> typing.List[str]:
+        lines: typing.List[str] = ["    select {\n"]
+        for case_index in range(self._options.cases):
+            channel: str = f"channel_{function_index}_{case_index}"
+            message: str = f"message_{case_index}"
+            if case_index % 2:
+                lines.append(f"        case {channel} <- {message}:\n")
+            else:
+                lines.append(f"        case {message} <- {channel}:\n")
+            lines.extend(self._get_body(case_index))
+        lines.append("    }\n")
+        return lines
+
+    def _get_function(self, function_index: int, filler_lines: int) -> typing.List[str]:
+        channel: str = f"channel_{function_index}_0"
+        lines: typing.List[str] = [f"void function_{function_index}()\n", "{\n"]
+        lines.extend(
+            f"    ChannelUnbounded<std::string, 100> channel_{function_index}_{case_index};\n"
+            for case_index in range(self._options.cases)
+        )
+        lines.extend(f"    std::string message_{case_index};\n" for case_index in range(self._options.cases))
+        lines.extend(self._get_filler_line(index) for index in range(filler_lines // 2))
+        lines.append(f"    {channel} <- message_0;\n")
+        lines.extend(self._get_select(function_index))
+        lines.append(f"    message_0 <- {channel};\n")
+        lines.extend(self._get_filler_line(index) for index in range(filler_lines - filler_lines // 2))
+        lines.extend(("}\n", "\n"))
+        return lines
+
+    def generate(self) -> str:
+        """Return the source of one file."""
+        functions: int = max(self._options.selects, 1)
+        function_lines: int = len(self._get_function(0, 0))
+        filler_lines: int = max(self._options.lines // functions - function_lines, 0)
+
+        lines: typing.List[str] = [self._HEADER]
+        for function_index in range(self._options.selects):
+            lines.extend(self._get_function(function_index, filler_lines))
+        if not self._options.selects:
+            lines.extend(self._get_filler_line(index) for index in range(self._options.lines))
+        return "".join(lines)
+
+    def write(self, directory: str, files: int = 1) -> typing.List[str]:
+        """Write `files` files in `directory`, return their names."""
+        file_names: typing.List[str] = []
+        for index in range(files):
+            file_name: str = os.path.join(directory, f"corpus_{index}.cpp")
+            with open(file_name, "w", encoding="utf-8", newline="") as output:
+                output.write(self.generate())
+            file_names.append(file_name)
+        return file_names
+
+
+class BenchmarkResult(typing.NamedTuple):
+    phase: str
+    lines: int
+    selects: int
+    seconds: float
+    # Peak of the memory allocated by Python during the phase, in bytes.
+    peak_memory: int
+
+    @property
+    def lines_per_second(self) -> float:
+        return self.lines / self.seconds
+
+    @property
+    def selects_per_second(self) -> float:
+        return self.selects / self.seconds
+
+
+class Benchmark:
+    """Time `SelectParser.parse`, `HeaderGenerator.generate` and `CppGenerator.generate` on one file."""
+    PHASES: typing.Tuple[str, ...] = ("parse", "header", "cpp")
+
+    def __init__(self, input_file_name: str, repeat: int = 3) -> None:
+        self._input_file_name: str = input_file_name
+        self._header_file_name: str = os.path.splitext(input_file_name)[0] + "_AUTOGENERATED.h"
+        self._repeat: int = repeat
+        with SelectParser.open_input(input_file_name) as input_file:
+            self._lines: int = sum(1 for _ in input_file)
+        self._select_data: typing.List[SelectParser.SelectContent] = SelectParser(input_file_name).parse()
+
+    def _run_phase(self, phase: str) -> None:
+        if phase == "parse":
+            SelectParser(self._input_file_name).parse()
+        elif phase == "header":
+            HeaderGenerator.generate(self._select_data, self._header_file_name)
+        else:
+            CppGenerator(self._input_file_name, self._header_file_name).generate()
+
+    def _measure(self, phase: str) -> BenchmarkResult:
+        seconds: float = min(self._time(phase) for _ in range(self._repeat))
+        # Tracing the allocations slows the phase down, so the memory is measured by a separate run.
+        tracemalloc.start()
+        try:
+            self._run_phase(phase)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return BenchmarkResult(phase, self._lines, len(self._select_data), seconds, peak_memory)
+
+    def _time(self, phase: str) -> float:
+        start: float = time.perf_counter()
+        self._run_phase(phase)
+        return max(time.perf_counter() - start, sys.float_info.epsilon)
+
+    def run(self) -> typing.List[BenchmarkResult]:
+        return [self._measure(phase) for phase in self.PHASES]
+
+
+def run_benchmarks(sizes: typing.Iterable[int],
+                   options: CorpusOptions = CorpusOptions(),
+                   repeat: int = 3) -> typing.List[BenchmarkResult]:
+    """Run every phase over a generated file of each size, with the same mix of content."""
+    results: typing.List[BenchmarkResult] = []
+    with tempfile.TemporaryDirectory() as directory:
+        for lines in sizes:
+            # The number of `select`s grows with the size, to keep the mix of the file.
+            selects: int = max(round(options.selects * lines / options.lines), 1) if options.selects else 0
+            generator = CorpusGenerator(options._replace(lines=lines, selects=selects))
+            size_directory: str = os.path.join(directory, str(lines))
+            os.makedirs(size_directory)
+            input_file_name, = generator.write(size_directory)
+            results.extend(Benchmark(input_file_name, repeat).run())
+    return results
+
+
+def check_scaling(results: typing.List[BenchmarkResult], max_ratio: float) -> typing.List[str]:
+    """Return a failure for each phase whose time per line, between the smallest and the
+    largest input, grew more than `max_ratio` times.
+    """
+    failures: typing.List[str] = []
+    for phase in Benchmark.PHASES:
+        phase_results: typing.List[BenchmarkResult] = sorted(
+            (result for result in results if result.phase == phase), key=lambda result: result.lines
+        )
+        if len(phase_results) < 2:
+            continue
+        smallest, largest = phase_results[0], phase_results[-1]
+        ratio: float = smallest.lines_per_second / largest.lines_per_second
+        if ratio > max_ratio:
+            failures.append(
+                f"{phase}: {ratio:.2f}x slower per line on {largest.lines} lines than on {smallest.lines} lines"
+            )
+    return failures
+
+
+def _get_key(result: BenchmarkResult) -> str:
+    return f"{result.phase}/{result.lines}"
+
+
+def save_baseline(results: typing.List[BenchmarkResult], file_name: str) -> None:
+    with open(file_name, "w", encoding="utf-8") as output:
+        json.dump({_get_key(result): result._asdict() for result in results}, output, indent=4, sort_keys=True)
+
+
+def load_baseline(file_name: str) -> typing.Dict[str, BenchmarkResult]:
+    with open(file_name, "r", encoding="utf-8") as input_file:
+        return {key: BenchmarkResult(**result) for key, result in json.load(input_file).items()}
+
+
+def check_regressions(results: typing.List[BenchmarkResult],
+                      baseline: typing.Dict[str, BenchmarkResult],
+                      tolerance: float) -> typing.List[str]:
+    """Return a failure for each result slower or using more memory than its baseline, beyond `tolerance`."""
+    failures: typing.List[str] = []
+    for result in results:
+        expected: typing.Optional[BenchmarkResult] = baseline.get(_get_key(result))
+        if expected is None:
+            continue
+        if result.lines_per_second < expected.lines_per_second * (1 - tolerance):
+            failures.append(
+                f"{_get_key(result)}: {result.lines_per_second:.0f} lines/s, "
+                f"the baseline is {expected.lines_per_second:.0f} lines/s"
+            )
+        if result.peak_memory > expected.peak_memory * (1 + tolerance):
+            failures.append(
+                f"{_get_key(result)}: {result.peak_memory} bytes at peak, "
+                f"the baseline is {expected.peak_memory} bytes"
+            )
+    return failures
+
+
+def _format_result(result: BenchmarkResult) -> str:
+    return f"{result.phase:>6} {result.lines:>9} lines {result.selects:>6} selects " \
+           f"{result.lines_per_second:>12.0f} lines/s {result.selects_per_second:>10.0f} selects/s " \
+           f"{result.peak_memory / 1024:>10.0f} KiB peak"
+
+
+@click.command("Benchmark the translator")
+@click.option("--lines", "sizes", type=int, multiple=True, default=(2000, 20000, 200000), show_default=True,
+              help="Size of a generated file, repeat the option for each size.")
+@click.option("--selects", type=int, default=CorpusOptions().selects,
+              show_default=True, help="Selects in a file of 10000 lines.")
+@click.option("--cases", type=int, default=CorpusOptions().cases, show_default=True, help="Cases per select.")
+@click.option("--comment-density", type=float, default=CorpusOptions().comment_density, show_default=True,
+              help="Fraction of the lines outside selects which are comments.")
+@click.option("--body-lines", type=int, default=CorpusOptions().body_lines, show_default=True,
+              help="Lines of each case's body.")
+@click.option("--repeat", type=int, default=3, show_default=True, help="Runs per phase, the fastest one is kept.")
+@click.option("--baseline", "baseline_file_name", type=click.Path(dir_okay=False), default="benchmark_baseline.json",
+              show_default=True, help="File with the results to compare with.")
+@click.option("--save", is_flag=True, help="Save the results as the new baseline instead of comparing with it.")
+@click.option("--tolerance", type=float, default=0.25, show_default=True,
+              help="Allowed slowdown and memory growth compared to the baseline.")
+@click.option("--max-scaling", type=float, default=2.0, show_default=True,
+              help="Allowed growth of the time per line from the smallest to the largest file.")
+def main(sizes: typing.Tuple[int, ...],
+         selects: int,
+         cases: int,
+         comment_density: float,
+         body_lines: int,
+         repeat: int,
+         baseline_file_name: str,
+         save: bool,
+         tolerance: float,
+         max_scaling: float) -> None:
+    options = CorpusOptions(selects=selects, cases=cases, comment_density=comment_density, body_lines=body_lines)
+    results: typing.List[BenchmarkResult] = run_benchmarks(sorted(sizes), options, repeat)
+    for result in results:
+        click.echo(_format_result(result))
+
+    failures: typing.List[str] = check_scaling(results, max_scaling)
+    if save:
+        save_baseline(results, baseline_file_name)
+        click.echo(f"Baseline saved to {baseline_file_name}")
+    elif os.path.exists(baseline_file_name):
+        failures.extend(check_regressions(results, load_baseline(baseline_file_name), tolerance))
+    for failure in failures:
+        click.echo(failure, err=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,94 +2,68 @@
 #ifndef AUTOGENERATED_H
 #define AUTOGENERATED_H
 
-#define select_0(channel1, true, message1, channel2, true, message2, channel3, false, message3, channel_GuiSim, true, nullptr) \
-{ \
-if (true) \
-{ \
-if (true) \
-{ \
-if (channel1.read(&message1, false)) \
+template <class Channel0, class Message0, class Channel1, class Message1, class Channel2, class Message2, class Channel3, class Message3>
+inline int select_shape_rrwr_default(Channel0& channel0, Message0 message0, Channel1& channel1, Message1 message1, Channel2& channel2, const Message2& message2, Channel3& channel3, Message3 message3)
+{
+    if (channel0.read(message0, false))
+    {
+        return 0;
+    }
+    if (channel1.read(message1, false))
+    {
+        return 1;
+    }
+    if (channel2.write(message2, false))
+    {
+        return 2;
+    }
+    if (channel3.read(message3, false))
+    {
+        return 3;
+    }
+    return -1;
+}
+
+#define select_0(selectChannel0, selectMessage0, selectChannel1, selectMessage1, selectChannel2, selectMessage2, selectChannel3, selectMessage3) \
 { \
-        { \
-            printf("1"); \
-        }    \
-break;\
-} \
-} \
-else \
+switch (select_shape_rrwr_default(selectChannel0, selectMessage0, selectChannel1, selectMessage1, selectChannel2, selectMessage2, selectChannel3, selectMessage3)) \
 { \
-if (channel1.write(message1, false)) \
+case 0: \
 { \
         { \
             printf("1"); \
         }    \
-break;\
 } \
-} \
-if (true) \
-{ \
-if (channel2.read(&message2, false)) \
-{ \
-        { \
-            printf("2"); \
-        } \
-break;\
-} \
-} \
-else \
-{ \
-if (channel2.write(message2, false)) \
+break; \
+case 1: \
 { \
         { \
             printf("2"); \
         } \
-break;\
 } \
-} \
-if (false) \
-{ \
-if (channel3.read(&message3, false)) \
+break; \
+case 2: \
 { \
         { \
             printf("Succeeded to write on channel 3\n"); \
         } \
-break;\
-} \
 } \
-else \
-{ \
-if (channel3.write(message3, false)) \
-{ \
-        { \
-            printf("Succeeded to write on channel 3\n"); \
-        } \
-break;\
-} \
-} \
-if (true) \
-{ \
-if (channel_GuiSim.read(nullptr, false)) \
+break; \
+case 3: \
 { \
         { \
             printf("Gui"); \
         } \
-break;\
-} \
 } \
-else \
-{ \
-if (channel_GuiSim.write(nullptr, false)) \
+break; \
+default: \
 { \
-        { \
-            printf("Gui"); \
-        } \
-break;\
-} \
-} \
         { \
             print ("nothing"); \
         } \
 } \
+break; \
+} \
 }
 
 
@@ -2,40 +2,40 @@
 #ifndef AUTOGENERATED_H
 #define AUTOGENERATED_H
 
-#define select_0(channel1, true, result, nullptr, false, std::this_thread::sleep_for(std::chrono::seconds(5))) \
-{ \
-while (true) \
+template <class Channel0, class Message0>
+inline int select_shape_rt(Channel0& channel0, Message0 message0, const SelectDeadline::Clock::time_point deadline1)
+{
+    while (true)
+    {
+        if (channel0.read(message0, false))
+        {
+            return 0;
+        }
+        if (SelectDeadline::hasPassed(deadline1))
+        {
+            return 1;
+        }
+    }
+}
+
+#define select_0(selectChannel0, selectMessage0) \
 { \
-if (true) \
+switch (select_shape_rt(selectChannel0, selectMessage0, SelectDeadline::after(std::chrono::seconds(5)))) \
 { \
-if (channel1.read(&result, false)) \
+case 0: \
 { \
 	        { \
 		        results.push_back(result); \
 	        } \
-break;\
-} \
 } \
-else \
-{ \
-if (channel1.write(result, false)) \
+break; \
+case 1: \
 { \
-	        { \
-		        results.push_back(result); \
-	        } \
-break;\
-} \
-} \
-if (false) \
-{ \
-} \
-else \
-{\
-std::this_thread::sleep_for(std::chrono::seconds(5));\
 	        { \
 		        return results; \
 	        } \
-}\
+} \
+break; \
 } \
 }
 
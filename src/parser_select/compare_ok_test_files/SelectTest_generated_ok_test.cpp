@@ -89,7 +89,7 @@ void runSelectExample()
 
     // Simulation of Golang's `select` statement
 
-select_0(channel1, true, message1, channel2, true, message2, channel3, false, message3, channel_GuiSim, true, nullptr);    
+select_0(channel1, &message1, channel2, &message2, channel3, message3, channel_GuiSim, nullptr);    
    // THE DEFINE CODE WILL BE IN A DIFFERENT FILE
    // We can't do it as a function since we'll lose user's context
    // select_X where X define the X'th encountered selec in this file
@@ -148,7 +148,7 @@ gobyexample: typing.Dict[int, typing.List[str]] = {
         '   ChannelUnbounded<bool, 10>   channel_GuiSim;\n'
         '   ChannelBounded<MyStruct> channel_commTest;\n'
         '\n'
-        'select_0(channel1, true, message1, channel2, true, message2, channel3, false, message3, channel_GuiSim, true, nullptr);}\n'
+        'select_0(channel1, &message1, channel2, &message2, channel3, message3, channel_GuiSim, nullptr);}\n'
         'int main()\n'
         '{\n'
         '   RndUtils::initRandomGen(false);\n'
@@ -199,14 +199,12 @@ gobyexample: typing.Dict[int, typing.List[str]] = {
         'ChannelBounded<std::string> channel1;\n'
         '\n'
         'vector<string> googleParallel2(string query) {\n'
-        'channel1.write(getWeb(query), false);\n'
-        'channel1.write(getImage(query), false);\n'
-        'channel1.write(getVideo(query), false);\n'
+        'channel1.writeMany({getWeb(query), getImage(query), getVideo(query)}, false);\n'
         '   string result;\n'
         '   vector<string> results;\n'
         '\n'
         '   for (int i = 0; i < 3; i++) {\n'
-        'select_0(channel1, true, result, nullptr, false, std::this_thread::sleep_for(std::chrono::seconds(5)));   }\n'
+        'select_0(channel1, &result);   }\n'
         '\n'
         '   return results;\n'
         '}\n'
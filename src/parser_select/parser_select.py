@@ -1,8 +1,33 @@
-import _io
+import codecs
+import concurrent.futures
+import bisect
+import contextlib
+import filecmp
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import typing
 
 import click
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak RSS is not reported there.
+    resource = None
+
+
+__version__: str = "0.1.0"
+
 
 class IndicesCase(typing.NamedTuple):
     receiver: int
@@ -15,14 +40,197 @@ class SeparatorsCodeBlock(typing.NamedTuple):
     close: str
 
 
+class Token(typing.NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+    line: int
+    depth: int
+
+
+class SelectLexer:
+    """Splits C/C++ source into the tokens `SelectParser` cares about, in a single linear pass.
+
+    Comments, string and character literals are returned as whole tokens, so a `select`,
+    a `<-` or a brace found inside them never reaches the parser as code.
+    Everything the parser doesn't need (plain identifiers, operators) is skipped by the regex
+    engine itself and never becomes a token.
+
+    `depth` is the brace depth the token is found at. An opening brace carries the depth
+    outside of it, and so does its matching closing brace.
+    """
+    COMMENT: str = "comment"
+    STRING: str = "string"
+    NUMBER: str = "number"
+    KEYWORD: str = "keyword"
+    # `range` in `for (x : range channel)`, not a keyword of the `select`s.
+    RANGE: str = "range"
+    ARROW: str = "arrow"
+    SCOPE: str = "scope"
+    COLON: str = "colon"
+    OPEN: str = "open"
+    CLOSE: str = "close"
+    # Tokens which are never code, the parser is not interested in them.
+    NOT_CODE: typing.FrozenSet[str] = frozenset([COMMENT, STRING, NUMBER])
+
+    _TOKEN_PATTERN: typing.Pattern = re.compile(
+        r"""
+          (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+        | (?P<string>(?<!\w)(?:u8|[uUL])?R"(?P<delimiter>[^()\\\s"]{0,16})\(.*?(?:\)(?P=delimiter)"|\Z)
+                    |"(?:\\.|[^"\\\n])*"
+                    |'(?:\\.|[^'\\\n])*')
+        | (?P<number>(?<!\w)\d[\w.']*)
+        | (?P<keyword>\b(?:select|case|default)\b)
+        | (?P<range>\brange\b)
+        | (?P<arrow>(?<!\S)<-(?!\S))
+        | (?P<scope>::)
+        | (?P<colon>:)
+        | (?P<open>\{)
+        | (?P<close>\})
+        """,
+        re.VERBOSE | re.DOTALL
+    )
+
+    def __init__(self, source: str = "") -> None:
+        # Only the part of the input which may still be needed is kept in `_buffer`,
+        # all positions are absolute ones, counted from the beginning of the input.
+        self._buffer: str = source
+        self._offset: int = 0
+        self._position: int = 0
+        self._kept_from: typing.Optional[int] = None
+        self._line: int = 1
+        self._counted_up_to: int = 0
+        self._depth: int = 0
+
+    @property
+    def end(self) -> int:
+        """Return the position right after the last character received so far."""
+        return self._offset + len(self._buffer)
+
+    def text(self, start: int, end: int) -> str:
+        return self._buffer[start - self._offset:end - self._offset]
+
+    def line_start(self, position: int) -> int:
+        """Return the position of the first character on the line `position` is on."""
+        return self._buffer.rfind("\n", 0, position - self._offset) + 1 + self._offset
+
+    def line_end(self, position: int) -> int:
+        """Return the position right after the newline ending the line `position` is on."""
+        newline: int = self._buffer.find("\n", position - self._offset)
+        return self.end if newline == -1 else newline + 1 + self._offset
+
+    def keep_from(self, position: typing.Optional[int]) -> None:
+        """Keep the text starting at `position` until it is called again.
+        With `None`, only the line currently tokenized is kept.
+        """
+        self._kept_from = position
+
+    def tokens(self) -> typing.Iterator[Token]:
+        """Tokenize the whole source given to the constructor."""
+        return self._scan(final=True)
+
+    def feed(self, chunk: str) -> typing.Iterator[Token]:
+        """Add the next chunk of the input and return the tokens completed by it.
+        The returned tokens have to be consumed before feeding the next chunk.
+        """
+        kept_from: int = self._position if self._kept_from is None else min(self._kept_from, self._position)
+        drop: int = self.line_start(kept_from) - self._offset
+        if drop > 0:
+            self._line += self._buffer.count("\n", self._counted_up_to - self._offset, drop)
+            self._counted_up_to = drop + self._offset
+            self._buffer = self._buffer[drop:]
+            self._offset += drop
+        self._buffer += chunk
+        return self._scan(final=False)
+
+    def close(self) -> typing.Iterator[Token]:
+        """Return the tokens left after the last chunk of the input."""
+        return self._scan(final=True)
+
+    @staticmethod
+    def _is_unterminated(match: typing.Match) -> bool:
+        text: str = match.group()
+        if match.lastgroup == SelectLexer.COMMENT:
+            return text.startswith("/*") and (len(text) < 4 or not text.endswith("*/"))
+        if match.group("delimiter") is not None:
+            return not text.endswith(")" + match.group("delimiter") + '"')
+        return False
+
+    def _scan(self, final: bool) -> typing.Iterator[Token]:
+        buffer: str = self._buffer
+        offset: int = self._offset
+        # Unless it is the end of the input, only whole lines are tokenized, the last one may be incomplete.
+        limit: int = len(buffer) if final else buffer.rfind("\n") + 1
+        scanned_up_to: int = limit
+
+        for match in self._TOKEN_PATTERN.finditer(buffer, self._position - offset, limit):
+            kind: str = match.lastgroup
+            start: int = match.start()
+            if not final and match.end() == limit and self._is_unterminated(match):
+                # A comment or a raw string continuing in the next chunks, it is scanned again later.
+                scanned_up_to = start
+                break
+            self._line += buffer.count("\n", self._counted_up_to - offset, start)
+            self._counted_up_to = start + offset
+            self._position = match.end() + offset
+
+            if kind == self.OPEN:
+                yield Token(kind, "{", start + offset, start + offset + 1, self._line, self._depth)
+                self._depth += 1
+                continue
+            if kind == self.CLOSE:
+                self._depth = max(self._depth - 1, 0)
+            yield Token(kind, match.group(), start + offset, match.end() + offset, self._line, self._depth)
+
+        self._position = max(self._position, scanned_up_to + offset)
+
+
+class SelectBlock(typing.NamedTuple):
+    """A `select` and its span in the source: from the start of the line with the `select`
+    keyword, up to the end of the line with its closing brace.
+    """
+    cases: typing.List[typing.Tuple[typing.Optional[str], str, str]]
+    start: int
+    end: int
+    line: int
+    # `hybrid` for `select[hybrid] {`, `None` without brackets.
+    annotation: typing.Optional[str] = None
+    # The weight of each case, 3 for `case[3] message1 <- channel1:` and 1 when it is not given.
+    # `None` when no case of the `select` has one.
+    priorities: typing.Optional[typing.List[int]] = None
+
+
+class ChannelOperation(typing.NamedTuple):
+    """A `<-` outside of any `select`, its span is the whole line it is on."""
+    receiver: str
+    sender: str
+    start: int
+    end: int
+    line: int
+
+
+class RangeLoop(typing.NamedTuple):
+    """`for (x : range channel)`, which reads `channel` until it is closed and drained.
+    Its span is the header of the loop only, from `for` to its closing parenthesis.
+    """
+    declaration: str
+    channel: str
+    start: int
+    end: int
+    line: int
+
+
+ParsedBlock = typing.Union[SelectBlock, ChannelOperation, RangeLoop]
+
+
 class SelectParser(object):
     """Parses a `*.cpp` file and leaves the content as it is apart
     from the `select` block of code.
     When it encounters the `select`, it outputs it as a C/C++ `define`.
 
-    IMPORTANT
-    Better leave the `select` code without comments, because the possibility of encountering a `select` string
-    in a comment area is not handled yet.
+    The source is tokenized once by `SelectLexer`, so a `select` written in
+    a comment or in a string literal is not taken into account.
     """
     _SELECT_KEYWORD: str = "select"
     _CASE_KEYWORD: str = "case"
@@ -30,7 +238,32 @@ class SelectParser(object):
     DEFAULT_CASE_NAME: str = "default"
     _SEPARATORS_CODE_BLOCK = SeparatorsCodeBlock(open="{", close="}")
     INDICES_CASE = IndicesCase(receiver=0, sender=1, content=2)
+    # The encoding assumed before `detect_encoding` was available, kept for the callers using it.
     FILE_ENCODING: str = "utf-16-le"
+    # The byte order mark is kept in the decoded text, so it stays in the generated file as well.
+    _BYTE_ORDER_MARKS: typing.Tuple[typing.Tuple[bytes, str], ...] = (
+        (codecs.BOM_UTF32_LE, "utf-32-le"),
+        (codecs.BOM_UTF32_BE, "utf-32-be"),
+        (codecs.BOM_UTF8, "utf-8"),
+        (codecs.BOM_UTF16_LE, "utf-16-le"),
+        (codecs.BOM_UTF16_BE, "utf-16-be"),
+    )
+    _SNIFF_SIZE: int = 4096
+    # Past the bytes `detect_encoding` looked at, a byte which isn't valid in the encoding it
+    # detected is decoded as Latin-1, as it would have been had it been among them.
+    DECODE_ERRORS: str = "parser_select.latin-1"
+    # select[annotation] {
+    _ANNOTATION_PATTERN: typing.Pattern = re.compile(r"\[\s*(\w+)\s*\]")
+    # case[priority] message1 <- channel1:
+    _PRIORITY_PATTERN: typing.Pattern = re.compile(r"\s*\[\s*(\d+)\s*\]")
+    DEFAULT_PRIORITY: int = 1
+    # for (x : range channel)
+    _RANGE_LOOP_PATTERN: typing.Pattern = re.compile(
+        r"\bfor\s*\(\s*(?P<declaration>(?:[^;:()]|::)+?)\s*:\s*range\s+(?P<channel>[^;()]+?)\s*\)"
+    )
+    _RANGE_KEYWORD: str = "range"
+    # A file without any of these can't contain anything to translate.
+    _MARKERS: typing.Tuple[str, ...] = (_SELECT_KEYWORD, _CASE_SEPARATOR, _RANGE_KEYWORD)
 
     # case message1 <- channel1:   or    case channel1 <- message1:
     # {
@@ -42,18 +275,56 @@ class SelectParser(object):
     CaseContent = typing.Tuple[typing.Optional[str], str, str]
     SelectContent = typing.List[CaseContent]
 
+    # Number of characters read at once by `iter_selects`.
+    CHUNK_SIZE: int = 1 << 16
+
     def __init__(self, input_file_name: str) -> None:
         self._input_file_name: str = input_file_name
-        self._content: typing.List[str] = self.get_input_content(self._input_file_name)
+
+    @classmethod
+    def detect_encoding(cls, file_name: str) -> str:
+        """Return the encoding of the file, based on its byte order mark or, without one,
+        on its first bytes: ASCII text encoded as UTF-16 has every other byte 0.
+        """
+        with open(file_name, "rb") as input_file:
+            sample: bytes = input_file.read(cls._SNIFF_SIZE)
+
+        for byte_order_mark, encoding in cls._BYTE_ORDER_MARKS:
+            if sample.startswith(byte_order_mark):
+                return encoding
+        if b"\0" in sample:
+            return "utf-16-le" if sample[1::2].count(0) >= sample[0::2].count(0) else "utf-16-be"
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        except UnicodeDecodeError:
+            return "latin-1"
+        return "utf-8"
+
+    @classmethod
+    def contains_markers(cls, file_name: str, encoding: typing.Optional[str] = None) -> bool:
+        """Return True if the file may contain a `select` or a `<-`, False if it surely doesn't.
+        The bytes of the file are searched directly, without decoding them.
+        """
+        encoding = encoding or cls.detect_encoding(file_name)
+        with open(file_name, "rb") as input_file:
+            if os.fstat(input_file.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return any(content.find(marker.encode(encoding)) != -1 for marker in cls._MARKERS)
+
+    @staticmethod
+    def _decode_as_latin1(error: UnicodeError) -> typing.Tuple[str, int]:
+        return error.object[error.start:error.end].decode("latin-1"), error.end
+
+    @classmethod
+    def open_input(cls, file_name: str) -> typing.TextIO:
+        return open(file_name, "r", encoding=cls.detect_encoding(file_name), errors=cls.DECODE_ERRORS)
 
     @classmethod
     def get_input_content(cls, file_name: str) -> typing.List[str]:
-        with open(file_name, "r", encoding=cls.FILE_ENCODING) as input_file:
+        with cls.open_input(file_name) as input_file:
             return input_file.readlines()
 
-    def _is_valid_index(self, index: int) -> bool:
-        return index >= 0 and index < len(self._content)
-
     @staticmethod
     def is_comment_line(line: str) -> bool:
         """Return True if it is a line starting with `//`, False otherwise."""
@@ -62,112 +333,112 @@ class SelectParser(object):
             return False
         return components[0] == "//" or components[0] == "/*" or components[len(components) - 1] == "*/"
 
-    def _get_previous_important_line(self, index: int) -> typing.Optional[str]:
-        """Return the previous line which doesn't contain a comment with '//' or a newline."""
-        previous_index: int = index - 1
-        if not self._is_valid_index(previous_index):
-            return None
-        while previous_index >= 0:
-            if not self.is_comment_line(self._content[previous_index]) and self._content[previous_index] != "\n":
-                return self._content[previous_index]
-            previous_index = previous_index - 1
+    @staticmethod
+    def _next_code_token(tokens: typing.Iterator[Token]) -> typing.Optional[Token]:
+        for token in tokens:
+            if token.kind not in SelectLexer.NOT_CODE:
+                return token
         return None
 
-    def is_closing_select(self, index) -> bool:
-        if not self._is_valid_index(index - 1):
-            return False
-        if not self._is_valid_index(index):
-            return False
-        previous_line: str = self._get_previous_important_line(index)
-        current_line: str = self._content[index]
-        if previous_line.split() == [] or current_line.split() == []:
-            return False
-        if previous_line.split()[0] == self._SEPARATORS_CODE_BLOCK.close:
-            if current_line.split()[0] == self._SEPARATORS_CODE_BLOCK.close:
-                return True
-        return False
-
-    def _parse_select_block(self, index: int, select_data: SelectContent) -> int:
-        """Return the index of the last line in the current `select` block.
-        IMPORTANT
-        Please restrict to not having more than one block of code (separated by "{}") inside the `case`s.
-        It handles only this case for the moment.
+    @classmethod
+    def _parse_case(cls,
+                    lexer: SelectLexer,
+                    tokens: typing.Iterator[Token],
+                    keyword: Token) -> typing.Tuple[CaseContent, typing.Optional[int], typing.Optional[Token]]:
+        """Return the case starting at `keyword`, its priority if it is given and the first token after it.
+        For example, from
+        ```
+        case message1 <- channel1:
+        {
+            //case content here
+        }
+        ```
+        it will return
+        ```
+        ('message1', 'channel1', '{\n    //case content here\n}\n')
+        ```
         """
-        # ----------------------------------------
-        def _is_default_case(line: str) -> bool:
-            return line.split()[0] == self.DEFAULT_CASE_NAME + ":"
-
-        def _get_receiver(line: str) -> typing.Optional[str]:
-            if _is_default_case(line):
-                return None
-            receiver_component: typing.List[str] = line.split(self._CASE_KEYWORD)[1].split(
-                self._CASE_SEPARATOR
-            )[self.INDICES_CASE.receiver].split()
-            return receiver_component[0] if receiver_component else None
-
-        def _get_sender(line: str) -> str:
-            if _is_default_case(line):
-                return self.DEFAULT_CASE_NAME
-            sender: str = line.split(self._CASE_KEYWORD)[1].split(
-                self._CASE_SEPARATOR
-            )[self.INDICES_CASE.sender].split()[0]
-            # It has ":".
-            return sender[:len(sender) - 1]
-
-        def _get_content(index: int) -> typing.Tuple[int, str]:
-            """Return the index of the last line from the current `select`'s content and the actual content.
-            For example, from
-            ```
-            case {
-                //case content here
-            }
-            ```
-            it will return
-            ```
-            {
-                //case content here
-            }
-            ```
-            """
-            index += 1  # to go on the starting content area
-            content: str = ""
-            while True:
-                if not self._is_valid_index(index):
-                    break
-                content += self._content[index]
-                if self._content[index].split() == []:
-                    index += 1
-                    continue
-                if self._content[index].split()[0] == self._SEPARATORS_CODE_BLOCK.close:
-                    break
-                index += 1
-            return index, content
-        # ----------------------------------------
-        # `select` line
-        index += 1
-
-        while True:
-            if not self._is_valid_index(index):
-                break
-            if self.is_closing_select(index):
+        depth: int = keyword.depth
+        token: typing.Optional[Token] = cls._next_code_token(tokens)
+        while token is not None and not (token.kind == SelectLexer.COLON and token.depth == depth):
+            token = cls._next_code_token(tokens)
+        if token is None:
+            return (None, cls.DEFAULT_CASE_NAME, ""), None, None
+        colon: Token = token
+
+        receiver: typing.Optional[str] = None
+        sender: str = cls.DEFAULT_CASE_NAME
+        priority: typing.Optional[int] = None
+        if keyword.text == cls._CASE_KEYWORD:
+            header_start: int = keyword.end
+            priority_match: typing.Optional[typing.Match] = cls._PRIORITY_PATTERN.match(
+                lexer.text(keyword.end, colon.start)
+            )
+            if priority_match:
+                header_start += priority_match.end()
+                priority = int(priority_match.group(1))
+            # Unlike in the code, `<-` needs no spaces around it here: `case msg <-channel1:`.
+            header: str = lexer.text(header_start, colon.start)
+            separator: int = header.find(cls._CASE_SEPARATOR)
+            if separator == -1:
+                sender = header.strip()
+            else:
+                receiver = header[:separator].strip() or None
+                sender = header[separator + len(cls._CASE_SEPARATOR):].strip()
+
+        # The content starts on the line after the case's header, unless it is written on the same line.
+        content_start: int = lexer.line_end(colon.end)
+        header_rest: str = lexer.text(colon.end, content_start)
+        if header_rest.strip() and not header_rest.strip().startswith("//"):
+            content_start = colon.end + len(header_rest) - len(header_rest.lstrip())
+        token = cls._next_code_token(tokens)
+
+        if token is not None and token.kind == SelectLexer.OPEN and token.depth == depth:
+            while token is not None and not (token.kind == SelectLexer.CLOSE and token.depth == depth):
+                token = cls._next_code_token(tokens)
+            if token is None:
+                return (receiver, sender, lexer.text(content_start, lexer.end)), priority, None
+            content_end: int = token.end
+            rest_of_line: str = lexer.text(content_end, lexer.line_end(content_end)).strip()
+            if not rest_of_line or rest_of_line.startswith("//"):
+                content_end = lexer.line_end(content_end)
+            return (receiver, sender, lexer.text(content_start, content_end)), priority, cls._next_code_token(tokens)
+
+        # A case without braces lasts until the next case or until the end of the `select`.
+        while token is not None and token.depth >= depth:
+            if token.kind == SelectLexer.KEYWORD and token.depth == depth and token.text != cls._SELECT_KEYWORD:
                 break
-            line: str = self._content[index]
-            if line.split() == [] or self.is_comment_line(line):
-                index += 1
-                continue
-            if not self.has_case_mark(line):
-                if self.DEFAULT_CASE_NAME + ":" not in line.split():
-                    index += 1
-                    continue
-            # `case` area
-            receiver: str = _get_receiver(line)
-            sender: str = _get_sender(line)
-            index, content = _get_content(index)
-            case_content: self.CaseContent = (receiver, sender, content)
-            select_data.append(case_content)
-            index += 1
+            token = cls._next_code_token(tokens)
+        content_end = lexer.end if token is None else lexer.line_start(token.start)
+        if token is not None and content_end <= content_start:
+            content_end = token.start
+        return (receiver, sender, lexer.text(content_start, content_end)), priority, token
 
-        return index
+    @classmethod
+    def _parse_select_block(cls,
+                            lexer: SelectLexer,
+                            tokens: typing.Iterator[Token],
+                            opening: Token
+                            ) -> typing.Tuple[SelectContent, typing.Optional[typing.List[int]], typing.Optional[Token]]:
+        """Return the cases of the `select` whose block starts at the `opening` brace, their priorities
+        (`None` if no case has one) and its closing brace.
+        The tokens are consumed up to, and including, the closing brace of the block.
+        """
+        select_data: cls.SelectContent = []
+        priorities: typing.List[typing.Optional[int]] = []
+        token: typing.Optional[Token] = cls._next_code_token(tokens)
+        while token is not None and not (token.kind == SelectLexer.CLOSE and token.depth == opening.depth):
+            if (token.kind == SelectLexer.KEYWORD and
+                    token.depth == opening.depth + 1 and
+                    token.text != cls._SELECT_KEYWORD):
+                case_content, priority, token = cls._parse_case(lexer, tokens, token)
+                select_data.append(case_content)
+                priorities.append(priority)
+                continue
+            token = cls._next_code_token(tokens)
+        if all(priority is None for priority in priorities):
+            return select_data, None, token
+        return select_data, [cls.DEFAULT_PRIORITY if priority is None else priority for priority in priorities], token
 
     @classmethod
     def contains_select_keyword(cls, line: str) -> bool:
@@ -181,27 +452,345 @@ class SelectParser(object):
     def has_case_mark(cls, line: str) -> bool:
         return cls._CASE_KEYWORD in line.split()
 
+    @classmethod
+    def _get_channel_operation(cls, lexer: SelectLexer, arrow: Token) -> ChannelOperation:
+        """`message1 <- channel1;` or `channel1 <- message1;`"""
+        start: int = lexer.line_start(arrow.start)
+        end: int = lexer.line_end(arrow.start)
+        receiver: str = lexer.text(start, arrow.start).strip() or "nullptr"
+        sender: str = lexer.text(arrow.end, end).split(";")[0].strip()
+        return ChannelOperation(receiver, sender, start, end, arrow.line)
+
+    @classmethod
+    def _get_range_loop(cls, lexer: SelectLexer, keyword: Token) -> typing.Optional[RangeLoop]:
+        """Return the `for (x : range channel)` the `range` keyword belongs to, `None` for any other `range`."""
+        start: int = lexer.line_start(keyword.start)
+        for match in cls._RANGE_LOOP_PATTERN.finditer(lexer.text(start, lexer.line_end(keyword.start))):
+            if match.start() + start < keyword.start < match.end() + start:
+                return RangeLoop(match.group("declaration"), match.group("channel"),
+                                 match.start() + start, match.end() + start, keyword.line)
+        return None
+
+    @classmethod
+    def _iter_blocks(cls,
+                     lexer: SelectLexer,
+                     tokens: typing.Iterator[Token]) -> typing.Iterator[ParsedBlock]:
+        token: typing.Optional[Token] = cls._next_code_token(tokens)
+        last_operation_end: int = 0
+
+        while token is not None:
+            if token.kind == SelectLexer.ARROW and token.start >= last_operation_end:
+                operation: ChannelOperation = cls._get_channel_operation(lexer, token)
+                last_operation_end = operation.end
+                yield operation
+                token = cls._next_code_token(tokens)
+                continue
+            if token.kind == SelectLexer.RANGE and token.start >= last_operation_end:
+                loop: typing.Optional[RangeLoop] = cls._get_range_loop(lexer, token)
+                if loop is not None:
+                    yield loop
+                token = cls._next_code_token(tokens)
+                continue
+            if token.kind != SelectLexer.KEYWORD or token.text != cls._SELECT_KEYWORD:
+                token = cls._next_code_token(tokens)
+                continue
+            # `select` area
+            keyword: Token = token
+            start: int = lexer.line_start(keyword.start)
+            lexer.keep_from(start)
+            token = cls._next_code_token(tokens)
+            if token is None or token.kind != SelectLexer.OPEN:
+                lexer.keep_from(None)
+                continue
+            # Only `select {` or `select[annotation] {`, not `select(fd + 1, ...)` nor `<sys/select.h>`.
+            between: str = lexer.text(keyword.end, token.start).strip()
+            annotation: typing.Optional[typing.Match] = cls._ANNOTATION_PATTERN.fullmatch(between)
+            if between and annotation is None:
+                lexer.keep_from(None)
+                continue
+            select_data, priorities, closing = cls._parse_select_block(lexer, tokens, token)
+            end: int = lexer.end if closing is None else lexer.line_end(closing.end)
+            lexer.keep_from(None)
+            yield SelectBlock(select_data, start, end, keyword.line, annotation and annotation.group(1), priorities)
+            token = cls._next_code_token(tokens)
+
+    @classmethod
+    def _iter_selects(cls,
+                      lexer: SelectLexer,
+                      tokens: typing.Iterator[Token]) -> typing.Iterator[SelectContent]:
+        for block in cls._iter_blocks(lexer, tokens):
+            if isinstance(block, SelectBlock):
+                yield block.cases
+
+    @classmethod
+    def parse_blocks(cls, source: str, tokens: typing.Optional[typing.List[Token]] = None) -> typing.List[ParsedBlock]:
+        """Return the `select`s, the `<-` outside of them and the `for (x : range channel)` loops,
+        in the order they are found in `source`. `tokens` are the ones of `source`, when they are already known.
+        """
+        lexer: SelectLexer = SelectLexer(source)
+        return list(cls._iter_blocks(lexer, lexer.tokens() if tokens is None else iter(tokens)))
+
+    @classmethod
+    def iter_selects(cls,
+                     input_file: typing.TextIO,
+                     chunk_size: int = CHUNK_SIZE) -> typing.Iterator[SelectContent]:
+        """Yield the `select` data one by one, as soon as the closing brace of each `select` is read.
+        The input is read in chunks of `chunk_size` characters and only the text of the `select`
+        being parsed is kept in memory, not the whole input.
+        """
+        lexer: SelectLexer = SelectLexer()
+
+        def _tokens() -> typing.Iterator[Token]:
+            for chunk in iter(lambda: input_file.read(chunk_size), ""):
+                yield from lexer.feed(chunk)
+            yield from lexer.close()
+
+        return cls._iter_selects(lexer, _tokens())
+
     def parse(self) -> typing.List[SelectContent]:
         """Return an array of `select` data."""
-        index: int = 0
-        all_selects: typing.List[self.SelectContent] = []
+        if not self.contains_markers(self._input_file_name):
+            return []
+        with self.open_input(self._input_file_name) as input_file:
+            return list(self.iter_selects(input_file))
 
-        while True:
-            if not self._is_valid_index(index):
+
+codecs.register_error(SelectParser.DECODE_ERRORS, SelectParser._decode_as_latin1)
+
+
+class ChannelDeclaration(typing.NamedTuple):
+    """`ChannelUnbounded<std::string, 100> channel1;`, or a parameter of a function, of a channel type."""
+    name: str
+    # `ChannelIndex.BOUNDED`, `ChannelIndex.UNBOUNDED`, or one of the ring channels.
+    kind: str
+    element_type: str
+    # The second template argument, `None` for a `ChannelBounded`.
+    capacity: typing.Optional[str]
+    line: int
+
+
+FileSignature = typing.Tuple[int, int]
+
+
+class _IndexedFile(typing.NamedTuple):
+    # Modification time and size of the file when it was indexed.
+    signature: FileSignature
+    declarations: typing.List[ChannelDeclaration]
+    # The project headers it includes with `#include "..."`, which could be found.
+    includes: typing.List[str]
+
+
+class ChannelIndex:
+    """The channels declared in a file and in the project headers it includes, by name.
+
+    Whether a side of a `<-` is a channel, and which kind of channel it is, is looked up here.
+    A name which isn't declared anywhere the index can see, for example a member of a class
+    defined elsewhere, falls back to `HeaderGenerator.is_channel`.
+    """
+    BOUNDED: str = "ChannelBounded"
+    UNBOUNDED: str = "ChannelUnbounded"
+    KINDS: typing.Tuple[str, ...] = (BOUNDED, UNBOUNDED, "ChannelRingSPSC", "ChannelRingMPMC")
+    _TYPE_PATTERN: typing.Pattern = re.compile(r"\b(?P<kind>" + "|".join(KINDS) + r")\s*<")
+    # The name after the type, `ChannelBounded<int>& channel` or `const ChannelBounded<int>* const channel`.
+    _DECLARATOR_PATTERN: typing.Pattern = re.compile(r"(?:\s*(?:[&*]|\bconst\b))*\s*(?P<name>[A-Za-z_]\w*)")
+    # The next names of `ChannelBounded<int> channel1, channel2;`
+    _NEXT_DECLARATOR_PATTERN: typing.Pattern = re.compile(r"\s*,(?:\s*[&*])*\s*(?P<name>[A-Za-z_]\w*)\s*(?=[,;=({\[])")
+    _INCLUDE_PATTERN: typing.Pattern = re.compile(r'^[ \t]*(?P<hash>#)[ \t]*include[ \t]*"(?P<path>[^"\n]+)"', re.MULTILINE)
+    # The name a channel expression ends with: `channel1`, `this->channel1`, `pipeline.channel1`.
+    _NAME_PATTERN: typing.Pattern = re.compile(r"\s*(?:[A-Za-z_]\w*\s*(?:\.|->|::)\s*)*(?P<name>[A-Za-z_]\w*)\s*")
+    _NOT_NAMES: typing.FrozenSet[str] = frozenset(["const", "volatile", "operator"])
+
+    # Indexed files by their real path, they are indexed again only once they change.
+    _files: typing.Dict[str, _IndexedFile] = {}
+
+    def __init__(self,
+                 declarations: typing.Iterable[ChannelDeclaration] = (),
+                 files: typing.Iterable[typing.Tuple[str, FileSignature]] = ()) -> None:
+        # A later declaration of the same name, closer to the code using it, wins.
+        self._declarations: typing.Dict[str, ChannelDeclaration] = {
+            declaration.name: declaration for declaration in declarations
+        }
+        # The files scanned and their signature when they were, what the translation depends on besides its input.
+        self._signatures: typing.Dict[str, FileSignature] = dict(files)
+
+    @property
+    def declarations(self) -> typing.List[ChannelDeclaration]:
+        return list(self._declarations.values())
+
+    @property
+    def files(self) -> typing.List[str]:
+        return list(self._signatures)
+
+    @staticmethod
+    def _blank_comments_and_strings(source: str, tokens: typing.Optional[typing.List[Token]] = None) -> str:
+        """Return `source` with its comments and literals replaced by spaces, newlines are kept.
+        `tokens` are the ones of `source`, when they are already known.
+        """
+        fragments: typing.List[str] = []
+        position: int = 0
+        for token in SelectLexer(source).tokens() if tokens is None else tokens:
+            if token.kind in (SelectLexer.COMMENT, SelectLexer.STRING):
+                fragments.append(source[position:token.start])
+                fragments.append(re.sub(r"[^\n]", " ", token.text))
+                position = token.end
+        fragments.append(source[position:])
+        return "".join(fragments)
+
+    @staticmethod
+    def _split_template_arguments(code: str, start: int) -> typing.Tuple[typing.List[str], int]:
+        """Return the template arguments starting right after the `<` at `start - 1`, and where they end."""
+        arguments: typing.List[str] = []
+        depth: int = 0
+        argument_start: int = start
+        for position in range(start, len(code)):
+            character: str = code[position]
+            if character in "<([{":
+                depth += 1
+            elif character in ")]}":
+                depth -= 1
+            elif character == ">" and depth == 0:
+                arguments.append(code[argument_start:position].strip())
+                return arguments, position + 1
+            elif character == ">":
+                depth -= 1
+            elif character == "," and depth == 0:
+                arguments.append(code[argument_start:position].strip())
+                argument_start = position + 1
+            elif character == ";":
                 break
-            line: str = self._content[index]
-            if not self.contains_select_keyword(line):
-                index += 1
+        return [], len(code)
+
+    @classmethod
+    def scan(cls, source: str, tokens: typing.Optional[typing.List[Token]] = None) -> typing.List[ChannelDeclaration]:
+        """Return the channels declared in `source`, as variables, members or parameters."""
+        return cls._scan_code(cls._blank_comments_and_strings(source, tokens))
+
+    @classmethod
+    def _scan_code(cls, code: str) -> typing.List[ChannelDeclaration]:
+        declarations: typing.List[ChannelDeclaration] = []
+        # The lines are counted from the previous declaration on, not from the beginning each time.
+        line: int = 1
+        counted_up_to: int = 0
+        for match in cls._TYPE_PATTERN.finditer(code):
+            arguments, end = cls._split_template_arguments(code, match.end())
+            declarator: typing.Optional[typing.Match] = cls._DECLARATOR_PATTERN.match(code, end)
+            if not arguments or declarator is None or declarator.group("name") in cls._NOT_NAMES:
                 continue
+            line += code.count("\n", counted_up_to, match.start())
+            counted_up_to = match.start()
+            capacity: typing.Optional[str] = arguments[1] if len(arguments) > 1 else None
+            while declarator is not None:
+                declarations.append(
+                    ChannelDeclaration(declarator.group("name"), match.group("kind"), arguments[0], capacity, line)
+                )
+                declarator = cls._NEXT_DECLARATOR_PATTERN.match(code, declarator.end())
+        return declarations
 
-            # `select` area
-            select_data: self.SelectContent = []
-            index = self._parse_select_block(index, select_data)
-            index += 1
-            all_selects.append(select_data)
+    @classmethod
+    def _get_includes(cls, source: str, code: str, directory: str) -> typing.List[str]:
+        """Return the project headers `source` includes, `code` is `source` with its comments blanked out."""
+        includes: typing.List[str] = []
+        for match in cls._INCLUDE_PATTERN.finditer(source):
+            # An `#include` in a comment is blanked out.
+            if code[match.start("hash")] != "#":
+                continue
+            path: str = os.path.join(directory, match.group("path"))
+            if os.path.isfile(path):
+                includes.append(os.path.realpath(path))
+        return includes
 
+    @staticmethod
+    def get_signature(file_name: str) -> typing.Optional[FileSignature]:
+        """Return the modification time and the size of the file, `None` if it doesn't exist anymore."""
+        try:
+            status: os.stat_result = os.stat(file_name)
+        except OSError:
+            return None
+        return status.st_mtime_ns, status.st_size
 
-        return all_selects
+    @classmethod
+    def _index_file(cls,
+                    path: str,
+                    source: typing.Optional[str] = None,
+                    tokens: typing.Optional[typing.List[Token]] = None) -> _IndexedFile:
+        """Return the index of the file at the real path `path`, whose content is `source` if it was already read."""
+        signature: typing.Optional[FileSignature] = cls.get_signature(path)
+        if signature is None:
+            raise FileNotFoundError(path)
+        indexed: typing.Optional[_IndexedFile] = cls._files.get(path)
+        if indexed is None or indexed.signature != signature:
+            if source is None:
+                with SelectParser.open_input(path) as input_file:
+                    source = input_file.read()
+                tokens = None
+            code: str = cls._blank_comments_and_strings(source, tokens)
+            indexed = _IndexedFile(signature, cls._scan_code(code),
+                                   cls._get_includes(source, code, os.path.dirname(path)))
+            cls._files[path] = indexed
+        return indexed
+
+    @classmethod
+    def for_source(cls, source: str, tokens: typing.Optional[typing.List[Token]] = None) -> "ChannelIndex":
+        """Return the index of `source` alone, for a translation done in memory."""
+        return cls(cls.scan(source, tokens))
+
+    @classmethod
+    def for_file(cls,
+                 file_name: str,
+                 source: typing.Optional[str] = None,
+                 tokens: typing.Optional[typing.List[Token]] = None) -> "ChannelIndex":
+        """Return the index of `file_name` and of the project headers it includes, directly or not.
+        Each file is scanned once, until it changes. `source` and `tokens` are the content of `file_name`
+        and its tokens, when the caller already has them.
+        """
+        declarations: typing.List[ChannelDeclaration] = []
+        signatures: typing.Dict[str, FileSignature] = {}
+
+        def _add(path: str, source: typing.Optional[str] = None, tokens: typing.Optional[typing.List[Token]] = None
+                 ) -> None:
+            if path in signatures:
+                return
+            indexed: _IndexedFile = cls._index_file(path, source, tokens)
+            signatures[path] = indexed.signature
+            for include in indexed.includes:
+                _add(include)
+            declarations.extend(indexed.declarations)
+
+        _add(os.path.realpath(file_name), source, tokens)
+        return cls(declarations, signatures.items())
+
+    def get_dependencies(self, file_name: str) -> typing.List[typing.Tuple[str, FileSignature]]:
+        """Return the files scanned besides `file_name`, with their signature when they were."""
+        path: str = os.path.realpath(file_name)
+        return [(dependency, signature) for dependency, signature in self._signatures.items() if dependency != path]
+
+    @classmethod
+    def is_current(cls, dependencies: typing.Iterable[typing.Sequence[typing.Any]]) -> bool:
+        """Return True if none of `dependencies`, from `get_dependencies`, changed since, without reading them."""
+        return all(cls.get_signature(path) == tuple(signature) for path, signature in dependencies)
+
+    def get(self, expression: typing.Optional[str]) -> typing.Optional[ChannelDeclaration]:
+        """Return the declaration of the channel `expression` names, `None` if it isn't a declared channel."""
+        match: typing.Optional[typing.Match] = self._NAME_PATTERN.fullmatch(expression or "")
+        return self._declarations.get(match.group("name")) if match else None
+
+    def is_channel(self, expression: typing.Optional[str]) -> bool:
+        if not expression:
+            return False
+        return self.get(expression) is not None or HeaderGenerator.is_channel(expression)
+
+    def is_read(self, receiver: typing.Optional[str], sender: str) -> bool:
+        """Return True if `receiver <- sender` reads from `sender`, False if it writes to `receiver`."""
+        if self.get(sender) is not None:
+            return True
+        if self.get(receiver) is not None:
+            return False
+        return HeaderGenerator.is_channel(sender)
+
+    def as_key(self) -> typing.List[typing.List[typing.Optional[str]]]:
+        """Return what the translation depends on, for the key of the translation cache."""
+        return sorted([declaration.name, declaration.kind, declaration.element_type, declaration.capacity]
+                      for declaration in self._declarations.values())
 
 
 class CantCreateOutputFileError(Exception):
@@ -210,6 +799,77 @@ class CantCreateOutputFileError(Exception):
         super().__init__("Can't create output file.")
 
 
+@contextlib.contextmanager
+def _open_atomically(file_name: str,
+                     mode: str = "w",
+                     encoding: typing.Optional[str] = None,
+                     newline: typing.Optional[str] = None) -> typing.Iterator[typing.IO]:
+    """Open a temporary file next to `file_name`, which replaces `file_name` only once it is completely written.
+    A reader never sees a half written output, and a failed translation leaves the previous output in place.
+    """
+    try:
+        descriptor, temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_name) or ".", prefix=os.path.basename(file_name) + ".", suffix=".tmp"
+        )
+    except OSError as error:
+        raise CantCreateOutputFileError() from error
+    try:
+        with open(descriptor, mode, encoding=encoding, newline=newline) as output:
+            yield output
+        # `mkstemp` creates the file readable only by its owner, give it the permissions `open` would.
+        umask: int = os.umask(0)
+        os.umask(umask)
+        os.chmod(temporary_path, 0o666 & ~umask)
+        os.replace(temporary_path, file_name)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class GeneratorOptions(typing.NamedTuple):
+    """Choices about the code generated for the `select`s, the defaults keep the historical output."""
+    # How a `select` without `default` waits for one of its cases, one of `HeaderGenerator.WAIT_STRATEGIES`.
+    # A `select[park] {` overrides it for one `select`.
+    wait_strategy: str = "spin"
+    # Polling rounds of a `hybrid` select before it parks.
+    spin_budget: int = 1000
+    # Which case is polled first, one of `HeaderGenerator.CASE_ORDERS`.
+    case_order: str = "source"
+    # What the `ChannelUnbounded`s of the input become, one of `CppGenerator.CHANNEL_IMPLS`.
+    channel_impl: str = "mutex"
+    # Name the `define` of a `select` after a hash of its content instead of its position, so adding a
+    # `select` doesn't rename the ones after it, see `HeaderGenerator.get_select_name`.
+    stable_names: bool = False
+    # Write `#line` directives in the `*_generated.cpp`, so the compiler, and the profilers and debuggers
+    # after it, attribute its lines to the input. The cases of the `select`s are then written in place
+    # instead of in their `define`, where a `#line` can't go.
+    line_directives: bool = False
+    # Count how each `select` behaves, see `common/Instrumentation.h`. The counters are only compiled in
+    # with `-DCSP_INSTRUMENTATION`, the output compiles to the same code as without them otherwise.
+    instrumentation: bool = False
+    # A blocking `select` with at least this many cases waits as a `ready` one whatever `wait_strategy` is,
+    # 0 for none. A `select[park] {` keeps its own strategy.
+    ready_threshold: int = 0
+
+
+class SelectShape(typing.NamedTuple):
+    """All the polling of a `select` depends on. The `select`s of the same shape share one polling function,
+    only the bodies of their cases are written in their own `define`.
+    """
+    # `HeaderGenerator.READ`, `WRITE`, `READ_BOUNDED`, `WRITE_BOUNDED`, `TIMER` or `CALL` for each case
+    # polled, in the order of the cases.
+    operations: typing.Tuple[str, ...]
+    # Without a `default` case, the polling waits until a case is ready.
+    blocking: bool
+    wait_strategy: str
+    spin_budget: int
+    case_order: str
+    # The priority of each case polled, empty when they are all the same.
+    weights: typing.Tuple[int, ...]
+    # The polling function gets the counters of the `select` calling it, see `GeneratorOptions.instrumentation`.
+    instrumented: bool = False
+
+
 class HeaderGenerator:
     OUTPUT_FILE_NAME: str = "AUTOGENERATED.h"
     _FILE_HEADER: str = "#pragma once\n" \
@@ -221,22 +881,71 @@ class HeaderGenerator:
                        "END AUTOGENERATED SOURCE CODE " \
                        "==================================\n\n" \
                        "#endif\n"
-    _FILE_ENCODING: str = SelectParser.FILE_ENCODING
+    OUTPUT_ENCODING: str = "utf-8"
     _INDICES_CASE: IndicesCase = SelectParser.INDICES_CASE
-    _DEFINE_PREFIX: str = "#define select_"
+    _MACRO_PREFIX: str = "select_"
+    _DEFINE_PREFIX: str = "#define "
+    # Hexadecimal digits of a hash in the name of a `select`.
+    _NAME_HASH_LENGTH: int = 12
     _MARK_LINE: str = "\\\n"
 
+    # Poll the channels in a loop.
+    WAIT_SPIN: str = "spin"
+    # Sleep on a `SelectWaiter` registered with every channel between two polls.
+    WAIT_PARK: str = "park"
+    # Spin with a `SelectBackoff` for `spin_budget` rounds, then park.
+    WAIT_HYBRID: str = "hybrid"
+    # Park on a `SelectReadySet`, then poll only the cases whose channels changed.
+    WAIT_READY: str = "ready"
+    WAIT_STRATEGIES: typing.Tuple[str, ...] = (WAIT_SPIN, WAIT_PARK, WAIT_HYBRID, WAIT_READY)
+
+    # Always poll the cases in the order they are written.
+    ORDER_SOURCE: str = "source"
+    # Start each polling round one case further than the previous one.
+    ORDER_ROUND_ROBIN: str = "round-robin"
+    # Start each polling round at a random case, as Go does.
+    ORDER_RANDOM: str = "random"
+    CASE_ORDERS: typing.Tuple[str, ...] = (ORDER_SOURCE, ORDER_ROUND_ROBIN, ORDER_RANDOM)
+
+    # What polling a case does.
+    READ: str = "r"
+    WRITE: str = "w"
+    # The same on a `ChannelBounded`, through its single-slot fast path which doesn't lock an empty,
+    # or a full, channel.
+    READ_BOUNDED: str = "R"
+    WRITE_BOUNDED: str = "W"
+    _READS: typing.FrozenSet[str] = frozenset([READ, READ_BOUNDED])
+    _POLLS: typing.Dict[str, str] = {
+        READ: "{channel}.read({message}, false)",
+        WRITE: "{channel}.write({message}, false)",
+        READ_BOUNDED: "{channel}.pollRead({message})",
+        WRITE_BOUNDED: "{channel}.pollWrite({message})",
+    }
+    # `case <- after(500):` is taken once 500 milliseconds, or a `std::chrono` duration, passed since
+    # the `select` started. `case <- std::this_thread::sleep_for(...):` is read the same way.
+    TIMER: str = "t"
+    _TIMER_PATTERN: typing.Pattern = re.compile(
+        r"(?:after|(?:std\s*::\s*)?(?:this_thread\s*::\s*)?sleep_for)\s*\((?P<timeout>.*)\)", re.DOTALL
+    )
+    # `case <- flush():` runs the call, then its case is taken.
+    CALL: str = "c"
+    # The cases which don't poll a channel.
+    _NOT_CHANNELS: typing.FrozenSet[str] = frozenset([TIMER, CALL])
+    _SHAPE_PREFIX: str = "select_shape_"
+    # Parameters of the `define`s, they can't clash with each other or with the names of the input.
+    _CHANNEL_PARAMETER: str = "selectChannel"
+    _MESSAGE_PARAMETER: str = "selectMessage"
+    _TURN: str = "selectTurn"
+    _COUNTERS: str = "selectCounters"
+    _INDENT: str = "    "
+
     @classmethod
-    def _get_output_file(cls) -> typing.Optional[_io.TextIOWrapper]:
-        output_file: typing.Optional[_io.TextIOWrapper] = open(
-            cls.OUTPUT_FILE_NAME, "w"
-        )
-        if not output_file:
-            raise CantCreateOutputFileError()
-        return output_file
+    def get_output_file_name(cls, input_cpp_file_name: str) -> str:
+        """Return the name of a header belonging only to `input_cpp_file_name`, placed next to it."""
+        return input_cpp_file_name.split(".cpp")[0] + "_" + cls.OUTPUT_FILE_NAME
 
     @staticmethod
-    def _is_channel(entry: str) -> bool:
+    def is_channel(entry: str) -> bool:
         # TODO for this moment we consider it to be a channel if it contains
         # "channel" as its substring. For example purposes.
         return entry.find("channel") != -1
@@ -248,274 +957,1099 @@ class HeaderGenerator:
         return sender == SelectParser.DEFAULT_CASE_NAME and not receiver
 
     @classmethod
-    def _is_read_from_channel(cls, sender: str) -> bool:
-        return cls._is_channel(sender)
+    def _get_define_arguments(cls,
+                              select: SelectParser.SelectContent,
+                              channels: ChannelIndex = ChannelIndex()) -> typing.List[typing.Tuple[str, str]]:
+        """Return the (parameter, argument) pairs of the `define` of `select`: the channel and the message
+        of each case reading or writing one, named after its position among the polled cases.
+        The direction of each case is known here, so a read gets the address of its message, or `nullptr`,
+        and a write gets the message itself. A function call case is written in the `define` as it is.
+        """
+        arguments: typing.List[typing.Tuple[str, str]] = []
+        for position, index in enumerate(cls._get_polled_cases(select)):
+            receiver: typing.Optional[str] = select[index][cls._INDICES_CASE.receiver]
+            sender: str = select[index][cls._INDICES_CASE.sender]
+            operation: str = cls._get_case_operation(select[index], channels)
+            if operation in cls._NOT_CHANNELS:
+                continue
+            if operation in cls._READS:
+                channel, message = sender, f"&{receiver}" if receiver else "nullptr"
+            else:
+                channel, message = receiver, sender
+            arguments.append((f"{cls._CHANNEL_PARAMETER}{position}", channel))
+            arguments.append((f"{cls._MESSAGE_PARAMETER}{position}", message))
+        return arguments
 
     @classmethod
-    def _write_define_header(cls,
-                             output: _io.TextIOWrapper,
-                             index: int,
-                             select: SelectParser.SelectContent) -> None:
-        output.write(cls._DEFINE_PREFIX)
-        output.write(str(index))
+    def get_select_name(cls,
+                        index: int,
+                        select: SelectParser.SelectContent,
+                        options: GeneratorOptions = GeneratorOptions(),
+                        priorities: typing.Optional[typing.List[int]] = None) -> str:
+        """Return the name of the `define` of the `index`th `select`: `select_0`, or with `options.stable_names`
+        `select_` and a hash of everything the `define` is made of, which doesn't depend on the other `select`s.
+        Two `select`s with the same name get the same `define`.
+        """
+        if not options.stable_names:
+            return f"{cls._MACRO_PREFIX}{index}"
+        content: bytes = json.dumps([select, priorities, options], separators=(",", ":")).encode("utf-8")
+        return cls._MACRO_PREFIX + hashlib.sha1(content).hexdigest()[:cls._NAME_HASH_LENGTH]
 
-        parameters: typing.List[str] = []
-        for case in select:
-            receiver: str = case[cls._INDICES_CASE.receiver] if case[cls._INDICES_CASE.receiver] else "nullptr"
-            sender: str = case[cls._INDICES_CASE.sender] if case[cls._INDICES_CASE.sender] else "nullptr"
-            read_from_channel: bool = cls._is_read_from_channel(sender)
+    @classmethod
+    def get_define_call(cls,
+                        index: int,
+                        select: SelectParser.SelectContent,
+                        channels: ChannelIndex = ChannelIndex(),
+                        options: GeneratorOptions = GeneratorOptions(),
+                        priorities: typing.Optional[typing.List[int]] = None) -> str:
+        """Return the call of the `define` written for the `index`th `select`, which replaces it in the source."""
+        arguments: typing.List[str] = [argument for _, argument in cls._get_define_arguments(select, channels)]
+        return f"{cls.get_select_name(index, select, options, priorities)}({', '.join(arguments)});"
 
-            # The default case is not appearing in the `define`'s header.
-            if cls._is_default_case(case):
-                continue
-            parameters.append(sender if read_from_channel else receiver)
-            parameters.append(str(read_from_channel).lower())
-            parameters.append(receiver or "nullptr" if read_from_channel else sender)
-        """ 
-        parameters: 
-        ['channel1',       True,  'message1', 
-         'channel2',       True,  'message2', 
-         'channel3',       False, 'message3', 
-         'channel_GuiSim', True,   None, 
-          None,            False, 'default']
-        """
-        output.write(f"({', '.join(parameters)}) {cls._MARK_LINE}")
-
-    @classmethod
-    def _write_case_content(cls,
-                            output: _io.TextIOWrapper,
-                            case: SelectParser.CaseContent) -> None:
-        def _get_message(receiver: str, sender: str) -> str:
-            message: str = receiver if cls._is_channel(sender) else sender
-            return message if message else "nullptr"
-
-        def _get_processed_content(content: str) -> str:
-            """Add '\' before each '\n'."""
-            processed: str = ""
-            for entry in content:
-                if entry == '\n':
-                    processed += f' \{entry}'
-                else:
-                    processed += entry
-            return processed
+    @classmethod
+    def _emit_define_header(cls,
+                            fragments: typing.List[str],
+                            name: str,
+                            select: SelectParser.SelectContent,
+                            channels: ChannelIndex) -> None:
+        parameters: typing.List[str] = [parameter for parameter, _ in cls._get_define_arguments(select, channels)]
+        fragments.append(f"{cls._DEFINE_PREFIX}{name}({', '.join(parameters)}) {cls._MARK_LINE}")
 
+    @classmethod
+    def _get_case_channel(cls,
+                          case: SelectParser.CaseContent,
+                          channels: ChannelIndex = ChannelIndex()) -> typing.Optional[str]:
+        """Return the channel read or written by `case`, `None` for the `default` case and function calls."""
+        if cls._is_default_case(case):
+            return None
         receiver: str = case[cls._INDICES_CASE.receiver]
         sender: str = case[cls._INDICES_CASE.sender]
-        content: str = case[cls._INDICES_CASE.content]
+        return sender if channels.is_read(receiver, sender) else receiver
 
-        if cls._is_default_case(case):
-            # Last case, the `default` one.
-            #output.write(f"{cls._MARK_LINE}")
-            output.write(_get_processed_content(content))
-            #output.write("} " + cls._MARK_LINE)
+    @classmethod
+    def _get_timeout(cls, case: SelectParser.CaseContent) -> typing.Optional[str]:
+        """Return the timeout of a `case <- after(timeout):`, `None` for the other cases."""
+        if case[cls._INDICES_CASE.receiver]:
             return None
+        match: typing.Optional[typing.Match] = cls._TIMER_PATTERN.fullmatch(case[cls._INDICES_CASE.sender].strip())
+        return match.group("timeout").strip() if match else None
+
+    @classmethod
+    def _get_case_operation(cls, case: SelectParser.CaseContent, channels: ChannelIndex = ChannelIndex()) -> str:
+        if cls._get_timeout(case) is not None:
+            return cls.TIMER
+        channel: typing.Optional[str] = cls._get_case_channel(case, channels)
+        if not channel:
+            return cls.CALL
+        declaration: typing.Optional[ChannelDeclaration] = channels.get(channel)
+        bounded: bool = declaration is not None and declaration.kind == ChannelIndex.BOUNDED
+        if channels.is_read(case[cls._INDICES_CASE.receiver], case[cls._INDICES_CASE.sender]):
+            return cls.READ_BOUNDED if bounded else cls.READ
+        return cls.WRITE_BOUNDED if bounded else cls.WRITE
 
-        # if (readFromChannel1) \
-        output.write(f"if ({str(cls._is_read_from_channel(sender)).lower()}) {cls._MARK_LINE}")
-        output.write("{ " + cls._MARK_LINE)
+    @classmethod
+    def _get_polled_cases(cls, select: SelectParser.SelectContent) -> typing.List[int]:
+        """Return the indices of the cases of `select` which are polled, all of them but `default`."""
+        return [index for index, case in enumerate(select) if not cls._is_default_case(case)]
 
-        # if (channel1.read(outVar1, false))
-        channel: str = sender if cls._is_channel(sender) else receiver
-        message: str = _get_message(receiver, sender)
-        if channel:
-            output.write(
-                f"if ({channel}.read({'&' if message != 'nullptr' else ''}{message}, false)) {cls._MARK_LINE}"
+    @classmethod
+    def get_shape(cls,
+                  select: SelectParser.SelectContent,
+                  options: GeneratorOptions = GeneratorOptions(),
+                  priorities: typing.Optional[typing.List[int]] = None,
+                  channels: ChannelIndex = ChannelIndex()) -> SelectShape:
+        """Return the shape of `select`. With `priorities`, one per case, it is polled in round-robin
+        order unless `options` ask for random.
+        """
+        polled: typing.List[int] = cls._get_polled_cases(select)
+        blocking: bool = len(polled) == len(select)
+        wait_strategy: str = options.wait_strategy if blocking else cls.WAIT_SPIN
+        case_order: str = options.case_order
+        if priorities is not None and case_order == cls.ORDER_SOURCE:
+            case_order = cls.ORDER_ROUND_ROBIN
+        weights: typing.Tuple[int, ...] = tuple(priorities[index] for index in polled) if priorities else ()
+        if len(set(weights)) <= 1:
+            weights = ()
+        if len(polled) <= 1:
+            # There is nothing to reorder.
+            case_order = cls.ORDER_SOURCE
+        operations: typing.Tuple[str, ...] = tuple(cls._get_case_operation(select[index], channels) for index in polled)
+        if blocking and options.ready_threshold and len(polled) >= options.ready_threshold:
+            wait_strategy = cls.WAIT_READY
+        if wait_strategy == cls.WAIT_READY:
+            if all(operation in cls._NOT_CHANNELS for operation in operations):
+                # Without a channel, nothing would tell the `select` which case is ready.
+                wait_strategy = cls.WAIT_PARK
+            else:
+                # The ready cases are taken in turns by `SelectReadySet::pop`.
+                case_order, weights = cls.ORDER_SOURCE, ()
+        return SelectShape(
+            operations=operations,
+            blocking=blocking,
+            wait_strategy=wait_strategy,
+            spin_budget=options.spin_budget if wait_strategy == cls.WAIT_HYBRID else 0,
+            case_order=case_order,
+            weights=weights,
+            instrumented=options.instrumentation
+        )
+
+    @classmethod
+    def get_shape_name(cls, shape: SelectShape) -> str:
+        """`select_shape_rw_park` polls a read, then a write, and parks until one of them is ready."""
+        parts: typing.List[str] = ["".join(shape.operations) or "empty"]
+        if not shape.blocking:
+            parts.append("default")
+        elif shape.wait_strategy != cls.WAIT_SPIN:
+            parts.append(shape.wait_strategy + (str(shape.spin_budget) if shape.wait_strategy == cls.WAIT_HYBRID else ""))
+        if shape.case_order != cls.ORDER_SOURCE:
+            parts.append(shape.case_order.replace("-", "_"))
+        if shape.weights:
+            parts.append("weights_" + "_".join(map(str, shape.weights)))
+        if shape.instrumented:
+            parts.append("instrumented")
+        return cls._SHAPE_PREFIX + "_".join(parts)
+
+    @classmethod
+    def _join_arguments(cls, shape: SelectShape, counters: str, arguments: typing.List[str]) -> str:
+        """Join the parameters or the arguments of the polling function of `shape`. An instrumented one
+        gets the counters first, left out by the preprocessor without `CSP_INSTRUMENTATION`.
+        """
+        joined: str = ", ".join(arguments)
+        if not shape.instrumented:
+            return joined
+        return f"CSP_INSTRUMENT({counters}{', ' if arguments else ''}) {joined}".rstrip()
+
+    @classmethod
+    def _get_counters_line(cls, name: str, select: SelectParser.SelectContent) -> str:
+        """Return the line of an instrumented `select` registering its counters, once per place it is used in."""
+        return f'CSP_INSTRUMENT(static SelectCounters& {cls._COUNTERS} = InstrumentationRegistry::instance()' \
+               f'.addSelect("{name}", __FILE__, __LINE__, {len(cls._get_polled_cases(select))});)'
+
+    @classmethod
+    def _get_switch(cls, shape: SelectShape, arguments: typing.List[str]) -> str:
+        """Return the `switch` on the case taken by the polling function of `shape`."""
+        call: str = f"{cls.get_shape_name(shape)}({cls._join_arguments(shape, cls._COUNTERS, arguments)})"
+        if shape.instrumented:
+            call = f"CSP_INSTRUMENT({cls._COUNTERS}.fired)({call})"
+        return f"switch ({call})"
+
+    @classmethod
+    def _get_shape_parameters(cls, shape: SelectShape) -> typing.Tuple[typing.List[str], typing.List[str]]:
+        """Return the template and the function parameters of the polling function of `shape`."""
+        template_parameters: typing.List[str] = []
+        parameters: typing.List[str] = []
+        for position, operation in enumerate(shape.operations):
+            if operation == cls.CALL:
+                template_parameters.append(f"class Call{position}")
+                parameters.append(f"Call{position} call{position}")
+                continue
+            if operation == cls.TIMER:
+                parameters.append(f"const SelectDeadline::Clock::time_point deadline{position}")
+                continue
+            template_parameters.extend((f"class Channel{position}", f"class Message{position}"))
+            parameters.append(f"Channel{position}& channel{position}")
+            # A read gets a pointer to its message, or `nullptr` to drop it.
+            parameters.append(
+                f"Message{position} message{position}" if operation in cls._READS
+                else f"const Message{position}& message{position}"
             )
-            output.write("{ " + cls._MARK_LINE)
-            output.write(_get_processed_content(content))
-            output.write("break;" + cls._MARK_LINE)
-            output.write("} " + cls._MARK_LINE)
-            output.write("} " + cls._MARK_LINE)
-            output.write(f"else {cls._MARK_LINE}")
-
-            output.write("{ " + cls._MARK_LINE)
-            # if (channel1.write(*outVar1, false))
-            output.write(
-                f"if ({channel}.write({'' if message != 'nullptr' else ''}{message}, false)) {cls._MARK_LINE}"
+        if shape.case_order == cls.ORDER_ROUND_ROBIN:
+            # Owned by the `select`, so each one has its own turns.
+            parameters.append(f"std::atomic<unsigned>& {cls._TURN}")
+        return template_parameters, parameters
+
+    @classmethod
+    def _get_poll_lines(cls, position: int, operation: str) -> typing.List[str]:
+        """Return the lines polling the case at `position`, which return `position` when it is taken."""
+        if operation == cls.CALL:
+            return [f"call{position}();", f"return {position};"]
+        if operation == cls.TIMER:
+            return [f"if (SelectDeadline::hasPassed(deadline{position}))", "{",
+                    f"{cls._INDENT}return {position};", "}"]
+        poll: str = cls._POLLS[operation].format(channel=f"channel{position}", message=f"message{position}")
+        return [f"if ({poll})", "{",
+                f"{cls._INDENT}return {position};", "}"]
+
+    @classmethod
+    def _get_wait_lines(cls, shape: SelectShape) -> typing.List[str]:
+        """Return what a blocking `select` does when none of its cases could proceed."""
+        # Sleep until one of the channels changes, or until the earliest deadline of its timers.
+        deadlines: typing.List[str] = [
+            f"deadline{position}" for position, operation in enumerate(shape.operations) if operation == cls.TIMER
+        ]
+        wait_for, wait_until = ("waitReady", "waitReadyUntil") if shape.wait_strategy == cls.WAIT_READY \
+            else ("waitFor", "waitUntil")
+        if not deadlines:
+            wait: str = f"selectWaiter.{wait_for}();"
+        elif len(deadlines) == 1:
+            wait = f"selectWaiter.{wait_until}({deadlines[0]});"
+        else:
+            wait = f"selectWaiter.{wait_until}(std::min({{{', '.join(deadlines)}}}));"
+        if shape.wait_strategy in (cls.WAIT_PARK, cls.WAIT_READY):
+            return [wait]
+        if shape.wait_strategy == cls.WAIT_HYBRID:
+            return ["if (!selectBackoff.spin())", "{", f"{cls._INDENT}{wait}", "}"]
+        return []
+
+    @classmethod
+    def _get_polling_lines(cls, shape: SelectShape) -> typing.List[str]:
+        """Return the lines polling each case once, in the order given by `shape`. A `ready` select polls
+        its timers and calls, then only the channels its `SelectReadySet` was told about.
+        """
+        if shape.wait_strategy == cls.WAIT_READY:
+            lines: typing.List[str] = []
+            for position, operation in enumerate(shape.operations):
+                if operation in cls._NOT_CHANNELS:
+                    lines.extend(cls._get_poll_lines(position, operation))
+            lines.extend(("int selectCase;",
+                          "while ((selectCase = selectWaiter.pop()) != -1)",
+                          "{",
+                          f"{cls._INDENT}switch (selectCase)",
+                          f"{cls._INDENT}{{"))
+            for position, operation in enumerate(shape.operations):
+                if operation not in cls._NOT_CHANNELS:
+                    lines.append(f"{cls._INDENT}case {position}:")
+                    lines.extend(2 * cls._INDENT + line for line in cls._get_poll_lines(position, operation))
+                    lines.append(f"{2 * cls._INDENT}break;")
+            lines.extend((f"{cls._INDENT}}}", "}"))
+            return lines
+        if shape.case_order == cls.ORDER_SOURCE:
+            lines = []
+            for position, operation in enumerate(shape.operations):
+                lines.extend(cls._get_poll_lines(position, operation))
+            return lines
+
+        cases: int = len(shape.operations)
+        # A round starts at each case as many times as its weight, so a heavier case is polled first more often.
+        turns: int = sum(shape.weights) if shape.weights else cases
+        if shape.case_order == cls.ORDER_RANDOM:
+            turn: str = f"SelectOrder::random({turns})"
+        else:
+            turn = f"SelectOrder::roundRobin({cls._TURN}, {turns})"
+        lines = [f"const unsigned selectStart = {f'selectSchedule[{turn}]' if shape.weights else turn};",
+                 f"for (unsigned selectStep = 0; selectStep < {cases}; ++selectStep)",
+                 "{",
+                 f"{cls._INDENT}switch ((selectStart + selectStep) % {cases})",
+                 f"{cls._INDENT}{{"]
+        for position, operation in enumerate(shape.operations):
+            lines.append(f"{cls._INDENT}case {position}:")
+            lines.extend(2 * cls._INDENT + line for line in cls._get_poll_lines(position, operation))
+            lines.append(f"{2 * cls._INDENT}break;")
+        lines.extend((f"{cls._INDENT}}}", "}"))
+        return lines
+
+    @classmethod
+    def render_shape(cls, shape: SelectShape) -> str:
+        """Return the polling function shared by the `select`s of `shape`. It returns the position of the
+        case taken among the polled ones, or -1 when none was ready and the `select` has a `default` case.
+        """
+        template_parameters, parameters = cls._get_shape_parameters(shape)
+        lines: typing.List[str] = []
+        if template_parameters:
+            lines.append(f"template <{', '.join(template_parameters)}>")
+        lines.extend((
+            f"inline int {cls.get_shape_name(shape)}("
+            f"{cls._join_arguments(shape, f'SelectCounters& {cls._COUNTERS}', parameters)})",
+            "{"
+        ))
+
+        body: typing.List[str] = []
+        if shape.instrumented:
+            body.append(f"CSP_INSTRUMENT(SelectPass selectPass({cls._COUNTERS});)")
+        # Each polling round is counted.
+        rounds: typing.List[str] = ["CSP_INSTRUMENT(selectPass.round();)"] if shape.instrumented else []
+        if shape.wait_strategy != cls.WAIT_SPIN:
+            body.append(f"SelectReadySet selectWaiter({len(shape.operations)});" if shape.wait_strategy == cls.WAIT_READY
+                        else "SelectWaiter selectWaiter;")
+            body.extend(
+                f"SelectWaiterRegistration selectWaiterRegistration{position}(channel{position}, selectWaiter, {position});"
+                for position, operation in enumerate(shape.operations) if operation not in cls._NOT_CHANNELS
             )
-            output.write("{ " + cls._MARK_LINE)
-            output.write(_get_processed_content(content))
-            output.write("break;" + cls._MARK_LINE)
-            output.write("} " + cls._MARK_LINE)
-            output.write("} " + cls._MARK_LINE)
+        if shape.wait_strategy == cls.WAIT_HYBRID:
+            body.append(f"SelectBackoff selectBackoff({shape.spin_budget});")
+        if shape.weights:
+            schedule: typing.List[str] = [
+                str(position) for position, weight in enumerate(shape.weights) for _ in range(weight)
+            ]
+            body.append(f"static const unsigned selectSchedule[] = {{{', '.join(schedule)}}};")
+        if shape.blocking:
+            body.extend(("while (true)", "{"))
+            body.extend(
+                cls._INDENT + line for line in rounds + cls._get_polling_lines(shape) + cls._get_wait_lines(shape)
+            )
+            body.append("}")
         else:
-            # We have a function call on the sender
-            output.write("} " + cls._MARK_LINE)
-            output.write(f"else {cls._MARK_LINE}")
-            output.write("{" + cls._MARK_LINE)
-            output.write(f"{sender};{cls._MARK_LINE}")
-            output.write(_get_processed_content(content))
-            output.write("}" + cls._MARK_LINE)
+            body.extend(rounds + cls._get_polling_lines(shape))
+            body.append("return -1;")
+
+        lines.extend(cls._INDENT + line for line in body)
+        lines.extend(("}", "", ""))
+        return "\n".join(lines)
+
+    @classmethod
+    def _get_shape_arguments(cls, select: SelectParser.SelectContent, shape: SelectShape) -> typing.List[str]:
+        """Return the arguments of the polling function called by the `define` of `select`, see `_get_define_arguments`."""
+        arguments: typing.List[str] = []
+        for position, index in enumerate(cls._get_polled_cases(select)):
+            if shape.operations[position] == cls.CALL:
+                arguments.append(f"[&]() {{ {select[index][cls._INDICES_CASE.sender]}; }}")
+            elif shape.operations[position] == cls.TIMER:
+                # The deadline is taken once, when the `select` starts.
+                arguments.append(f"SelectDeadline::after({cls._get_timeout(select[index])})")
+            else:
+                arguments.extend((f"{cls._CHANNEL_PARAMETER}{position}", f"{cls._MESSAGE_PARAMETER}{position}"))
+        if shape.case_order == cls.ORDER_ROUND_ROBIN:
+            arguments.append(cls._TURN)
+        return arguments
+
+    @classmethod
+    def _emit_case_body(cls, fragments: typing.List[str], label: str, case: SelectParser.CaseContent) -> None:
+        # Each line of the body continues the `define`.
+        content: str = case[cls._INDICES_CASE.content].replace("\n", " " + cls._MARK_LINE)
+        # The braces keep the variables of a body out of the other cases.
+        fragments.extend((f"{label}: {cls._MARK_LINE}", "{ " + cls._MARK_LINE, content,
+                          "} " + cls._MARK_LINE, "break; " + cls._MARK_LINE))
 
     @classmethod
-    def _select_has_default_case(cls, select: SelectParser.SelectContent) -> bool:
+    def render_select(cls,
+                      index: int,
+                      select: SelectParser.SelectContent,
+                      options: GeneratorOptions = GeneratorOptions(),
+                      priorities: typing.Optional[typing.List[int]] = None,
+                      channels: ChannelIndex = ChannelIndex()) -> str:
+        """Return the `define` of the `index`th `select`. It calls the polling function of its shape,
+        see `render_shape`, and runs the body of the case taken, each body is written only once.
+        """
+        shape: SelectShape = cls.get_shape(select, options, priorities, channels)
+        fragments: typing.List[str] = []
+        name: str = cls.get_select_name(index, select, options, priorities)
+        cls._emit_define_header(fragments, name, select, channels)
+        fragments.append("{ " + cls._MARK_LINE)
+        if shape.case_order == cls.ORDER_ROUND_ROBIN:
+            fragments.append(f"static std::atomic<unsigned> {cls._TURN}(0); {cls._MARK_LINE}")
+        if shape.instrumented:
+            fragments.append(f"{cls._get_counters_line(name, select)} {cls._MARK_LINE}")
+        fragments.append(f"{cls._get_switch(shape, cls._get_shape_arguments(select, shape))} {cls._MARK_LINE}")
+        fragments.append("{ " + cls._MARK_LINE)
+        for position, case_index in enumerate(cls._get_polled_cases(select)):
+            cls._emit_case_body(fragments, f"case {position}", select[case_index])
         for case in select:
             if cls._is_default_case(case):
-                return True
-        return False
+                cls._emit_case_body(fragments, "default", case)
+        fragments.append("} " + cls._MARK_LINE)  # /switch
+        fragments.append("}\n")    # /define
+        return "".join(fragments)
 
     @classmethod
-    def _write_select_content(cls,
-                              output: _io.TextIOWrapper,
-                              select: SelectParser.SelectContent) -> None:
-        output.write("{ " + cls._MARK_LINE)
+    def _get_block_options(cls, block: SelectBlock, options: GeneratorOptions) -> GeneratorOptions:
+        if block.priorities and min(block.priorities) < 1:
+            raise ValueError(f"line {block.line}: the priority of a case must be at least 1")
+        if block.annotation is None:
+            return options
+        if block.annotation in cls.WAIT_STRATEGIES:
+            return options._replace(wait_strategy=block.annotation, ready_threshold=0)
+        raise ValueError(f"line {block.line}: unknown select annotation `{block.annotation}`, "
+                         f"expected one of {', '.join(cls.WAIT_STRATEGIES)}")
 
-        # If it doesn't have a `default` case, then it is a blocking `select`, so we have `while` in `define`
-        output.write(
-            f"{'if' if cls._select_has_default_case(select) else 'while'} (true) {cls._MARK_LINE}"
+    @classmethod
+    def render_block(cls,
+                     index: int,
+                     block: SelectBlock,
+                     options: GeneratorOptions = GeneratorOptions(),
+                     channels: ChannelIndex = ChannelIndex()) -> str:
+        """Return the `define` of the `index`th `select`, with `options` overridden by the annotations of `block`."""
+        return cls.render_select(
+            index, block.cases, cls._get_block_options(block, options), block.priorities, channels
         )
-        output.write("{ " + cls._MARK_LINE)
-        for case in select:
-            cls._write_case_content(output, case)
-
-        output.write("} \\\n")  # /while
-        output.write("}\n")    # /define
 
     @classmethod
-    def _write_select(cls,
-                      output: _io.TextIOWrapper,
-                      index: int,
-                      select: SelectParser.SelectContent) -> None:
-        cls._write_define_header(output, index, select)
-        cls._write_select_content(output, select)
+    def get_block_call(cls,
+                       index: int,
+                       block: SelectBlock,
+                       options: GeneratorOptions = GeneratorOptions(),
+                       channels: ChannelIndex = ChannelIndex()) -> str:
+        """Return the call of the `define` `render_block` returns."""
+        return cls.get_define_call(
+            index, block.cases, channels, cls._get_block_options(block, options), block.priorities
+        )
 
     @classmethod
-    def generate(cls, select_data: typing.List[SelectParser.SelectContent]) -> None:
-        """TODO fix this
-        For this moment, I consider to be a channel if the receiver/sender has
-        "channel" as substring.
+    def get_inline_block(cls,
+                         index: int,
+                         block: SelectBlock,
+                         options: GeneratorOptions = GeneratorOptions(),
+                         channels: ChannelIndex = ChannelIndex()
+                         ) -> typing.Tuple[str, typing.List[typing.Tuple[str, SelectParser.CaseContent]], str]:
+        """Return what replaces `block` when its cases are written in place, around their bodies: the code
+        calling the polling function of its shape, each case with its label, in the order of the `define`,
+        and the end.
         """
-        output_file: _io.TextIOWrapper = cls._get_output_file()
-        output_file.write(cls._FILE_HEADER)
+        block_options: GeneratorOptions = cls._get_block_options(block, options)
+        shape: SelectShape = cls.get_shape(block.cases, block_options, block.priorities, channels)
+        # The `define` would be called with these, the polling function is called with them directly.
+        arguments: typing.Dict[str, str] = dict(cls._get_define_arguments(block.cases, channels))
+        opening: str = "{ "
+        if shape.case_order == cls.ORDER_ROUND_ROBIN:
+            opening += f"static std::atomic<unsigned> {cls._TURN}(0); "
+        if shape.instrumented:
+            name: str = cls.get_select_name(index, block.cases, block_options, block.priorities)
+            opening += cls._get_counters_line(name, block.cases) + " "
+        shape_arguments: typing.List[str] = [
+            arguments.get(argument, argument) for argument in cls._get_shape_arguments(block.cases, shape)
+        ]
+        opening += f"{cls._get_switch(shape, shape_arguments)} {{"
+        labels: typing.List[typing.Tuple[str, SelectParser.CaseContent]] = [
+            (f"case {position}:", block.cases[index])
+            for position, index in enumerate(cls._get_polled_cases(block.cases))
+        ]
+        labels.extend(("default:", case) for case in block.cases if cls._is_default_case(case))
+        return opening, labels, "} }"
 
-        for index in range(len(select_data)):
-            select: SelectParser.SelectContent = select_data[index]
-            cls._write_select(output_file, index, select)
+    @classmethod
+    def get_block_shape(cls,
+                        block: SelectBlock,
+                        options: GeneratorOptions = GeneratorOptions(),
+                        channels: ChannelIndex = ChannelIndex()) -> SelectShape:
+        return cls.get_shape(block.cases, cls._get_block_options(block, options), block.priorities, channels)
 
-        output_file.write(cls._FILE_FOOTER)
-        output_file.close()
+    @classmethod
+    def iter_header_parts(cls, selects: typing.Iterable[typing.Tuple[SelectShape, str]]) -> typing.Iterator[str]:
+        """Yield the `define` of each (shape, `define`) of `selects`, preceded by the polling function of
+        its shape the first time the shape is met. A `define` met again, see `get_select_name`, is left out.
+        """
+        shapes: typing.Set[SelectShape] = set()
+        defines: typing.Set[str] = set()
+        for shape, define in selects:
+            if shape not in shapes:
+                shapes.add(shape)
+                yield cls.render_shape(shape)
+            if define not in defines:
+                defines.add(define)
+                yield define
+
+    @classmethod
+    def generate(cls,
+                 select_data: typing.Iterable[SelectParser.SelectContent],
+                 output_file_name: typing.Optional[str] = None,
+                 options: GeneratorOptions = GeneratorOptions(),
+                 channels: ChannelIndex = ChannelIndex()) -> None:
+        """The channels are looked up in `channels`, see `ChannelIndex` for the names it doesn't know.
+
+        `select_data` may also be the generator returned by `SelectParser.iter_selects`,
+        each `select` is written as soon as it is parsed, with a single write.
+        The header replaces `output_file_name` once it is complete.
+        """
+        with _open_atomically(output_file_name or cls.OUTPUT_FILE_NAME, encoding=cls.OUTPUT_ENCODING) as output:
+            cls._write_header(output, select_data, options, channels)
         return None
 
+    @classmethod
+    def render(cls,
+               select_data: typing.Iterable[SelectParser.SelectContent],
+               options: GeneratorOptions = GeneratorOptions(),
+               channels: ChannelIndex = ChannelIndex()) -> str:
+        """Return the content `generate` would write."""
+        output: io.StringIO = io.StringIO()
+        cls._write_header(output, select_data, options, channels)
+        return output.getvalue()
+
+    @classmethod
+    def render_header(cls, parts: typing.Iterable[str]) -> str:
+        """Return the header made of `parts`, as yielded by `iter_header_parts`."""
+        return cls._FILE_HEADER + "".join(parts) + cls._FILE_FOOTER
+
+    @classmethod
+    def _write_header(cls,
+                      output: typing.TextIO,
+                      select_data: typing.Iterable[SelectParser.SelectContent],
+                      options: GeneratorOptions,
+                      channels: ChannelIndex) -> None:
+        output.write(cls._FILE_HEADER)
+        selects: typing.Iterator[typing.Tuple[SelectShape, str]] = (
+            (cls.get_shape(select, options, channels=channels),
+             cls.render_select(index, select, options, channels=channels))
+            for index, select in enumerate(select_data)
+        )
+        for part in cls.iter_header_parts(selects):
+            output.write(part)
+        output.write(cls._FILE_FOOTER)
+
+
+class SelectMapping(typing.NamedTuple):
+    """Where a `select` of the input went."""
+    # Its `define`.
+    name: str
+    # Its polling function, where a profiler shows the time spent polling and waiting.
+    shape: str
+    line: int
+    # The first line of the body of each case, in the order of the cases.
+    cases: typing.List[int]
+
+
+class SourceMap(typing.NamedTuple):
+    """Which line of the input each line of a `*_generated.cpp` comes from."""
+    # (generated line, input line): from the generated line on, the lines come one by one from the input
+    # line on, until the next pair.
+    lines: typing.List[typing.Tuple[int, int]]
+    selects: typing.List[SelectMapping]
+
+    def get_source_line(self, generated_line: int) -> int:
+        index: int = bisect.bisect_right(self.lines, (generated_line, sys.maxsize)) - 1
+        generated_start, source_start = self.lines[max(index, 0)]
+        return source_start + generated_line - generated_start
+
+    def as_dict(self) -> typing.Dict[str, typing.Any]:
+        return {"lines": [list(pair) for pair in self.lines],
+                "selects": [select._asdict() for select in self.selects]}
+
+    @classmethod
+    def from_dict(cls, stored: typing.Dict[str, typing.Any]) -> "SourceMap":
+        return cls([tuple(pair) for pair in stored["lines"]],
+                   [SelectMapping(**select) for select in stored["selects"]])
+
+
+def get_line_directive(line: int, file_name: typing.Optional[str] = None) -> str:
+    """Return the `#line` directive making the next line the `line`th of `file_name`."""
+    if file_name is None:
+        return f"#line {line}\n"
+    escaped: str = file_name.replace("\\", "\\\\").replace('"', '\\"')
+    return f'#line {line} "{escaped}"\n'
+
+
+class _MappedOutput:
+    """The generated source being written, with the line of the input each of its lines comes from."""
+
+    def __init__(self, source: str, source_file_name: typing.Optional[str], line_directives: bool) -> None:
+        self._source: str = source
+        self._source_file_name: typing.Optional[str] = source_file_name
+        self._line_directives: bool = line_directives
+        self._fragments: typing.List[str] = []
+        self._at_line_start: bool = True
+        self.line: int = 1
+        self._lines: typing.Dict[int, int] = {1: 1}
+        # The positions are asked in increasing order, the lines are counted from the previous one.
+        self._counted: int = 0
+        self._counted_lines: int = 1
+
+    def _get_source_line(self, position: int) -> int:
+        if position < self._counted:
+            self._counted, self._counted_lines = 0, 1
+        self._counted_lines += self._source.count("\n", self._counted, position)
+        self._counted = position
+        return self._counted_lines
+
+    def write(self, text: str) -> None:
+        if text:
+            self._fragments.append(text)
+            self.line += text.count("\n")
+            self._at_line_start = text.endswith("\n")
+
+    def map_line(self, position: int) -> int:
+        """Make the next line written come from the line of `position` in the input, return that line."""
+        source_line: int = self._get_source_line(position)
+        if self._line_directives:
+            if not self._at_line_start:
+                self.write("\n")
+            self.write(get_line_directive(source_line, self._source_file_name))
+            self._lines[self.line] = source_line
+        elif self._at_line_start:
+            self._lines[self.line] = source_line
+        else:
+            # Without a directive the current line goes on, the next one follows the input again.
+            self._lines[self.line + 1] = source_line + 1
+        return source_line
+
+    def getvalue(self) -> str:
+        return "".join(self._fragments)
+
+    def get_lines(self) -> typing.List[typing.Tuple[int, int]]:
+        return sorted(self._lines.items())
+
 
 class CppGenerator:
     _SUFFIX_GENERATED: str = "_generated.cpp"
-    _HEADER: str = HeaderGenerator.OUTPUT_FILE_NAME
-    _HEADER_INCLUDE: str = f'#include "{_HEADER}"\n\n\n'
-    _CHANNEL_MARK: str = "<-"
-    _DEFINE_MARK: str = "#define"
-
-    def __init__(self, input_cpp_file_name: str) -> None:
+    _INCLUDE_MARK: str = "#include"
+    OUTPUT_ENCODING: str = "utf-8"
+
+    # Keep the `ChannelUnbounded`s, a `BoundedBuffer` behind a mutex.
+    CHANNEL_MUTEX: str = "mutex"
+    # Rewrite them to the lock-free rings of `common/ChannelRing.h`, with a single writer and reader
+    # or with any number of them.
+    CHANNEL_SPSC: str = "spsc"
+    CHANNEL_MPMC: str = "mpmc"
+    CHANNEL_IMPLS: typing.Tuple[str, ...] = (CHANNEL_MUTEX, CHANNEL_SPSC, CHANNEL_MPMC)
+    _RING_CHANNELS: typing.Dict[str, str] = {CHANNEL_SPSC: "ChannelRingSPSC", CHANNEL_MPMC: "ChannelRingMPMC"}
+    _CHANNEL_TYPE_PATTERN: typing.Pattern = re.compile(r"\bChannelUnbounded(?=\s*<)")
+    # The ring header is included from the directory the input includes `ChannelUnbounded.h` from.
+    _CHANNEL_INCLUDE_PATTERN: typing.Pattern = re.compile(r'#include\s*"((?:[^"\n]*/)?)ChannelUnbounded\.h"')
+    _RING_HEADER: str = "ChannelRing.h"
+    _DEFAULT_INCLUDE_DIRECTORY: str = "common/"
+
+    def __init__(self,
+                 input_cpp_file_name: str,
+                 header_file_name: typing.Optional[str] = None,
+                 options: GeneratorOptions = GeneratorOptions(),
+                 channels: ChannelIndex = ChannelIndex()) -> None:
         self._input_cpp_file_name: str = input_cpp_file_name
-        self._output_cpp_file_name: str = self._get_output_file_name()
-        self._input_cpp_content: typing.List[str] = SelectParser.get_input_content(self._input_cpp_file_name)
-        self._defines: typing.List[str] = self._get_defines()
-
-    def _get_output_file_name(self) -> str:
-        return self._input_cpp_file_name.split(".cpp")[0] + self._SUFFIX_GENERATED
+        self._output_cpp_file_name: str = self.get_output_file_name(self._input_cpp_file_name)
+        self._header_file_name: typing.Optional[str] = header_file_name
+        self._options: GeneratorOptions = options
+        self._channels: ChannelIndex = channels
+        with SelectParser.open_input(self._input_cpp_file_name) as input_file:
+            self._input_cpp_source: str = input_file.read()
 
-    def _get_defines(self) -> typing.List[str]:
-        defines: typing.List[str] = []
+    @classmethod
+    def get_output_file_name(cls, input_cpp_file_name: str) -> str:
+        return input_cpp_file_name.split(".cpp")[0] + cls._SUFFIX_GENERATED
 
-        def _is_select_line(line: str) -> bool:
-            if self._DEFINE_MARK not in line.split():
+    @classmethod
+    def copy_untranslated(cls, input_cpp_file_name: str) -> bool:
+        """Write the input as the generated file, for an input without anything to translate.
+        When the input is already in the output encoding, its bytes are copied without decoding them,
+        unless the generated file already holds them. Return whether the generated file was written.
+        """
+        output_cpp_file_name: str = cls.get_output_file_name(input_cpp_file_name)
+        encoding: str = SelectParser.detect_encoding(input_cpp_file_name)
+        if codecs.lookup(encoding).name == codecs.lookup(cls.OUTPUT_ENCODING).name:
+            if os.path.isfile(output_cpp_file_name) and filecmp.cmp(input_cpp_file_name, output_cpp_file_name,
+                                                                    shallow=False):
                 return False
-            if line.split("#define")[1].find("select_") != -1:
-                return True
+            with open(input_cpp_file_name, "rb") as input_file:
+                with _open_atomically(output_cpp_file_name, "wb") as output:
+                    shutil.copyfileobj(input_file, output)
+            return True
+        with open(input_cpp_file_name, "r", encoding=encoding, errors=SelectParser.DECODE_ERRORS,
+                  newline="") as input_file:
+            return _write_if_changed(output_cpp_file_name, input_file.read(), cls.OUTPUT_ENCODING)
 
-        def _get_select_macro(line: str) -> str:
-            return line.split("#define")[1][1:].split(" \\\n")[0] + ";"
+    @classmethod
+    def get_include_line(cls, header_file_name: str) -> str:
+        """Return what includes the header in the `*_generated.cpp`, after the includes of the input."""
+        return f'#include "{os.path.basename(header_file_name)}"\n\n\n'
 
-        with open(HeaderGenerator.OUTPUT_FILE_NAME, "r") as autogenerated:
-            for line in autogenerated.readlines():
-                if _is_select_line(line):
-                    defines.append(_get_select_macro(line))
-        return defines
+    @classmethod
+    def _get_includes_end(cls, source: str) -> int:
+        """Return where the first lines of `source`, made only of `#include`s and empty lines, end."""
+        position: int = 0
+        while position < len(source):
+            line_end: int = source.find("\n", position) + 1 or len(source)
+            line: str = source[position:line_end]
+            if line.find(cls._INCLUDE_MARK) == -1 and line != "\n":
+                break
+            position = line_end
+        return position
 
-    def _is_valid_index(self, index: int) -> bool:
-        return 0 <= index and index < len(self._input_cpp_content)
+    @staticmethod
+    def _translate_channel_operation(operation: ChannelOperation, channels: ChannelIndex = ChannelIndex()) -> str:
+        if not channels.is_read(operation.receiver, operation.sender):
+            # `channel1 <- message1` case
+            return f"{operation.receiver}.write({operation.sender}, false);\n"
+        receiver: str = operation.receiver
+        return f"{operation.sender}.read({'&' if receiver != 'nullptr' else ''}{receiver}, false);\n"
 
-    def _get_previous_important_line(self, index: int) -> typing.Optional[str]:
-        """Return the previous line which doesn't contain a comment with '//' or a newline."""
-        previous_index: int = index - 1
-        if not self._is_valid_index(previous_index):
-            return None
-        while previous_index >= 0:
-            if not SelectParser.is_comment_line(self._input_cpp_content[previous_index]):
-                if self._input_cpp_content[previous_index] != "\n":
-                    return self._input_cpp_content[previous_index]
-            previous_index = previous_index - 1
-        return None
+    @classmethod
+    def _translate_writes(cls, writes: typing.List[ChannelOperation]) -> typing.Tuple[int, int, str]:
+        """Return the edit replacing `writes`, consecutive lines writing to the same channel,
+        with a single `writeMany`, which takes the lock of the channel once.
+        """
+        if len(writes) == 1:
+            # A write whatever the index says, so the heuristic can't be asked again.
+            return writes[0].start, writes[0].end, f"{writes[0].receiver}.write({writes[0].sender}, false);\n"
+        values: str = ", ".join(write.sender for write in writes)
+        return writes[0].start, writes[-1].end, f"{writes[0].receiver}.writeMany({{{values}}}, false);\n"
 
-    def _is_closing_select(self, index) -> bool:
-        if not self._is_valid_index(index - 1):
-            return False
-        if not self._is_valid_index(index):
-            return False
-        previous_line: str = self._get_previous_important_line(index)
-        current_line: str = self._input_cpp_content[index]
-        if previous_line.split() == [] or current_line.split() == []:
-            return False
-        if previous_line.split()[0] == '}':
-            if current_line.split()[0] == '}':
-                return True
-        return False
+    @classmethod
+    def _continues_writes(cls, source: str, writes: typing.List[ChannelOperation], write: ChannelOperation) -> bool:
+        """Return True if `write` can be merged with `writes`: it is on the line right after them, to
+        the same channel, and they are all statements of the same block.
+        """
+        last: ChannelOperation = writes[-1]
+        return (last.end == write.start and
+                last.receiver == write.receiver and
+                not any(brace in source[last.start:write.end] for brace in "{}") and
+                cls._starts_statement(source, writes[0].start))
+
+    @staticmethod
+    def _starts_statement(source: str, position: int) -> bool:
+        """Return True if the line at `position` follows the end of a statement or of a block,
+        so it can't be the body of an `if`, `for`, `while` or `else` written without braces.
+        Blank lines and comments before it are skipped.
+        """
+        end: int = position
+        while end > 0:
+            start: int = source.rfind("\n", 0, end - 1) + 1
+            line: str = source[start:end].split("//")[0].strip()
+            if line and not SelectParser.is_comment_line(line):
+                return line[-1] in ";{}"
+            end = start
+        return True
+
+    @staticmethod
+    def _translate_range_loop(loop: RangeLoop) -> str:
+        # A bare name gets its type from the channel.
+        declaration: str = f"auto {loop.declaration}" if loop.declaration.isidentifier() else loop.declaration
+        return f"for ({declaration} : channelRange({loop.channel}))"
+
+    @classmethod
+    def _get_channel_type_edits(cls,
+                                source: str,
+                                blocks: typing.List[ParsedBlock],
+                                channel_impl: str) -> typing.List[typing.Tuple[int, int, str]]:
+        """Return the edits replacing each `ChannelUnbounded` type of `source` with the ring of `channel_impl`.
+        The ones in comments, in string literals and in the bodies of the `select`s are left alone.
+        """
+        skipped: typing.List[typing.Tuple[int, int]] = sorted(
+            [(token.start, token.end) for token in SelectLexer(source).tokens()
+             if token.kind in (SelectLexer.COMMENT, SelectLexer.STRING)]
+            + [(block.start, block.end) for block in blocks]
+        )
+        edits: typing.List[typing.Tuple[int, int, str]] = []
+        index: int = 0
+        for match in cls._CHANNEL_TYPE_PATTERN.finditer(source):
+            while index < len(skipped) and skipped[index][1] <= match.start():
+                index += 1
+            if index < len(skipped) and skipped[index][0] <= match.start():
+                continue
+            edits.append((match.start(), match.end(), cls._RING_CHANNELS[channel_impl]))
+        return edits
+
+    @classmethod
+    def render(cls,
+               source: str,
+               blocks: typing.List[ParsedBlock],
+               header_file_name: typing.Optional[str] = None,
+               options: GeneratorOptions = GeneratorOptions(),
+               channels: ChannelIndex = ChannelIndex(),
+               source_file_name: typing.Optional[str] = None) -> str:
+        """Return `source` with the header included and the `select`s and `<-`s from `blocks` replaced.
+        The spans recorded by the parser are used as they are, the source is not parsed again.
+        `source_file_name` is the name the `#line` directives give, see `GeneratorOptions.line_directives`.
+        """
+        cpp, _ = cls.render_mapped(source, blocks, header_file_name, options, channels, source_file_name)
+        return cpp
 
     @classmethod
-    def _get_receiver(cls, line: str) -> str:
-        assert SelectParser.has_channel_mark(line)
-        components: typing.List[str] = line.split(cls._CHANNEL_MARK)[0].split()
-        return components[0] if components else "nullptr"
+    def _write_inline_select(cls,
+                             output: _MappedOutput,
+                             source: str,
+                             index: int,
+                             block: SelectBlock,
+                             options: GeneratorOptions,
+                             channels: ChannelIndex) -> None:
+        opening, labels, closing = HeaderGenerator.get_inline_block(index, block, options, channels)
+        positions: typing.Dict[int, int] = dict(zip(map(id, block.cases), cls._get_case_positions(source, block)))
+        output.write(opening + "\n")
+        for label, case in labels:
+            content: str = case[SelectParser.INDICES_CASE.content]
+            output.write(label + " {\n")
+            output.map_line(positions[id(case)])
+            output.write(content if content.endswith("\n") else content + "\n")
+            output.write("} break;\n")
+        output.write(closing)
 
     @classmethod
-    def _get_sender(cls, line: str) -> str:
-        assert SelectParser.has_channel_mark(line)
-        component: str = line.split(cls._CHANNEL_MARK)[1].split()[0]
-        last_character = component[len(component) - 1]
-        return component if last_character != ";" else component[:len(component) - 1]
+    def _get_case_positions(cls, source: str, block: SelectBlock) -> typing.List[int]:
+        """Return where the body of each case of `block` starts in `source`."""
+        positions: typing.List[int] = []
+        position: int = block.start
+        for case in block.cases:
+            content: str = case[SelectParser.INDICES_CASE.content]
+            position = max(source.find(content, position), position)
+            positions.append(position)
+            position += len(content)
+        return positions
+
+    @classmethod
+    def render_mapped(cls,
+                      source: str,
+                      blocks: typing.List[ParsedBlock],
+                      header_file_name: typing.Optional[str] = None,
+                      options: GeneratorOptions = GeneratorOptions(),
+                      channels: ChannelIndex = ChannelIndex(),
+                      source_file_name: typing.Optional[str] = None) -> typing.Tuple[str, SourceMap]:
+        """Same as `render`, also return where each line of the result comes from."""
+        header_file_name = header_file_name or HeaderGenerator.OUTPUT_FILE_NAME
+        position: int = cls._get_includes_end(source)
+        output = _MappedOutput(source, source_file_name, options.line_directives)
+        output.write(source[:position])
+
+        edits: typing.List[typing.Tuple[int, int, str]] = []
+        # The index of each `select` written in place, and its block, by its start.
+        inline_selects: typing.Dict[int, typing.Tuple[int, SelectBlock]] = {}
+        selects: typing.List[SelectMapping] = []
+        writes: typing.List[ChannelOperation] = []
+        index_select: int = 0
+        for block in blocks:
+            if isinstance(block, ChannelOperation) and not channels.is_read(block.receiver, block.sender):
+                if writes and not cls._continues_writes(source, writes, block):
+                    edits.append(cls._translate_writes(writes))
+                    writes = []
+                writes.append(block)
+                continue
+            if writes:
+                edits.append(cls._translate_writes(writes))
+                writes = []
+            if isinstance(block, SelectBlock):
+                call: str = HeaderGenerator.get_block_call(index_select, block, options, channels)
+                edits.append((block.start, block.end, call))
+                if options.line_directives:
+                    inline_selects[block.start] = (index_select, block)
+                selects.append(SelectMapping(
+                    name=call[:call.index("(")],
+                    shape=HeaderGenerator.get_shape_name(HeaderGenerator.get_block_shape(block, options, channels)),
+                    line=block.line,
+                    cases=[block.line + source.count("\n", block.start, position)
+                           for position in cls._get_case_positions(source, block)]
+                ))
+                index_select += 1
+            elif isinstance(block, RangeLoop):
+                edits.append((block.start, block.end, cls._translate_range_loop(block)))
+            else:
+                edits.append((block.start, block.end, cls._translate_channel_operation(block, channels)))
+        if writes:
+            edits.append(cls._translate_writes(writes))
+        if options.channel_impl != cls.CHANNEL_MUTEX:
+            channel_types: typing.List[typing.Tuple[int, int, str]] = cls._get_channel_type_edits(
+                source, blocks, options.channel_impl
+            )
+            if channel_types:
+                include: typing.Optional[typing.Match] = cls._CHANNEL_INCLUDE_PATTERN.search(source)
+                directory: str = include.group(1) if include else cls._DEFAULT_INCLUDE_DIRECTORY
+                output.write(f'#include "{directory}{cls._RING_HEADER}"\n')
+                edits = sorted(edits + channel_types)
+        output.write(cls.get_include_line(header_file_name))
+        output.map_line(position)
+
+        for start, end, text in edits:
+            output.write(source[position:start])
+            # An edit which keeps the number of lines keeps the lines after it where they were.
+            if start not in inline_selects and text.count("\n") == source.count("\n", start, end):
+                output.write(text)
+            else:
+                output.map_line(start)
+                if start in inline_selects:
+                    cls._write_inline_select(output, source, *inline_selects[start], options, channels)
+                else:
+                    output.write(text)
+                output.map_line(end)
+            position = end
+        output.write(source[position:])
+        return output.getvalue(), SourceMap(output.get_lines(), selects)
 
     def generate(self) -> None:
-        with open(self._output_cpp_file_name, "w") as output:
-            index: int = 0
-            index_select: int = 0
-
-            while True:
-                if not self._is_valid_index(index):
-                    break
-                line: str = self._input_cpp_content[index]
-                if line.find("#include") == -1 and line != '\n':
-                    break
-                output.write(line)
-                index += 1
+        blocks = SelectParser.parse_blocks(self._input_cpp_source)
+        with _open_atomically(self._output_cpp_file_name, encoding=self.OUTPUT_ENCODING) as output:
+            output.write(
+                self.render(self._input_cpp_source, blocks, self._header_file_name, self._options, self._channels)
+            )
+
+
+class PhaseTime(typing.NamedTuple):
+    wall: float
+    cpu: float
+
+
+class TranslationStats:
+    """Wall and CPU time of each phase of a translation, with the sizes it went through."""
+    PHASES: typing.Tuple[str, ...] = ("cache", "read", "parse", "header", "cpp", "write")
+
+    def __init__(self) -> None:
+        self.phases: typing.Dict[str, PhaseTime] = {}
+        self.bytes_read: int = 0
+        self.bytes_written: int = 0
+        # `None` when the input was not read, for example when the outputs come from the cache.
+        self.lines: typing.Optional[int] = None
+        self.selects: int = 0
+        self.cases: int = 0
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        wall: float = time.perf_counter()
+        cpu: float = time.process_time()
+        try:
+            yield
+        finally:
+            previous: PhaseTime = self.phases.get(name, PhaseTime(0.0, 0.0))
+            self.phases[name] = PhaseTime(
+                previous.wall + time.perf_counter() - wall, previous.cpu + time.process_time() - cpu
+            )
+
+    def count_source(self, source: str) -> None:
+        # The last line may not end with a new line.
+        self.lines = source.count("\n") + (1 if source and not source.endswith("\n") else 0)
+
+    def count_selects(self, select_data: typing.List[SelectParser.SelectContent]) -> None:
+        self.selects = len(select_data)
+        self.cases = sum(len(select) for select in select_data)
+
+    @staticmethod
+    def get_peak_rss() -> typing.Optional[int]:
+        """Return the peak resident set size of the process, in bytes."""
+        if resource is None:
+            return None
+        peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes.
+        return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+    def as_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "phases": {name: phase._asdict() for name, phase in self.phases.items()},
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "lines": self.lines,
+            "selects": self.selects,
+            "cases": self.cases,
+            "peak_rss": self.get_peak_rss(),
+        }
+
+    def format(self) -> str:
+        lines: typing.List[str] = [f"{'phase':<8}{'wall (s)':>12}{'cpu (s)':>12}"]
+        lines.extend(
+            f"{name:<8}{self.phases[name].wall:>12.6f}{self.phases[name].cpu:>12.6f}"
+            for name in self.PHASES if name in self.phases
+        )
+        stats: typing.Dict[str, typing.Any] = self.as_dict()
+        lines.extend(
+            f"{name.replace('_', ' ')}: {'-' if stats[name] is None else stats[name]}"
+            for name in ("bytes_read", "bytes_written", "lines", "selects", "cases", "peak_rss")
+        )
+        return "\n".join(lines)
+
+
+def _translate(source: str,
+               header_file_name: typing.Optional[str],
+               options: GeneratorOptions = GeneratorOptions(),
+               stats: typing.Optional[TranslationStats] = None,
+               channels: typing.Optional[ChannelIndex] = None,
+               source_file_name: typing.Optional[str] = None,
+               tokens: typing.Optional[typing.List[Token]] = None
+               ) -> typing.Tuple[typing.List[SelectParser.SelectContent], str, str, SourceMap]:
+    stats = stats or TranslationStats()
+    with stats.phase("parse"):
+        # The source is tokenized once, for its channels and for its blocks.
+        tokens = list(SelectLexer(source).tokens()) if tokens is None else tokens
+        channels = channels or ChannelIndex.for_source(source, tokens)
+        blocks: typing.List[ParsedBlock] = SelectParser.parse_blocks(source, tokens)
+        selects: typing.List[SelectBlock] = [block for block in blocks if isinstance(block, SelectBlock)]
+        select_data: typing.List[SelectParser.SelectContent] = [block.cases for block in selects]
+    with stats.phase("header"):
+        header: str = HeaderGenerator.render_header(HeaderGenerator.iter_header_parts(
+            (HeaderGenerator.get_block_shape(block, options, channels),
+             HeaderGenerator.render_block(index, block, options, channels))
+            for index, block in enumerate(selects)
+        ))
+    with stats.phase("cpp"):
+        cpp, source_map = CppGenerator.render_mapped(
+            source, blocks, header_file_name, options, channels, source_file_name
+        )
+    stats.count_selects(select_data)
+    return select_data, header, cpp, source_map
+
+
+def translate(source: str,
+              header_file_name: typing.Optional[str] = None,
+              options: GeneratorOptions = GeneratorOptions(),
+              channels: typing.Optional[ChannelIndex] = None,
+              source_file_name: typing.Optional[str] = None) -> typing.Tuple[str, str]:
+    """Return the header and the `*_generated.cpp` content translated from `source`.
+    Nothing is read from or written to the disk, `source` is parsed only once. Without
+    `channels`, only the channels declared in `source` itself are known, see `ChannelIndex`.
+    `source_file_name` is the name given by the `#line` directives, see `GeneratorOptions.line_directives`.
+    """
+    _, header, cpp, _ = _translate(source, header_file_name, options, channels=channels,
+                                   source_file_name=source_file_name)
+    return header, cpp
+
+
+class CacheEntry(typing.NamedTuple):
+    selects: typing.List[SelectParser.SelectContent]
+    header: str
+    cpp: str
+    # `SourceMap.as_dict`, missing from the entries written before it.
+    source_map: typing.Optional[typing.Dict[str, typing.Any]] = None
+    # `ChannelIndex.get_dependencies`, the headers whose channels the translation depends on.
+    dependencies: typing.Optional[typing.List[typing.Tuple[str, FileSignature]]] = None
+
+
+class TranslationCache:
+    """On-disk cache of the translations, so that an unchanged input is not parsed again.
+
+    An entry is keyed by the hash of the input's bytes, the translator's source and the
+    options of the translation. It holds the parsed `select`s and both generated files.
+    The entries are evicted in least recently used order, once the cache grows over `max_size` bytes.
+    """
+    DEFAULT_MAX_SIZE: int = 64 * 1024 * 1024
+    _ENTRY_SUFFIX: str = ".json"
+    _READ_SIZE: int = 1 << 20
+    # Any change of the translator may change its outputs, so its whole source is part of the key.
+    _translator_digest: typing.Optional[bytes] = None
+
+    def __init__(self, directory: str, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        self._directory: str = directory
+        self._max_size: int = max_size
+        os.makedirs(self._directory, exist_ok=True)
+
+    @classmethod
+    def _get_translator_digest(cls) -> bytes:
+        if cls._translator_digest is None:
+            with open(__file__, "rb") as translator_file:
+                cls._translator_digest = hashlib.sha256(translator_file.read()).digest()
+        return cls._translator_digest
+
+    @classmethod
+    def key(cls, input_file_name: str, options: typing.Optional[typing.Dict[str, str]] = None) -> str:
+        digest = hashlib.sha256()
+        digest.update(__version__.encode())
+        digest.update(cls._get_translator_digest())
+        digest.update(json.dumps(options or {}, sort_keys=True).encode())
+        with open(input_file_name, "rb") as input_file:
+            for block in iter(lambda: input_file.read(cls._READ_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _get_entry_path(self, key: str) -> str:
+        return os.path.join(self._directory, key + self._ENTRY_SUFFIX)
+
+    def get(self, key: str) -> typing.Optional[CacheEntry]:
+        entry_path: str = self._get_entry_path(key)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as entry_file:
+                stored: typing.Dict[str, typing.Any] = json.load(entry_file)
+            # The modification time tells which entries were used least recently.
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(
+            selects=[[tuple(case) for case in select] for select in stored["selects"]],
+            header=stored["header"],
+            cpp=stored["cpp"],
+            source_map=stored.get("source_map"),
+            dependencies=stored.get("dependencies")
+        )
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        descriptor, temporary_path = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        try:
+            with open(descriptor, "w", encoding="utf-8") as entry_file:
+                # The optional fields are left out when missing, as in the entries written before them.
+                json.dump({name: value for name, value in entry._asdict().items() if value is not None}, entry_file)
+            os.replace(temporary_path, self._get_entry_path(key))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        entries: typing.List[os.DirEntry] = [
+            entry for entry in os.scandir(self._directory) if entry.name.endswith(self._ENTRY_SUFFIX)
+        ]
+        total_size: int = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total_size <= self._max_size:
+                break
+            total_size -= entry.stat().st_size
+            os.remove(entry.path)
 
-            output.write(self._HEADER_INCLUDE)
-
-            while True:
-                if not self._is_valid_index(index):
-                    break
-                line: str = self._input_cpp_content[index]
-                if SelectParser.has_channel_mark(line):
-                    # `message1 <- channel1` or `channel1` <- `message1`
-                    receiver: str = self._get_receiver(line)
-                    sender: str = self._get_sender(line)
-                    if receiver.find("channel") != -1:
-                        # `channel1 <- message1` case
-                        output.write(f"{receiver}.write({sender}, false);\n")
-                    else:
-                        output.write(
-                            f"{sender}.read({'&' if receiver != 'nullptr' else ''}{receiver}, false);\n"
-                        )
-                    index += 1
-                    continue
-                if SelectParser.contains_select_keyword(line):
-                    # `select`
-                    output.write(self._defines[index_select])
-                    index_select += 1
-                    while not self._is_closing_select(index):
-                        index += 1
-                    index += 1
-                    continue
-                output.write(self._input_cpp_content[index])
-                index += 1
 
 """
 def main():
@@ -529,16 +2063,736 @@ def main():
 """
 
 
+def _write_text(file_name: str, content: str, encoding: str, stats: typing.Optional[TranslationStats] = None) -> None:
+    # An output left as it is isn't rebuilt by the C++ build.
+    if _write_if_changed(file_name, content, encoding) and stats:
+        stats.bytes_written += os.path.getsize(file_name)
+
+
+def _escape_dependency(file_name: str) -> str:
+    return file_name.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def get_depfile_name(cpp_file_name: str) -> str:
+    """`foo.cpp` gets `foo_generated.d`, next to `foo_generated.cpp`."""
+    return os.path.splitext(CppGenerator.get_output_file_name(cpp_file_name))[0] + ".d"
+
+
+def _write_depfile(cpp_file_name: str, outputs: typing.List[str], dependencies: typing.Iterable[str]) -> None:
+    """Write the Make rule of `outputs`, which Ninja reads as well: they are rebuilt once `cpp_file_name`
+    or one of the headers the translation looked into changes.
+    """
+    inputs: typing.List[str] = [cpp_file_name] + [
+        file_name for file_name in dependencies if file_name != os.path.realpath(cpp_file_name)
+    ]
+    _write_if_changed(
+        get_depfile_name(cpp_file_name),
+        f"{' '.join(map(_escape_dependency, outputs))}: {' '.join(map(_escape_dependency, inputs))}\n",
+        CppGenerator.OUTPUT_ENCODING
+    )
+
+
+def get_source_map_name(cpp_file_name: str) -> str:
+    """`foo.cpp` gets `foo_generated.cpp.map`, next to `foo_generated.cpp`."""
+    return CppGenerator.get_output_file_name(cpp_file_name) + ".map"
+
+
+def _write_source_map(cpp_file_name: str, header_file_name: str, source_map: SourceMap) -> None:
+    """Write which line of `cpp_file_name` each line of its `*_generated.cpp` comes from, and where
+    each of its `select`s went, for the tools which can't read the `#line` directives.
+    """
+    _write_if_changed(
+        get_source_map_name(cpp_file_name),
+        json.dumps(dict(version=1,
+                        file=os.path.basename(CppGenerator.get_output_file_name(cpp_file_name)),
+                        source=os.path.basename(cpp_file_name),
+                        header=os.path.basename(header_file_name),
+                        **source_map.as_dict()), indent=4) + "\n",
+        CppGenerator.OUTPUT_ENCODING
+    )
+
+
+def _write_if_changed(file_name: str, content: str, encoding: str) -> bool:
+    """Write `content` unless `file_name` already holds it, so its modification time is kept.
+    Return whether the file was written.
+    """
+    encoded: bytes = content.encode(encoding)
+    try:
+        with open(file_name, "rb") as existing:
+            if existing.read(len(encoded) + 1) == encoded:
+                return False
+    except OSError:
+        pass
+    with _open_atomically(file_name, "wb") as output:
+        output.write(encoded)
+    return True
+
+
+class TranslationResult(typing.NamedTuple):
+    input_file_name: str
+    # One of the `TRANSLATED`, `CACHED`, `COPIED` or `UNCHANGED` below.
+    status: str
+    selects: int
+
+
+TRANSLATED: str = "translated"
+CACHED: str = "cached"
+COPIED: str = "copied"
+# Translated again, to the same outputs.
+UNCHANGED: str = "unchanged"
+
+
+def translate_file(cpp_file_name: str,
+                   header_file_name: typing.Optional[str] = None,
+                   cache: typing.Optional[TranslationCache] = None,
+                   stats: typing.Optional[TranslationStats] = None,
+                   options: GeneratorOptions = GeneratorOptions(),
+                   depfile: bool = False,
+                   source_map: bool = False) -> TranslationResult:
+    """Write the header and the `*_generated.cpp` for `cpp_file_name`, the ones whose content changed.
+    The time spent in each phase is added to `stats`. With `depfile`, also write their dependencies,
+    see `get_depfile_name`, and with `source_map`, where their lines come from, see `get_source_map_name`.
+
+    Unlike `SelectParser.iter_selects`, the input is read whole, so its memory use grows with its size:
+    the channels declared anywhere in it and the end of its `#include`s are needed before the first
+    line of the output is written, and a hit of the cache reads nothing but its bytes.
+    """
+    stats = stats or TranslationStats()
+    header_file_name = header_file_name or HeaderGenerator.OUTPUT_FILE_NAME
+    output_cpp_file_name: str = CppGenerator.get_output_file_name(cpp_file_name)
+    with stats.phase("read"):
+        has_markers: bool = SelectParser.contains_markers(cpp_file_name)
+    if not has_markers:
+        with stats.phase("write"):
+            written: bool = CppGenerator.copy_untranslated(cpp_file_name)
+            if depfile:
+                _write_depfile(cpp_file_name, [output_cpp_file_name], [])
+        stats.bytes_read += os.path.getsize(cpp_file_name)
+        # As for the translated files, an output left as it is isn't counted.
+        if written:
+            stats.bytes_written += os.path.getsize(output_cpp_file_name)
+        return TranslationResult(cpp_file_name, COPIED, 0)
+
+    entry: typing.Optional[CacheEntry] = None
+    if cache:
+        with stats.phase("cache"):
+            # The generated `*.cpp` includes the header by its name, so the name is part of the key,
+            # and the headers the input includes are found next to it, so its path is as well.
+            key_options: typing.Dict[str, typing.Any] = dict(
+                options._asdict(), header=os.path.basename(header_file_name), path=os.path.realpath(cpp_file_name)
+            )
+            if options.line_directives:
+                # The `#line` directives name the input.
+                key_options.update(source=cpp_file_name)
+            key: str = TranslationCache.key(cpp_file_name, key_options)
+            entry = cache.get(key)
+            # The channels declared in the headers it includes may change without it,
+            # which is told from their signatures, without reading them.
+            if entry is not None and not ChannelIndex.is_current(entry.dependencies or []):
+                entry = None
+    if entry is not None and (entry.source_map is not None or not source_map):
+        stats.bytes_read += os.path.getsize(cpp_file_name)
+        stats.count_selects(entry.selects)
+        with stats.phase("write"):
+            _write_text(header_file_name, entry.header, HeaderGenerator.OUTPUT_ENCODING, stats)
+            _write_text(output_cpp_file_name, entry.cpp, CppGenerator.OUTPUT_ENCODING, stats)
+            if depfile:
+                _write_depfile(cpp_file_name, [output_cpp_file_name, header_file_name],
+                               [path for path, _ in entry.dependencies or []])
+            if source_map:
+                _write_source_map(cpp_file_name, header_file_name, SourceMap.from_dict(entry.source_map))
+        return TranslationResult(cpp_file_name, CACHED, len(entry.selects))
+
+    with stats.phase("read"):
+        with SelectParser.open_input(cpp_file_name) as input_file:
+            source: str = input_file.read()
+    stats.bytes_read += os.path.getsize(cpp_file_name)
+    stats.count_source(source)
+    with stats.phase("parse"):
+        tokens: typing.List[Token] = list(SelectLexer(source).tokens())
+        channels: ChannelIndex = ChannelIndex.for_file(cpp_file_name, source, tokens)
+    select_data, header, cpp, mapping = _translate(source, header_file_name, options, stats, channels, cpp_file_name,
+                                                   tokens)
+    with stats.phase("write"):
+        _write_text(header_file_name, header, HeaderGenerator.OUTPUT_ENCODING, stats)
+        _write_text(output_cpp_file_name, cpp, CppGenerator.OUTPUT_ENCODING, stats)
+        if depfile:
+            _write_depfile(cpp_file_name, [output_cpp_file_name, header_file_name], channels.files)
+        if source_map:
+            _write_source_map(cpp_file_name, header_file_name, mapping)
+
+    if cache:
+        with stats.phase("cache"):
+            cache.put(key, CacheEntry(selects=select_data, header=header, cpp=cpp, source_map=mapping.as_dict(),
+                                      dependencies=channels.get_dependencies(cpp_file_name)))
+    return TranslationResult(cpp_file_name, TRANSLATED, len(select_data))
+
+
+def _make_cache(cache_dir: typing.Optional[str], cache_size: int) -> typing.Optional[TranslationCache]:
+    return TranslationCache(cache_dir, cache_size) if cache_dir else None
+
+
+_cache_options: typing.List[typing.Callable] = [
+    click.option("--cache-dir", default=None, envvar="PARSER_SELECT_CACHE_DIR",
+                 help="Directory of the translation cache, an unchanged input is not translated again."),
+    click.option("--cache-size", default=TranslationCache.DEFAULT_MAX_SIZE, show_default=True,
+                 help="Maximum size of the translation cache, in bytes."),
+]
+
+
+_generator_options: typing.List[typing.Callable] = [
+    click.option("--wait-strategy", type=click.Choice(HeaderGenerator.WAIT_STRATEGIES),
+                 default=GeneratorOptions().wait_strategy, show_default=True,
+                 help="How a select without default waits: `spin` polls its channels in a loop, "
+                      "`park` sleeps until one of them changes, `hybrid` spins with a backoff, then parks, "
+                      "`ready` parks, then polls only the channels which changed. "
+                      "`select[park] {` overrides it for one select."),
+    click.option("--spin-budget", type=click.IntRange(min=0), default=GeneratorOptions().spin_budget,
+                 show_default=True, help="Polling rounds of a hybrid select before it parks."),
+    click.option("--ready-threshold", type=click.IntRange(min=0), default=GeneratorOptions().ready_threshold,
+                 show_default=True,
+                 help="Blocking selects with at least this many cases wait as `ready` ones: their channels tell "
+                      "them which cases changed, so a wake-up doesn't poll all the cases. 0 for none."),
+    click.option("--case-order", type=click.Choice(HeaderGenerator.CASE_ORDERS),
+                 default=GeneratorOptions().case_order, show_default=True,
+                 help="Which case each polling round of a select starts with, so a busy first case can't "
+                      "starve the others. A select with `case[N]` priorities is always polled in round-robin "
+                      "order at least."),
+    click.option("--channel-impl", type=click.Choice(CppGenerator.CHANNEL_IMPLS),
+                 default=GeneratorOptions().channel_impl, show_default=True,
+                 help="What the `ChannelUnbounded` declarations become: `mutex` keeps them, `spsc` and `mpmc` "
+                      "rewrite them to the lock-free rings of `common/ChannelRing.h`. `spsc` is only correct "
+                      "when each channel has a single writing and a single reading thread."),
+    click.option("--stable-names", is_flag=True,
+                 help="Name each select after a hash of its content instead of its position, so adding a "
+                      "select doesn't change the others and their translation units aren't rebuilt."),
+    click.option("--instrument", "instrumentation", is_flag=True,
+                 help="Count how many times each case of each select is taken, its polling rounds and the time "
+                      "it is blocked. The counters are compiled in with `-DCSP_INSTRUMENTATION` only, and "
+                      "written at exit to `$CSP_INSTRUMENTATION_FILE` or `csp_instrumentation.json`."),
+]
+
+
+# Not an option of `cc`, whose translation always has them.
+_line_directives_option: typing.Callable = click.option(
+    "--line-directives", is_flag=True,
+    help="Write `#line` directives in `*_generated.cpp`, so the compiler errors, the debuggers and "
+         "the profilers point at the lines of the input. The case bodies are then written in "
+         "`*_generated.cpp` instead of the header."
+)
+
+
+_depfile_option: typing.Callable = click.option(
+    "--depfile", is_flag=True,
+    help="Also write `foo_generated.d` for each `foo.cpp`, the Make and Ninja rule of its outputs, "
+         "which depend on it and on the project headers it includes."
+)
+
+
+_source_map_option: typing.Callable = click.option(
+    "--source-map", is_flag=True,
+    help="Also write `foo_generated.cpp.map` for each `foo.cpp`, the JSON map from the lines of "
+         "`foo_generated.cpp` to the lines of `foo.cpp`, and where each select went."
+)
+
+
+def _add_options(options: typing.List[typing.Callable]) -> typing.Callable:
+    def _decorator(function: typing.Callable) -> typing.Callable:
+        for option in reversed(options):
+            function = option(function)
+        return function
+    return _decorator
+
+
+def _report_stats(stats: TranslationStats, show: bool, json_file_name: typing.Optional[str]) -> None:
+    if show:
+        click.echo(stats.format(), err=True)
+    if json_file_name:
+        with click.open_file(json_file_name, "w") as output:
+            json.dump(stats.as_dict(), output, indent=4)
+            output.write("\n")
+
+
 @click.command("Run parser")
 @click.argument("cpp_file_name")
-def command_line(cpp_file_name: str) -> None:
-    select_data: typing.List[SelectParser.SelectContent] = SelectParser(cpp_file_name).parse()
-    HeaderGenerator.generate(select_data)
-    CppGenerator(cpp_file_name).generate()
+@_add_options(_cache_options)
+@_add_options(_generator_options)
+@_line_directives_option
+@_depfile_option
+@_source_map_option
+@click.option("--stats", "show_stats", is_flag=True,
+              help="Print the time of each phase and the sizes of the translation on stderr.")
+@click.option("--stats-json", default=None, metavar="PATH",
+              help="Write the same numbers as `--stats` as JSON to PATH, `-` for stdout.")
+@click.option("--profile", "profile_file_name", default=None, metavar="PATH",
+              help="Run the translation under cProfile and dump the profile to PATH, readable with `pstats`.")
+def command_line(cpp_file_name: str,
+                 cache_dir: typing.Optional[str],
+                 cache_size: int,
+                 wait_strategy: str,
+                 spin_budget: int,
+                 ready_threshold: int,
+                 case_order: str,
+                 channel_impl: str,
+                 stable_names: bool,
+                 line_directives: bool,
+                 instrumentation: bool,
+                 depfile: bool,
+                 source_map: bool,
+                 show_stats: bool,
+                 stats_json: typing.Optional[str],
+                 profile_file_name: typing.Optional[str]) -> None:
+    """Translate CPP_FILE_NAME into `*_generated.cpp` and `AUTOGENERATED.h`."""
+    stats = TranslationStats()
+    cache: typing.Optional[TranslationCache] = _make_cache(cache_dir, cache_size)
+    options = GeneratorOptions(wait_strategy=wait_strategy, spin_budget=spin_budget, case_order=case_order,
+                               ready_threshold=ready_threshold, channel_impl=channel_impl, stable_names=stable_names,
+                               line_directives=line_directives, instrumentation=instrumentation)
+    if profile_file_name:
+        # Imported here, the profiler is only needed on demand.
+        import cProfile
+        profile = cProfile.Profile()
+        profile.runcall(translate_file, cpp_file_name, cache=cache, stats=stats, options=options, depfile=depfile,
+                        source_map=source_map)
+        profile.dump_stats(profile_file_name)
+    else:
+        translate_file(cpp_file_name, cache=cache, stats=stats, options=options, depfile=depfile,
+                       source_map=source_map)
+    _report_stats(stats, show_stats, stats_json)
+
+
+def _find_input_files(paths: typing.Iterable[str]) -> typing.List[str]:
+    """Return the `*.cpp` files given directly, matched by a glob or found in a directory tree.
+    The files generated by a previous translation are left out.
+    """
+    def _is_input(file_name: str) -> bool:
+        return file_name.endswith(".cpp") and not file_name.endswith(CppGenerator.get_output_file_name(""))
+
+    found: typing.Dict[str, None] = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    if _is_input(file_name):
+                        found[os.path.join(directory, file_name)] = None
+        elif any(character in path for character in "*?["):
+            for file_name in sorted(glob.glob(path, recursive=True)):
+                if _is_input(file_name):
+                    found[file_name] = None
+        else:
+            found[path] = None
+    return list(found)
+
+
+def _translate_in_worker(cpp_file_name: str,
+                         cache_dir: typing.Optional[str],
+                         cache_size: int,
+                         options: GeneratorOptions,
+                         depfile: bool,
+                         source_map: bool) -> TranslationResult:
+    return translate_file(cpp_file_name,
+                          HeaderGenerator.get_output_file_name(cpp_file_name),
+                          _make_cache(cache_dir, cache_size),
+                          options=options,
+                          depfile=depfile,
+                          source_map=source_map)
+
+
+@click.command("translate")
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--jobs", "-j", default=os.cpu_count() or 1, show_default=True,
+              help="Number of files translated in parallel.")
+@_add_options(_cache_options)
+@_add_options(_generator_options)
+@_line_directives_option
+@_depfile_option
+@_source_map_option
+def translate_command(paths: typing.Tuple[str, ...],
+                      jobs: int,
+                      cache_dir: typing.Optional[str],
+                      cache_size: int,
+                      wait_strategy: str,
+                      spin_budget: int,
+                      ready_threshold: int,
+                      case_order: str,
+                      channel_impl: str,
+                      stable_names: bool,
+                      line_directives: bool,
+                      instrumentation: bool,
+                      depfile: bool,
+                      source_map: bool) -> None:
+    """Translate every `*.cpp` file from PATHS (files, directories or globs) in parallel.
+    Each `foo.cpp` gets its own `foo_AUTOGENERATED.h`, included by `foo_generated.cpp`.
+    """
+    input_file_names: typing.List[str] = _find_input_files(paths)
+    options = GeneratorOptions(wait_strategy=wait_strategy, spin_budget=spin_budget, case_order=case_order,
+                               ready_threshold=ready_threshold, channel_impl=channel_impl, stable_names=stable_names,
+                               line_directives=line_directives, instrumentation=instrumentation)
+    results: typing.List[TranslationResult] = []
+    failures: typing.List[typing.Tuple[str, str]] = []
+    start: float = time.perf_counter()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures: typing.Dict[concurrent.futures.Future, str] = {
+            executor.submit(
+                _translate_in_worker, file_name, cache_dir, cache_size, options, depfile, source_map
+            ): file_name
+            for file_name in input_file_names
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                failures.append((futures[future], str(error)))
+
+    for file_name, error in sorted(failures):
+        click.echo(f"{file_name}: {error}", err=True)
+    counts: typing.Dict[str, int] = {
+        status: sum(1 for result in results if result.status == status) for status in (TRANSLATED, CACHED, COPIED)
+    }
+    click.echo(
+        f"{len(input_file_names)} files: {counts[TRANSLATED]} translated, {counts[CACHED]} from cache, "
+        f"{counts[COPIED]} without selects, {len(failures)} failed; "
+        f"{sum(result.selects for result in results)} selects in {time.perf_counter() - start:.2f}s"
+    )
+    if failures:
+        raise click.exceptions.Exit(1)
+
+
+class _WatchedFile(typing.NamedTuple):
+    # Modification time and size of the input when it was translated.
+    signature: typing.Tuple[int, int]
+    # The shape and the `define` rendered for each `select`, by its index and its text in the input.
+    defines: typing.Dict[typing.Tuple[int, str], typing.Tuple[SelectShape, str]]
+    # The channels the `define`s were rendered with, see `ChannelIndex.as_key`.
+    channels: typing.List[typing.List[typing.Optional[str]]] = []
+    # The headers they were declared in, see `ChannelIndex.get_dependencies`.
+    dependencies: typing.List[typing.Tuple[str, FileSignature]] = []
+
+
+class WatchFailure(typing.NamedTuple):
+    input_file_name: str
+    error: str
+
+
+class Watcher:
+    """Keep the translation of the `*.cpp` files from `paths` up to date.
+
+    Only the inputs whose modification time or size changed are translated again, the
+    `define`s of the `select`s whose text did not change are reused, and an output is
+    written only when its content changed, so the C++ build does not rebuild it needlessly.
+    """
+
+    def __init__(self,
+                 paths: typing.Iterable[str],
+                 options: GeneratorOptions = GeneratorOptions(),
+                 depfile: bool = False) -> None:
+        self._paths: typing.Tuple[str, ...] = tuple(paths)
+        self._options: GeneratorOptions = options
+        self._depfile: bool = depfile
+        self._files: typing.Dict[str, _WatchedFile] = {}
+
+    @staticmethod
+    def _get_signature(file_name: str) -> typing.Tuple[int, int]:
+        status: os.stat_result = os.stat(file_name)
+        return status.st_mtime_ns, status.st_size
+
+    def _translate(self,
+                   cpp_file_name: str,
+                   signature: typing.Tuple[int, int],
+                   previous: typing.Optional[_WatchedFile]) -> TranslationResult:
+        header_file_name: str = HeaderGenerator.get_output_file_name(cpp_file_name)
+        # A failed translation is not tried again until the input changes.
+        self._files[cpp_file_name] = _WatchedFile(signature, {})
+        with SelectParser.open_input(cpp_file_name) as input_file:
+            source: str = input_file.read()
+        tokens: typing.List[Token] = list(SelectLexer(source).tokens())
+        blocks: typing.List[ParsedBlock] = SelectParser.parse_blocks(source, tokens)
+        selects: typing.List[SelectBlock] = [block for block in blocks if isinstance(block, SelectBlock)]
+        channels: ChannelIndex = ChannelIndex.for_file(cpp_file_name, source, tokens)
+
+        previous_defines: typing.Dict[typing.Tuple[int, str], typing.Tuple[SelectShape, str]] = \
+            previous.defines if previous and previous.channels == channels.as_key() else {}
+        defines: typing.Dict[typing.Tuple[int, str], typing.Tuple[SelectShape, str]] = {}
+        for index, block in enumerate(selects):
+            key: typing.Tuple[int, str] = (index, source[block.start:block.end])
+            defines[key] = previous_defines.get(key) or (
+                HeaderGenerator.get_block_shape(block, self._options, channels),
+                HeaderGenerator.render_block(index, block, self._options, channels)
+            )
+
+        written: bool = _write_if_changed(
+            header_file_name,
+            HeaderGenerator.render_header(HeaderGenerator.iter_header_parts(defines.values())),
+            HeaderGenerator.OUTPUT_ENCODING
+        )
+        written |= _write_if_changed(CppGenerator.get_output_file_name(cpp_file_name),
+                                     CppGenerator.render(source, blocks, header_file_name, self._options, channels,
+                                                         cpp_file_name),
+                                     CppGenerator.OUTPUT_ENCODING)
+        if self._depfile:
+            _write_depfile(cpp_file_name, [CppGenerator.get_output_file_name(cpp_file_name), header_file_name],
+                           channels.files)
+        self._files[cpp_file_name] = _WatchedFile(signature, defines, channels.as_key(),
+                                                  channels.get_dependencies(cpp_file_name))
+        return TranslationResult(cpp_file_name, TRANSLATED if written else UNCHANGED, len(selects))
+
+    def poll_once(self) -> typing.List[typing.Union[TranslationResult, WatchFailure]]:
+        """Translate the inputs which changed since the previous call, return their results."""
+        results: typing.List[typing.Union[TranslationResult, WatchFailure]] = []
+        input_file_names: typing.List[str] = _find_input_files(self._paths)
+        for file_name in set(self._files) - set(input_file_names):
+            del self._files[file_name]
+        for file_name in input_file_names:
+            try:
+                signature: typing.Tuple[int, int] = self._get_signature(file_name)
+                previous: typing.Optional[_WatchedFile] = self._files.get(file_name)
+                # The channels declared in the headers it includes may change without it.
+                if (previous is None or previous.signature != signature or
+                        not ChannelIndex.is_current(previous.dependencies)):
+                    results.append(self._translate(file_name, signature, previous))
+            except (OSError, ValueError) as error:
+                results.append(WatchFailure(file_name, str(error)))
+        return results
+
+    def watch(self, interval: float) -> typing.Iterator[typing.Union[TranslationResult, WatchFailure]]:
+        """Poll every `interval` seconds and yield the results, forever."""
+        while True:
+            yield from self.poll_once()
+            time.sleep(interval)
+
+
+@click.command("watch")
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--interval", default=0.5, show_default=True, help="Seconds between two polls of PATHS.")
+@_add_options(_generator_options)
+@_line_directives_option
+@_depfile_option
+def watch_command(paths: typing.Tuple[str, ...],
+                  interval: float,
+                  wait_strategy: str,
+                  spin_budget: int,
+                  ready_threshold: int,
+                  case_order: str,
+                  channel_impl: str,
+                  stable_names: bool,
+                  line_directives: bool,
+                  instrumentation: bool,
+                  depfile: bool) -> None:
+    """Keep translating the `*.cpp` files from PATHS (files, directories or globs) as they change,
+    until interrupted. Each `foo.cpp` gets its own `foo_AUTOGENERATED.h`, as with `translate`.
+    """
+    try:
+        options = GeneratorOptions(wait_strategy=wait_strategy, spin_budget=spin_budget, case_order=case_order,
+                                   ready_threshold=ready_threshold, channel_impl=channel_impl,
+                                   stable_names=stable_names, line_directives=line_directives,
+                                   instrumentation=instrumentation)
+        for result in Watcher(paths, options, depfile).watch(interval):
+            if isinstance(result, WatchFailure):
+                click.echo(f"{result.input_file_name}: {result.error}", err=True)
+            else:
+                click.echo(f"{result.input_file_name}: {result.status}, {result.selects} selects")
+    except KeyboardInterrupt:
+        pass
+
+
+class CompilerWrapper:
+    """Runs a compiler command on the translation of its source instead of the source itself. The
+    translation is piped to the compiler, with the header inline, so nothing is written to the disk,
+    and the `#line` directives keep the errors and the debug information pointing at the source.
+    """
+    _SOURCE_SUFFIXES: typing.Tuple[str, ...] = (".cpp", ".cc", ".cxx", ".c++", ".C")
+    # The options of GCC and Clang whose value is the next argument, which is not a source then.
+    _OPTIONS_WITH_VALUE: typing.FrozenSet[str] = frozenset([
+        "-o", "-x", "-I", "-D", "-U", "-L", "-l", "-include", "-imacros", "-iquote", "-isystem", "-idirafter",
+        "-isysroot", "--sysroot", "-MF", "-MT", "-MQ", "-Xlinker", "-Xpreprocessor", "-Xassembler",
+        "-target", "-arch",
+    ])
+    # Read the source from stdin, the arguments after it are typed by their suffix again.
+    _STDIN_ARGUMENTS: typing.Tuple[str, ...] = ("-x", "c++", "-", "-x", "none")
+    _PRAGMA_ONCE: str = "#pragma once\n"
+    _DEPFILE_OPTIONS: typing.Tuple[str, ...] = ("-MD", "-MMD")
+    # The end of the target of a Make rule, `foo.o: bar.h`, not the colon of `C:\path`.
+    _RULE_SEPARATOR_PATTERN: typing.Pattern = re.compile(r":(?=\s|$)")
+    # What the compilers may list for the source read from stdin.
+    _STDIN_DEPENDENCY_PATTERN: typing.Pattern = re.compile(r"[ \t]+(?:-|<stdin>)(?=\s|$)")
+
+    @classmethod
+    def find_sources(cls, arguments: typing.List[str]) -> typing.List[int]:
+        """Return the positions of the C++ sources among the `arguments` of the compiler."""
+        positions: typing.List[int] = []
+        for position, argument in enumerate(arguments):
+            if position == 0 or arguments[position - 1] in cls._OPTIONS_WITH_VALUE or argument.startswith("-"):
+                continue
+            if argument.endswith(cls._SOURCE_SUFFIXES):
+                positions.append(position)
+        return positions
+
+    @classmethod
+    def _has_option(cls, arguments: typing.List[str], option: str) -> bool:
+        """Return True if `option` is given, as `-o foo.o` or with its value attached, as `-ofoo.o`
+        or `--sysroot=/path`. The value of another option doesn't count.
+        """
+        attached: str = option + "=" if option.startswith("--") else option
+        return any(
+            (argument == option or argument.startswith(attached) and len(argument) > len(attached)) and
+            arguments[position - 1] not in cls._OPTIONS_WITH_VALUE
+            for position, argument in enumerate(arguments) if position > 0
+        )
+
+    @classmethod
+    def _get_option_value(cls, arguments: typing.List[str], option: str) -> typing.Optional[str]:
+        """Return the value of the last `option` of `arguments`, given as `-MF foo.d` or `-MFfoo.d`."""
+        value: typing.Optional[str] = None
+        for position, argument in enumerate(arguments):
+            if position == 0 or arguments[position - 1] in cls._OPTIONS_WITH_VALUE:
+                continue
+            if argument == option and position + 1 < len(arguments):
+                value = arguments[position + 1]
+            elif argument.startswith(option) and len(argument) > len(option):
+                value = argument[len(option):]
+        return value
+
+    @classmethod
+    def get_command(cls, arguments: typing.List[str], position: int) -> typing.List[str]:
+        """Return `arguments` reading the source at `position` from stdin. Its directory is searched by
+        its quoted includes first, as it would be, and the outputs the compiler would name after it
+        are named explicitly, unless there are several sources: the compiler rejects `-o` then,
+        and names the outputs itself. The target of the dependency file is the object file, not stdin.
+        """
+        source_file_name: str = arguments[position]
+        command: typing.List[str] = arguments[:position] + [
+            "-iquote", os.path.dirname(os.path.abspath(source_file_name))
+        ] + list(cls._STDIN_ARGUMENTS) + arguments[position + 1:]
+        if len(cls.find_sources(arguments)) != 1:
+            return command
+        stem: str = os.path.splitext(os.path.basename(source_file_name))[0]
+        if "-c" in arguments and not cls._has_option(arguments, "-o"):
+            command.extend(("-o", stem + ".o"))
+        if any(option in arguments for option in cls._DEPFILE_OPTIONS):
+            if not cls._has_option(arguments, "-MF"):
+                command.extend(("-MF", stem + ".d"))
+            if not cls._has_option(arguments, "-MT") and not cls._has_option(arguments, "-MQ"):
+                command.extend(("-MT", cls._get_option_value(command, "-o") or stem + ".o"))
+        return command
+
+    @classmethod
+    def get_depfile_name(cls, command: typing.List[str]) -> typing.Optional[str]:
+        """Return the dependency file `command`, from `get_command`, writes, `None` if it is not named."""
+        if not any(option in command for option in cls._DEPFILE_OPTIONS):
+            return None
+        return cls._get_option_value(command, "-MF")
+
+    @classmethod
+    def rewrite_depfile(cls, depfile_name: str, source_file_name: str) -> None:
+        """Make the dependency file list `source_file_name` instead of stdin, which the compiler read it
+        from, so the build compiles it again once it changes.
+        """
+        with open(depfile_name, "r", encoding=CppGenerator.OUTPUT_ENCODING) as depfile:
+            rule: str = depfile.read()
+        separator: typing.Optional[typing.Match] = cls._RULE_SEPARATOR_PATTERN.search(rule)
+        if separator is None:
+            return
+        prerequisites: str = cls._STDIN_DEPENDENCY_PATTERN.sub("", rule[separator.end():])
+        _write_if_changed(
+            depfile_name,
+            f"{rule[:separator.end()]} {_escape_dependency(source_file_name)}{prerequisites}",
+            CppGenerator.OUTPUT_ENCODING
+        )
+
+    @classmethod
+    def render_input(cls, source_file_name: str, options: GeneratorOptions = GeneratorOptions()) -> str:
+        """Return the translation of `source_file_name` as the compiler reads it from stdin: the header
+        takes the place of its `#include`, and every line is attributed to the file it comes from.
+        """
+        with SelectParser.open_input(source_file_name) as input_file:
+            source: str = input_file.read()
+        header_file_name: str = HeaderGenerator.get_output_file_name(source_file_name)
+        header, cpp = translate(source, header_file_name, options._replace(line_directives=True),
+                                ChannelIndex.for_file(source_file_name), source_file_name)
+        include: str = CppGenerator.get_include_line(header_file_name)
+        position: int = cpp.index(include)
+        # The header is part of the main file now, where `#pragma once` only gets a warning.
+        first_line: int = 1
+        if header.startswith(cls._PRAGMA_ONCE):
+            header, first_line = header[len(cls._PRAGMA_ONCE):], 2
+        # The translation continues with a `#line` back to the source after the include.
+        return get_line_directive(1, source_file_name) + cpp[:position] + \
+            get_line_directive(first_line, os.path.basename(header_file_name)) + header + \
+            cpp[position + len(include):]
+
+    @classmethod
+    def run(cls, arguments: typing.List[str], options: GeneratorOptions = GeneratorOptions()) -> int:
+        """Run the compiler command `arguments` and return its exit status. A command without a source
+        to translate is run as it is.
+        """
+        positions: typing.List[int] = [
+            position for position in cls.find_sources(arguments) if SelectParser.contains_markers(arguments[position])
+        ]
+        if not positions:
+            return subprocess.call(arguments)
+        if len(positions) > 1:
+            raise click.UsageError("only one source with selects can be piped to the compiler, "
+                                   f"got {', '.join(arguments[position] for position in positions)}")
+        compiler_input: bytes = cls.render_input(arguments[positions[0]], options).encode(CppGenerator.OUTPUT_ENCODING)
+        command: typing.List[str] = cls.get_command(arguments, positions[0])
+        status: int = subprocess.run(command, input=compiler_input).returncode
+        depfile_name: typing.Optional[str] = cls.get_depfile_name(command)
+        if status == 0 and depfile_name is not None and os.path.isfile(depfile_name):
+            cls.rewrite_depfile(depfile_name, arguments[positions[0]])
+        return status
+
+
+@click.command("cc", context_settings=dict(ignore_unknown_options=True))
+@_add_options(_generator_options)
+@click.argument("compiler_command", nargs=-1, required=True, type=click.UNPROCESSED)
+def cc_command(wait_strategy: str,
+               spin_budget: int,
+               ready_threshold: int,
+               case_order: str,
+               channel_impl: str,
+               stable_names: bool,
+               instrumentation: bool,
+               compiler_command: typing.Tuple[str, ...]) -> None:
+    """Run COMPILER_COMMAND on the translation of its `*.cpp` source, given after `--` as in
+    `cc -- g++ -c foo.cpp`. The translation is piped to the compiler, no `*_generated.cpp` nor header
+    is written, and the errors point at the lines of the source.
+    """
+    # The lines are always mapped back to the source.
+    options = GeneratorOptions(wait_strategy=wait_strategy, spin_budget=spin_budget, case_order=case_order,
+                               ready_threshold=ready_threshold, channel_impl=channel_impl, stable_names=stable_names,
+                               line_directives=True, instrumentation=instrumentation)
+    sys.exit(CompilerWrapper.run(list(compiler_command), options))
+
+
+class _DefaultCommandGroup(click.Group):
+    """Runs `default_command` when the first argument is not the name of a command,
+    so `parser_select.py file.cpp` keeps working next to `parser_select.py translate ...`.
+    """
+
+    def __init__(self, *args: typing.Any, default_command: str, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._default_command: str = default_command
+
+    def parse_args(self, ctx: click.Context, args: typing.List[str]) -> typing.List[str]:
+        if args and args[0] not in self.commands and args[0] not in ctx.help_option_names:
+            args.insert(0, self._default_command)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=_DefaultCommandGroup, default_command="run")
+def cli() -> None:
+    """Translate the Go-like `select` and `<-` of C++ sources."""
+
+
+cli.add_command(command_line, "run")
+cli.add_command(translate_command, "translate")
+cli.add_command(watch_command, "watch")
+cli.add_command(cc_command, "cc")
 
 
 def main():
-    command_line()
+    cli()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,421 @@
+"""Benchmarks of the channels and of the generated `select`s, compiled and run.
+
+    python runtime_benchmark.py --save
+    python runtime_benchmark.py --channel-type mpmc --wait-strategy park --producers 1 --producers 8
+
+Each scenario is a C++ source where `--producers` threads write timestamps to their own channel
+and `--consumers` threads take them with a `select` over all the channels. It is translated,
+compiled with `$CXX` (`g++` by default) and run. The messages per second, the latency from the
+write to the read, and the CPU time a `select` burns while it is blocked on empty channels are
+reported. `--save` stores them as the baseline, which a later run fails against when a scenario
+got slower than it allows. Until a baseline is saved, the results are only reported.
+"""
+import json
+import os
+import string
+import subprocess
+import sys
+import tempfile
+import typing
+
+import click
+
+try:
+    from .parser_select import CppGenerator, GeneratorOptions, HeaderGenerator, translate
+except ImportError:
+    from parser_select import CppGenerator, GeneratorOptions, HeaderGenerator, translate
+
+
+_SOURCE_DIRECTORY: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# A `ChannelBounded`, the other channel types are the ones of `CppGenerator.CHANNEL_IMPLS`.
+CHANNEL_BOUNDED: str = "bounded"
+CHANNEL_TYPES: typing.Tuple[str, ...] = (CHANNEL_BOUNDED,) + CppGenerator.CHANNEL_IMPLS
+
+
+class Scenario(typing.NamedTuple):
+    # One of `CHANNEL_TYPES`, a `ChannelUnbounded` is translated to the others.
+    channel_type: str = CppGenerator.CHANNEL_MUTEX
+    wait_strategy: str = HeaderGenerator.WAIT_SPIN
+    # Threads writing, each to its own channel, so also the number of cases of the `select`.
+    producers: int = 1
+    # Threads reading with a `select` over all the channels.
+    consumers: int = 1
+    # Written by each producer.
+    messages: int = 100000
+    capacity: int = 1024
+    # How long the `select` measuring the CPU time of a blocked `select` waits.
+    idle_milliseconds: int = 200
+
+    @property
+    def name(self) -> str:
+        return f"{self.channel_type}/{self.wait_strategy}/p{self.producers}/c{self.consumers}"
+
+    @property
+    def is_valid(self) -> bool:
+        # A single producer and a single consumer per channel.
+        return self.channel_type != CppGenerator.CHANNEL_SPSC or self.consumers == 1
+
+    @property
+    def options(self) -> GeneratorOptions:
+        channel_impl: str = CppGenerator.CHANNEL_MUTEX if self.channel_type == CHANNEL_BOUNDED else self.channel_type
+        return GeneratorOptions(wait_strategy=self.wait_strategy, channel_impl=channel_impl)
+
+
+class ScenarioGenerator:
+    """Produce the C++ source of a `Scenario`, with `select`s and `<-`s for the translator."""
+    _SOURCE: string.Template = string.Template(
+        '#include <algorithm>\n'
+        '#include <atomic>\n'
+        '#include <chrono>\n'
+        '#include <cstdio>\n'
+        '#include <ctime>\n'
+        '#include <functional>\n'
+        '#include <thread>\n'
+        '#include <vector>\n'
+        '\n'
+        '#include "common/ChannelBounded.h"\n'
+        '#include "common/ChannelUnbounded.h"\n'
+        '#include "common/Utils.h"\n'
+        '\n'
+        'static long long benchmarkNow()\n'
+        '{\n'
+        '    return std::chrono::duration_cast<std::chrono::nanoseconds>(\n'
+        '        std::chrono::steady_clock::now().time_since_epoch()).count();\n'
+        '}\n'
+        '\n'
+        'static double benchmarkCpuSeconds(const clockid_t clock)\n'
+        '{\n'
+        '    timespec time;\n'
+        '    clock_gettime(clock, &time);\n'
+        '    return time.tv_sec + time.tv_nsec / 1e9;\n'
+        '}\n'
+        '\n'
+        '$channels'
+        '\n'
+        'std::atomic<int> received(0);\n'
+        '\n'
+        'template <class Channel>\n'
+        'void produce(Channel& channel, const int messages)\n'
+        '{\n'
+        '    for (int message = 0; message < messages; ++message)\n'
+        '    {\n'
+        '        channel.write(benchmarkNow(), true);\n'
+        '    }\n'
+        '}\n'
+        '\n'
+        'void consume(std::vector<long long>& latencies, const int total)\n'
+        '{\n'
+        '    long long stamp = 0;\n'
+        '    while (received.load() < total)\n'
+        '    {\n'
+        '        // The timer lets a consumer see that the others took the last messages.\n'
+        '        select {\n'
+        '$consume_cases'
+        '            case <- after(10):\n'
+        '            {\n'
+        '            }\n'
+        '        }\n'
+        '    }\n'
+        '}\n'
+        '\n'
+        'double idle(const int milliseconds)\n'
+        '{\n'
+        '    long long stamp = 0;\n'
+        '    const double start = benchmarkCpuSeconds(CLOCK_THREAD_CPUTIME_ID);\n'
+        '    select {\n'
+        '$idle_cases'
+        '        case <- after(milliseconds):\n'
+        '        {\n'
+        '        }\n'
+        '    }\n'
+        '    return benchmarkCpuSeconds(CLOCK_THREAD_CPUTIME_ID) - start;\n'
+        '}\n'
+        '\n'
+        'static long long percentile(const std::vector<long long>& sorted, const double fraction)\n'
+        '{\n'
+        '    if (sorted.empty())\n'
+        '    {\n'
+        '        return 0;\n'
+        '    }\n'
+        '    const std::size_t rank = static_cast<std::size_t>(fraction * (sorted.size() - 1));\n'
+        '    return sorted[rank];\n'
+        '}\n'
+        '\n'
+        'int main()\n'
+        '{\n'
+        '    const int messages = $messages;\n'
+        '    const int total = messages * $producers;\n'
+        '    const double idleCpuSeconds = idle($idle_milliseconds);\n'
+        '\n'
+        '    std::vector<std::vector<long long>> latencies($consumers);\n'
+        '    std::vector<std::thread> threads;\n'
+        '    const double cpuStart = benchmarkCpuSeconds(CLOCK_PROCESS_CPUTIME_ID);\n'
+        '    const long long start = benchmarkNow();\n'
+        '    for (int consumer = 0; consumer < $consumers; ++consumer)\n'
+        '    {\n'
+        '        latencies[consumer].reserve(total);\n'
+        '        threads.emplace_back(consume, std::ref(latencies[consumer]), total);\n'
+        '    }\n'
+        '$start_producers'
+        '    for (std::thread& thread : threads)\n'
+        '    {\n'
+        '        thread.join();\n'
+        '    }\n'
+        '    const long long elapsed = benchmarkNow() - start;\n'
+        '    const double cpuSeconds = benchmarkCpuSeconds(CLOCK_PROCESS_CPUTIME_ID) - cpuStart;\n'
+        '\n'
+        '    std::vector<long long> sorted;\n'
+        '    for (const std::vector<long long>& consumed : latencies)\n'
+        '    {\n'
+        '        sorted.insert(sorted.end(), consumed.begin(), consumed.end());\n'
+        '    }\n'
+        '    std::sort(sorted.begin(), sorted.end());\n'
+        '    printf("{\\"messages\\": %d, \\"seconds\\": %.9f, \\"cpu_seconds\\": %.9f, "\n'
+        '           "\\"idle_seconds\\": %.9f, \\"idle_cpu_seconds\\": %.9f, "\n'
+        '           "\\"p50_ns\\": %lld, \\"p90_ns\\": %lld, \\"p99_ns\\": %lld, \\"max_ns\\": %lld}\\n",\n'
+        '           static_cast<int>(sorted.size()), elapsed / 1e9, cpuSeconds,\n'
+        '           $idle_milliseconds / 1e3, idleCpuSeconds,\n'
+        '           percentile(sorted, 0.5), percentile(sorted, 0.9), percentile(sorted, 0.99),\n'
+        '           sorted.empty() ? 0LL : sorted.back());\n'
+        '    return 0;\n'
+        '}\n'
+    )
+
+    def __init__(self, scenario: Scenario) -> None:
+        self._scenario: Scenario = scenario
+
+    def _get_channel_type(self) -> str:
+        if self._scenario.channel_type == CHANNEL_BOUNDED:
+            return "ChannelBounded<long long>"
+        return f"ChannelUnbounded<long long, {self._scenario.capacity}>"
+
+    def _get_cases(self, indent: str, body: typing.List[str]) -> str:
+        lines: typing.List[str] = []
+        for channel in range(self._scenario.producers):
+            lines.append(f"{indent}case stamp <- channel{channel}:\n")
+            lines.append(f"{indent}{{\n")
+            lines.extend(f"{indent}    {line}\n" for line in body)
+            lines.append(f"{indent}}}\n")
+        return "".join(lines)
+
+    def generate(self) -> str:
+        """Return the source of the scenario, before its translation."""
+        return self._SOURCE.substitute(
+            channels="".join(f"{self._get_channel_type()} channel{channel};\n"
+                             for channel in range(self._scenario.producers)),
+            consume_cases=self._get_cases(
+                " " * 12, ["latencies.push_back(benchmarkNow() - stamp);", "received.fetch_add(1);"]
+            ),
+            idle_cases=self._get_cases(" " * 8, []),
+            start_producers="".join(
+                f"    threads.emplace_back([&]() {{ produce(channel{channel}, messages); }});\n"
+                for channel in range(self._scenario.producers)
+            ),
+            messages=self._scenario.messages,
+            producers=self._scenario.producers,
+            consumers=self._scenario.consumers,
+            idle_milliseconds=self._scenario.idle_milliseconds,
+        )
+
+
+class CompilationError(Exception):
+
+    def __init__(self, file_name: str, output: str) -> None:
+        super().__init__(f"{file_name} could not be compiled:\n{output}")
+
+
+class RuntimeResult(typing.NamedTuple):
+    scenario: str
+    messages: int
+    seconds: float
+    # CPU time of the whole process while the messages went through.
+    cpu_seconds: float
+    # CPU time of a `select` blocked on empty channels for `idle_seconds`.
+    idle_seconds: float
+    idle_cpu_seconds: float
+    p50_ns: int
+    p90_ns: int
+    p99_ns: int
+    max_ns: int
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / max(self.seconds, sys.float_info.epsilon)
+
+    @property
+    def idle_cpu_ratio(self) -> float:
+        """Fraction of a core a blocked `select` keeps busy."""
+        return self.idle_cpu_seconds / max(self.idle_seconds, sys.float_info.epsilon)
+
+
+class RuntimeBenchmark:
+    """Translate, compile and run one `Scenario` in `directory`."""
+    _CXX_FLAGS: typing.Tuple[str, ...] = ("-std=c++11", "-O2", "-pthread")
+
+    def __init__(self, scenario: Scenario, directory: str, compiler: str = "g++") -> None:
+        self._scenario: Scenario = scenario
+        self._directory: str = directory
+        self._compiler: str = compiler
+        base_name: str = "scenario_" + scenario.name.replace("/", "_")
+        self._cpp_file_name: str = os.path.join(directory, base_name + ".cpp")
+        self._header_file_name: str = HeaderGenerator.get_output_file_name(self._cpp_file_name)
+        self._executable_file_name: str = os.path.join(directory, base_name)
+
+    def translate(self) -> None:
+        header, cpp = translate(ScenarioGenerator(self._scenario).generate(),
+                                self._header_file_name,
+                                self._scenario.options)
+        with open(self._header_file_name, "w", encoding=HeaderGenerator.OUTPUT_ENCODING) as output:
+            output.write(header)
+        with open(self._cpp_file_name, "w", encoding=CppGenerator.OUTPUT_ENCODING) as output:
+            output.write(cpp)
+
+    def compile(self) -> None:
+        command: typing.List[str] = [self._compiler, *self._CXX_FLAGS, f"-I{_SOURCE_DIRECTORY}",
+                                     self._cpp_file_name, os.path.join(_SOURCE_DIRECTORY, "common", "Utils.cpp"),
+                                     "-o", self._executable_file_name]
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if process.returncode:
+            raise CompilationError(self._cpp_file_name, process.stdout)
+
+    def run(self) -> RuntimeResult:
+        self.translate()
+        self.compile()
+        output: str = subprocess.run([self._executable_file_name], stdout=subprocess.PIPE, check=True,
+                                     universal_newlines=True).stdout
+        return parse_result(self._scenario, output)
+
+
+def parse_result(scenario: Scenario, output: str) -> RuntimeResult:
+    """Return the result printed by the program of `scenario`, on its last line."""
+    return RuntimeResult(scenario=scenario.name, **json.loads(output.strip().splitlines()[-1]))
+
+
+def iter_scenarios(channel_types: typing.Iterable[str],
+                   wait_strategies: typing.Iterable[str],
+                   producers: typing.Iterable[int],
+                   consumers: typing.Iterable[int],
+                   base: Scenario = Scenario()) -> typing.Iterator[Scenario]:
+    """Yield each valid combination, with the other fields of `base`."""
+    for channel_type in channel_types:
+        for wait_strategy in wait_strategies:
+            for producer_count in producers:
+                for consumer_count in consumers:
+                    scenario: Scenario = base._replace(channel_type=channel_type,
+                                                       wait_strategy=wait_strategy,
+                                                       producers=producer_count,
+                                                       consumers=consumer_count)
+                    if scenario.is_valid:
+                        yield scenario
+
+
+def run_benchmarks(scenarios: typing.Iterable[Scenario],
+                   compiler: str = "g++",
+                   directory: typing.Optional[str] = None) -> typing.Iterator[RuntimeResult]:
+    """Run each scenario, in `directory` when given so the sources and the programs are kept."""
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        for scenario in scenarios:
+            yield RuntimeBenchmark(scenario, directory or temporary_directory, compiler).run()
+
+
+def save_baseline(results: typing.List[RuntimeResult], file_name: str) -> None:
+    with open(file_name, "w", encoding="utf-8") as output:
+        json.dump({result.scenario: result._asdict() for result in results}, output, indent=4, sort_keys=True)
+
+
+def load_baseline(file_name: str) -> typing.Dict[str, RuntimeResult]:
+    with open(file_name, "r", encoding="utf-8") as input_file:
+        return {key: RuntimeResult(**result) for key, result in json.load(input_file).items()}
+
+
+def check_regressions(results: typing.List[RuntimeResult],
+                      baseline: typing.Dict[str, RuntimeResult],
+                      tolerance: float) -> typing.List[str]:
+    """Return a failure for each result with fewer messages per second, or a higher 99th percentile
+    of latency, than its baseline, beyond `tolerance`.
+    """
+    failures: typing.List[str] = []
+    for result in results:
+        expected: typing.Optional[RuntimeResult] = baseline.get(result.scenario)
+        if expected is None:
+            continue
+        if result.messages_per_second < expected.messages_per_second * (1 - tolerance):
+            failures.append(
+                f"{result.scenario}: {result.messages_per_second:.0f} messages/s, "
+                f"the baseline is {expected.messages_per_second:.0f} messages/s"
+            )
+        if result.p99_ns > expected.p99_ns * (1 + tolerance):
+            failures.append(
+                f"{result.scenario}: {result.p99_ns} ns at the 99th percentile, the baseline is {expected.p99_ns} ns"
+            )
+    return failures
+
+
+def _format_result(result: RuntimeResult) -> str:
+    return f"{result.scenario:<24} {result.messages_per_second:>12.0f} messages/s " \
+           f"p50 {result.p50_ns:>9} ns p90 {result.p90_ns:>9} ns p99 {result.p99_ns:>9} ns " \
+           f"max {result.max_ns:>10} ns {result.cpu_seconds:>7.2f} s CPU " \
+           f"{100 * result.idle_cpu_ratio:>5.1f}% CPU blocked"
+
+
+@click.command("Benchmark the channels and the generated selects")
+@click.option("--channel-type", "channel_types", type=click.Choice(CHANNEL_TYPES), multiple=True,
+              default=CHANNEL_TYPES, show_default=True, help="Repeat the option for each channel type.")
+@click.option("--wait-strategy", "wait_strategies", type=click.Choice(HeaderGenerator.WAIT_STRATEGIES),
+              multiple=True, default=HeaderGenerator.WAIT_STRATEGIES, show_default=True,
+              help="Repeat the option for each wait strategy.")
+@click.option("--producers", type=int, multiple=True, default=(1, 4), show_default=True,
+              help="Producers, and cases of the select, repeat the option for each fan-in.")
+@click.option("--consumers", type=int, multiple=True, default=(1,), show_default=True,
+              help="Consumers selecting over the same channels, repeat the option for each count.")
+@click.option("--messages", type=int, default=Scenario().messages, show_default=True,
+              help="Messages written by each producer.")
+@click.option("--capacity", type=int, default=Scenario().capacity, show_default=True,
+              help="Capacity of the unbounded and ring channels.")
+@click.option("--idle-ms", "idle_milliseconds", type=int, default=Scenario().idle_milliseconds, show_default=True,
+              help="How long the CPU time of a blocked select is measured.")
+@click.option("--cxx", "compiler", default=lambda: os.environ.get("CXX", "g++"), show_default="$CXX or g++",
+              help="C++ compiler.")
+@click.option("--work-dir", "directory", type=click.Path(file_okay=False, exists=True), default=None,
+              help="Keep the translated sources and the programs there.")
+@click.option("--baseline", "baseline_file_name", type=click.Path(dir_okay=False),
+              default="runtime_benchmark_baseline.json", show_default=True, help="File with the results to compare with.")
+@click.option("--save", is_flag=True, help="Save the results as the new baseline instead of comparing with it.")
+@click.option("--tolerance", type=float, default=0.25, show_default=True,
+              help="Allowed slowdown and latency growth compared to the baseline.")
+def main(channel_types: typing.Tuple[str, ...],
+         wait_strategies: typing.Tuple[str, ...],
+         producers: typing.Tuple[int, ...],
+         consumers: typing.Tuple[int, ...],
+         messages: int,
+         capacity: int,
+         idle_milliseconds: int,
+         compiler: str,
+         directory: typing.Optional[str],
+         baseline_file_name: str,
+         save: bool,
+         tolerance: float) -> None:
+    base = Scenario(messages=messages, capacity=capacity, idle_milliseconds=idle_milliseconds)
+    results: typing.List[RuntimeResult] = []
+    try:
+        for result in run_benchmarks(iter_scenarios(channel_types, wait_strategies, producers, consumers, base),
+                                     compiler, directory):
+            click.echo(_format_result(result))
+            results.append(result)
+    except (CompilationError, subprocess.CalledProcessError) as error:
+        raise click.ClickException(str(error))
+
+    failures: typing.List[str] = []
+    if save:
+        save_baseline(results, baseline_file_name)
+        click.echo(f"Baseline saved to {baseline_file_name}")
+    elif os.path.exists(baseline_file_name):
+        failures.extend(check_regressions(results, load_baseline(baseline_file_name), tolerance))
+    for failure in failures:
+        click.echo(failure, err=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
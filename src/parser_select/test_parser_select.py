@@ -1,4 +1,8 @@
+import codecs
+import io
+import json
 import os
+import re
 from py._path import local
 import typing
 
@@ -6,8 +10,15 @@ from click.testing import CliRunner
 from click.testing import Result
 import pytest
 
-from .parser_select import CppGenerator, SelectParser, HeaderGenerator
-from .parser_select import command_line
+from .parser_select import CppGenerator, SelectLexer, SelectParser, HeaderGenerator
+from .parser_select import cli, command_line, translate, translate_file, get_depfile_name, CacheEntry, TranslationCache
+from .parser_select import CompilerWrapper, SourceMap, get_source_map_name
+from .parser_select import Watcher, WatchFailure, TranslationStats, CACHED, COPIED, TRANSLATED, UNCHANGED
+from .parser_select import ChannelDeclaration, ChannelIndex, GeneratorOptions
+from .parser_select import ChannelOperation, RangeLoop, SelectBlock
+from .benchmark import BenchmarkResult, CorpusGenerator, CorpusOptions, check_regressions, check_scaling
+from .runtime_benchmark import CHANNEL_BOUNDED, CHANNEL_TYPES, RuntimeResult, Scenario, ScenarioGenerator
+from .runtime_benchmark import check_regressions as check_runtime_regressions, iter_scenarios, parse_result
 from .conftest import gobyexample
 
 def test_parser_select_general_case_overall() -> None:
@@ -143,6 +154,162 @@ def test_select_with_just_one_default(tmpdir: local.LocalPath, cpp_includes: str
     ]
 
 
+def test_select_in_comments_and_strings_is_ignored(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    _add_content(tmpdir, cpp_includes +
+                         '// select {\n'
+                         '/* select {\n'
+                         '   case message1 <- channel1:\n'
+                         '*/\n'
+                         'int main() {\n'
+                         '    std::cout << "select {";\n'
+                         '}\n')
+    select_data = SelectParser(_get_file_path(tmpdir)).parse()
+    assert select_data == []
+
+
+@pytest.mark.parametrize("source", [
+    '#include <sys/select.h>\n'
+    'int main() {\n'
+    '    return 0;\n'
+    '}\n',
+    'void wait(int fd, fd_set& r) {\n'
+    '    int n = select(fd + 1, &r, 0, 0, 0);\n'
+    '    if (n > 0) {\n'
+    '        read(fd);\n'
+    '    }\n'
+    '}\n',
+])
+def test_posix_select_is_left_alone(source: str) -> None:
+    assert SelectParser.parse_blocks(source) == []
+    _, cpp = translate(source)
+    # Everything after the first line, where the include of the header may go, is kept as it is.
+    assert cpp.endswith(source.split("\n", 1)[1])
+
+
+def test_select_with_nested_braces_in_case(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    _add_content(tmpdir, cpp_includes +
+                         'int main() {\n'
+                         '    select {\n' +
+                         '      case message1 <- channel1: // the first one\n'
+                         '      {\n'
+                         '          if (message1.empty()) {\n'
+                         '              std::cout << "}";\n'
+                         '          }\n'
+                         '      }\n'
+                         '      default: std::cout << "{";\n'
+                         '  }\n'
+                         '}\n')
+    select_data = SelectParser(_get_file_path(tmpdir)).parse()
+    assert select_data == [
+        [
+            (
+                'message1',
+                'channel1',
+                '      {\n'
+                '          if (message1.empty()) {\n'
+                '              std::cout << "}";\n'
+                '          }\n'
+                '      }\n'
+            ),
+            (
+                None,
+                'default',
+                'std::cout << "{";\n'
+            )
+        ]
+    ]
+
+
+def test_lexer_tracks_brace_depth() -> None:
+    tokens = list(SelectLexer("select {\n  case a <- b: { c('}'); }\n}\n").tokens())
+    assert [(token.kind, token.depth) for token in tokens] == [
+        (SelectLexer.KEYWORD, 0),
+        (SelectLexer.OPEN, 0),
+        (SelectLexer.KEYWORD, 1),
+        (SelectLexer.ARROW, 1),
+        (SelectLexer.COLON, 1),
+        (SelectLexer.OPEN, 1),
+        (SelectLexer.STRING, 2),
+        (SelectLexer.CLOSE, 1),
+        (SelectLexer.CLOSE, 0),
+    ]
+    assert [token.line for token in tokens] == [1, 1, 2, 2, 2, 2, 2, 2, 3]
+
+
+def test_iter_selects_yields_before_reading_everything() -> None:
+    source: str = 'void f() {\n' \
+                  '    select {\n' \
+                  '        case message1 <- channel1:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n' + '// filler\n' * 1000
+    input_file = io.StringIO(source)
+    selects = SelectParser.iter_selects(input_file, chunk_size=16)
+    assert next(selects) == [('message1', 'channel1', '        {\n        }\n')]
+    assert input_file.tell() < len(source)
+    assert list(selects) == []
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64])
+def test_iter_selects_does_not_depend_on_chunk_size(chunk_size: int) -> None:
+    with SelectParser.open_input("SelectTest.cpp") as input_file:
+        source: str = input_file.read()
+    assert list(SelectParser.iter_selects(io.StringIO(source), chunk_size)) == \
+        SelectParser("SelectTest.cpp").parse()
+
+
+@pytest.mark.parametrize("content, encoding", [
+    ("#include <iostream>\n".encode("utf-8"), "utf-8"),
+    (codecs.BOM_UTF8 + "#include <iostream>\n".encode("utf-8"), "utf-8"),
+    ("#include <iostream>\n".encode("utf-16-le"), "utf-16-le"),
+    (codecs.BOM_UTF16_LE + "#include <iostream>\n".encode("utf-16-le"), "utf-16-le"),
+    ("#include <iostream>\n".encode("utf-16-be"), "utf-16-be"),
+])
+def test_detect_encoding(tmpdir: local.LocalPath, content: bytes, encoding: str) -> None:
+    tmpdir.join(_get_file_name()).write_binary(content)
+    assert SelectParser.detect_encoding(_get_file_path(tmpdir)) == encoding
+
+
+def test_parse_utf8_input(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    tmpdir.join(_get_file_name()).write_text(cpp_includes +
+                                             'int main() {\n'
+                                             '    select {\n'
+                                             '      case message1 <- channel1:\n'
+                                             '      {\n'
+                                             '      }\n'
+                                             '  }\n'
+                                             '}\n', encoding="utf-8")
+    assert SelectParser.contains_markers(_get_file_path(tmpdir))
+    assert SelectParser(_get_file_path(tmpdir)).parse() == [[('message1', 'channel1', '      {\n      }\n')]]
+
+
+def test_late_byte_outside_the_detected_encoding(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    # Past the bytes the encoding is detected from, a Latin-1 `é`, which isn't valid UTF-8.
+    tmpdir.join(_get_file_name()).write_binary(cpp_includes.encode() + b"// padding\n" * 500 +
+                                               b"// caf\xe9\n"
+                                               b"int main() {\n"
+                                               b"    select {\n"
+                                               b"      case message1 <- channel1:\n"
+                                               b"      {\n"
+                                               b"      }\n"
+                                               b"  }\n"
+                                               b"}\n")
+    assert SelectParser.detect_encoding(_get_file_path(tmpdir)) == "utf-8"
+    assert SelectParser(_get_file_path(tmpdir)).parse() == [[('message1', 'channel1', '      {\n      }\n')]]
+    assert translate_file(_get_file_path(tmpdir), str(tmpdir.join("AUTOGENERATED.h"))).status == TRANSLATED
+    assert "// caf\u00e9\n" in tmpdir.join(_get_generated_file_name()).read_text(encoding="utf-8")
+
+
+def test_command_line_copies_file_without_markers(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    tmpdir.join(_get_file_name()).write_text(cpp_includes + "int main() {}\n", encoding="utf-8")
+    assert not SelectParser.contains_markers(_get_file_path(tmpdir))
+
+    result: Result = CliRunner().invoke(command_line, [_get_file_path(tmpdir)])
+    assert result.exit_code == 0
+    assert tmpdir.join(_get_generated_file_name()).read_binary() == tmpdir.join(_get_file_name()).read_binary()
+
+
 def test_header_generator_general_case_overall() -> None:
     parser = SelectParser("SelectTest.cpp")
     select_data: typing.List[SelectParser.SelectContent] = parser.parse()
@@ -157,6 +324,22 @@ def test_header_generator_general_case_overall() -> None:
     assert verified
 
 
+def test_header_generator_keeps_previous_output_on_failure(tmpdir: local.LocalPath) -> None:
+    header = tmpdir.join("AUTOGENERATED.h")
+    select_data: typing.List[SelectParser.SelectContent] = SelectParser("SelectTest.cpp").parse()
+    HeaderGenerator.generate(select_data, str(header))
+    assert header.read_text(encoding="utf-8") == HeaderGenerator.render(select_data)
+
+    def _failing_selects() -> typing.Iterator[SelectParser.SelectContent]:
+        yield select_data[0]
+        raise ValueError("parse error")
+
+    with pytest.raises(ValueError):
+        HeaderGenerator.generate(_failing_selects(), str(header))
+    assert header.read_text(encoding="utf-8") == HeaderGenerator.render(select_data)
+    assert [entry.basename for entry in tmpdir.listdir()] == ["AUTOGENERATED.h"]
+
+
 def _get_generated_file_name() -> str:
     return _get_file_name().split(".cpp")[0] + "_generated.cpp"
 
@@ -226,3 +409,821 @@ def test_command_line_creates_output_files() -> None:
     assert result.exit_code == 0
     assert _file_exists(HeaderGenerator.OUTPUT_FILE_NAME), f"{HeaderGenerator.OUTPUT_FILE_NAME} was not generated."
     assert _file_exists(output_file_name), f"{output_file_name} was not generated."
+
+
+def test_command_line_restores_outputs_from_cache(tmpdir: local.LocalPath,
+                                                  monkeypatch: pytest.MonkeyPatch,
+                                                  cpp_includes: str) -> None:
+    monkeypatch.chdir(tmpdir)
+    _add_content(tmpdir, cpp_includes +
+                         'int main() {\n'
+                         '    select {\n'
+                         '      case message1 <- channel1:\n'
+                         '      {\n'
+                         '      }\n'
+                         '  }\n'
+                         '}\n')
+    arguments: typing.List[str] = [_get_file_path(tmpdir), "--cache-dir", str(tmpdir.join("cache"))]
+    assert CliRunner().invoke(command_line, arguments).exit_code == 0
+    header: str = tmpdir.join(HeaderGenerator.OUTPUT_FILE_NAME).read()
+    generated: str = tmpdir.join(_get_generated_file_name()).read()
+    os.remove(HeaderGenerator.OUTPUT_FILE_NAME)
+    os.remove(_get_generated_file_name())
+
+    def _fail(*args: typing.Any) -> None:
+        raise AssertionError("The input was parsed again.")
+
+    monkeypatch.setattr(SelectParser, "parse_blocks", _fail)
+    monkeypatch.setattr(SelectLexer, "tokens", _fail)
+    result: Result = CliRunner().invoke(command_line, arguments)
+    assert result.exit_code == 0, result.output
+    assert tmpdir.join(HeaderGenerator.OUTPUT_FILE_NAME).read() == header
+    assert tmpdir.join(_get_generated_file_name()).read() == generated
+
+
+def test_translation_cache_evicts_least_recently_used(tmpdir: local.LocalPath) -> None:
+    cache = TranslationCache(str(tmpdir), max_size=350)
+    for key in ["first", "second", "third"]:
+        cache.put(key, CacheEntry(selects=[[(None, "default", "")]], header=key * 10, cpp=""))
+        os.utime(tmpdir.join(key + ".json"), (0, {"first": 1, "second": 2, "third": 3}[key]))
+    assert cache.get("first") is not None
+    cache.put("fourth", CacheEntry(selects=[], header="", cpp=""))
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("fourth") is not None
+
+
+def test_translation_cache_leaves_nothing_behind_on_failure(tmpdir: local.LocalPath) -> None:
+    cache = TranslationCache(str(tmpdir))
+    with pytest.raises(TypeError):
+        cache.put("key", CacheEntry(selects=[], header=object(), cpp=""))
+    assert tmpdir.listdir() == []
+    assert cache.get("key") is None
+
+
+def test_translation_cache_key_changes_with_the_translator(tmpdir: local.LocalPath,
+                                                           monkeypatch: pytest.MonkeyPatch) -> None:
+    tmpdir.join("input.cpp").write("select {}\n")
+    key: str = TranslationCache.key(str(tmpdir.join("input.cpp")))
+    assert TranslationCache.key(str(tmpdir.join("input.cpp"))) == key
+    monkeypatch.setattr(TranslationCache, "_translator_digest", b"another translator")
+    assert TranslationCache.key(str(tmpdir.join("input.cpp"))) != key
+
+
+def test_translate_command_translates_a_tree(tmpdir: local.LocalPath, cpp_includes: str) -> None:
+    sources: local.LocalPath = tmpdir.mkdir("sources")
+    for name in ["first", "second"]:
+        sources.join(name + ".cpp").write_text(cpp_includes +
+                                               'int main() {\n'
+                                               '    select {\n'
+                                               f'      case {name} <- channel1:\n'
+                                               '      {\n'
+                                               '      }\n'
+                                               '  }\n'
+                                               '}\n', encoding="utf-8")
+    sources.join("third.cpp").write_text(cpp_includes, encoding="utf-8")
+
+    result: Result = CliRunner().invoke(cli, ["translate", "--jobs", "2", str(sources)])
+    assert result.exit_code == 0, result.output
+    assert "3 files: 2 translated, 0 from cache, 1 without selects, 0 failed; 2 selects" in result.output
+    for name in ["first", "second"]:
+        assert sources.join(name + "_generated.cpp").read().startswith(
+            f'#include <iostream>\n\n#include "{name}_AUTOGENERATED.h"\n'
+        )
+        assert f"select_0(channel1, &{name});" in sources.join(name + "_generated.cpp").read()
+        assert "#define select_0(selectChannel0, selectMessage0)" in sources.join(name + "_AUTOGENERATED.h").read()
+
+    # The generated files are not translated again.
+    result = CliRunner().invoke(cli, ["translate", "--jobs", "1", str(sources.join("*.cpp"))])
+    assert "3 files:" in result.output
+
+
+def test_cli_runs_a_single_file_by_default(tmpdir: local.LocalPath,
+                                          monkeypatch: pytest.MonkeyPatch,
+                                          cpp_includes: str) -> None:
+    monkeypatch.chdir(tmpdir)
+    _add_content(tmpdir, cpp_includes)
+    assert CliRunner().invoke(cli, [_get_file_path(tmpdir)]).exit_code == 0
+    assert _file_exists(_get_generated_file_name())
+
+
+def test_command_line_reports_stats(tmpdir: local.LocalPath, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join(_get_file_name()).write_text(gobyexample[0][0], encoding="utf-8")
+    stats_file = tmpdir.join("stats.json")
+    profile_file = tmpdir.join("translation.prof")
+    result: Result = CliRunner().invoke(command_line, [
+        _get_file_name(), "--stats-json", str(stats_file), "--profile", str(profile_file)
+    ])
+    assert result.exit_code == 0
+
+    stats: typing.Dict[str, typing.Any] = json.loads(stats_file.read_text(encoding="utf-8"))
+    assert list(stats["phases"]) == ["read", "parse", "header", "cpp", "write"]
+    assert all(phase["wall"] >= 0 and phase["cpu"] >= 0 for phase in stats["phases"].values())
+    assert stats["bytes_read"] == len(gobyexample[0][0].encode())
+    assert stats["bytes_written"] == tmpdir.join(_get_generated_file_name()).size() + tmpdir.join("AUTOGENERATED.h").size()
+    assert (stats["lines"], stats["selects"], stats["cases"]) == (16, 0, 0)
+    assert profile_file.size() > 0
+
+
+def test_stats_count_only_the_outputs_written(tmpdir: local.LocalPath) -> None:
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text("int main() {}\n", encoding="utf-8")
+    for bytes_written in [input_file.size(), 0]:
+        stats = TranslationStats()
+        assert translate_file(str(input_file), str(tmpdir.join("AUTOGENERATED.h")), stats=stats).status == COPIED
+        assert stats.bytes_written == bytes_written
+
+
+@pytest.mark.parametrize("index_example", list(range(len(gobyexample))))
+def test_translate_in_memory(index_example: int) -> None:
+    header, cpp = translate(gobyexample[index_example][0])
+    assert cpp == gobyexample[index_example][1]
+    assert header.startswith("#pragma once\n")
+
+
+@pytest.mark.parametrize("header, receiver, sender", [
+    ("case msg <-channel1:", "msg", "channel1"),
+    ("case msg<-channel1:", "msg", "channel1"),
+    ("case <-channel1:", None, "channel1"),
+    ("case channel1<- msg:", "channel1", "msg"),
+])
+def test_case_arrow_needs_no_spaces(header: str, receiver: typing.Optional[str], sender: str) -> None:
+    source: str = 'int main() {\n' \
+                  '    select {\n' \
+                  f'        {header}\n' \
+                  '            use();\n' \
+                  '    }\n' \
+                  '}\n'
+    block, = SelectParser.parse_blocks(source)
+    assert block.cases == [(receiver, sender, '            use();\n')]
+
+
+def test_parse_blocks_records_spans() -> None:
+    source: str = 'int main() {\n' \
+                  '    msg <- channel1;\n' \
+                  '    select {\n' \
+                  '        default:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    operation, block = SelectParser.parse_blocks(source)
+    assert operation == ChannelOperation("msg", "channel1", 13, 34, 2)
+    assert source[operation.start:operation.end] == '    msg <- channel1;\n'
+    assert isinstance(block, SelectBlock)
+    assert block.cases == [(None, 'default', '        {\n        }\n')]
+    assert block.line == 3
+    assert source[block.start:block.end] == source[34:-2]
+
+
+def test_corpus_generator_follows_options(tmpdir: local.LocalPath) -> None:
+    options = CorpusOptions(lines=1000, selects=5, cases=3, comment_density=0.5, body_lines=2)
+    input_file_name, = CorpusGenerator(options).write(str(tmpdir))
+    with open(input_file_name, "r", encoding="utf-8") as input_file:
+        assert abs(len(input_file.readlines()) - options.lines) < 50
+
+    select_data: typing.List[SelectParser.SelectContent] = SelectParser(input_file_name).parse()
+    assert len(select_data) == options.selects
+    assert all(len(select) == options.cases for select in select_data)
+    receiver, sender, content = select_data[0][1]
+    assert (receiver, sender) == ("channel_0_1", "message_1")
+    assert content.count("std::cout") == options.body_lines
+
+
+def test_benchmark_checks_regressions_and_scaling() -> None:
+    baseline = BenchmarkResult("parse", 1000, 10, 0.1, 1000)
+    assert not check_regressions([baseline._replace(seconds=0.11)], {"parse/1000": baseline}, 0.25)
+    assert check_regressions([baseline._replace(seconds=0.2)], {"parse/1000": baseline}, 0.25)
+    assert check_regressions([baseline._replace(peak_memory=2000)], {"parse/1000": baseline}, 0.25)
+
+    assert not check_scaling([baseline, BenchmarkResult("parse", 10000, 100, 1.2, 1000)], 2.0)
+    assert check_scaling([baseline, BenchmarkResult("parse", 10000, 100, 3.0, 1000)], 2.0)
+
+
+def test_watcher_translates_only_what_changed(tmpdir: local.LocalPath, monkeypatch: pytest.MonkeyPatch) -> None:
+    select: str = '    select {\n' \
+                  '        case message <- channel%d:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n'
+    source: str = 'int main() {\n' + select % 1 + select % 2 + '}\n'
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text(source, encoding="utf-8")
+    watcher = Watcher([str(tmpdir)])
+
+    result, = watcher.poll_once()
+    assert (result.status, result.selects) == (TRANSLATED, 2)
+    assert watcher.poll_once() == []
+    header = tmpdir.join("hello_AUTOGENERATED.h")
+    assert header.read_text(encoding="utf-8") == translate(source, str(header))[0]
+
+    rendered: typing.List[int] = []
+    render_select: typing.Callable = HeaderGenerator.render_select
+    monkeypatch.setattr(HeaderGenerator, "render_select",
+                        lambda index, *args: rendered.append(index) or render_select(index, *args))
+    header_mtime: float = header.mtime()
+    # The same content with a new modification time leaves the outputs alone.
+    os.utime(str(input_file), (0, 0))
+    assert [result.status for result in watcher.poll_once()] == [UNCHANGED]
+    assert (rendered, header.mtime()) == ([], header_mtime)
+
+    source = source.replace("channel2", "channel3")
+    input_file.write_text(source, encoding="utf-8")
+    assert [result.status for result in watcher.poll_once()] == [TRANSLATED]
+    assert rendered == [1]
+    assert header.read_text(encoding="utf-8") == translate(source, str(header))[0]
+
+    def _fail(*args: typing.Any) -> None:
+        raise ValueError("parse error")
+
+    monkeypatch.setattr(SelectParser, "parse_blocks", _fail)
+    input_file.write_text(source + "\n", encoding="utf-8")
+    assert watcher.poll_once() == [WatchFailure(str(input_file), "parse error")]
+    assert watcher.poll_once() == []
+
+
+def test_watcher_translates_again_when_an_included_header_changes(tmpdir: local.LocalPath) -> None:
+    header_file = tmpdir.join("channels.h")
+    header_file.write_text('ChannelBounded<int> x;\n', encoding="utf-8")
+    tmpdir.join(_get_file_name()).write_text('#include "channels.h"\nvoid send() {\n    values <- x;\n}\n',
+                                             encoding="utf-8")
+    output_file = tmpdir.join(_get_generated_file_name())
+    watcher = Watcher([str(tmpdir.join(_get_file_name()))])
+    assert [result.status for result in watcher.poll_once()] == [TRANSLATED]
+    assert "x.read(&values, false);\n" in output_file.read_text(encoding="utf-8")
+    assert watcher.poll_once() == []
+
+    header_file.write_text('ChannelBounded<int> values;\n', encoding="utf-8")
+    assert [result.status for result in watcher.poll_once()] == [TRANSLATED]
+    assert "values.write(x, false);\n" in output_file.read_text(encoding="utf-8")
+    assert watcher.poll_once() == []
+
+
+def test_blocking_select_parks_on_a_waiter() -> None:
+    source: str = 'int main() {\n' \
+                  '    select {\n' \
+                  '        case message1 <- channel1:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '        case channel2 <- message2:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    spinning, cpp = translate(source)
+    assert "SelectWaiter" not in spinning
+    parking, parking_cpp = translate(source, options=GeneratorOptions(wait_strategy=HeaderGenerator.WAIT_PARK))
+    assert parking_cpp == cpp
+    assert "inline int select_shape_rw_park(Channel0& channel0, Message0 message0, " \
+           "Channel1& channel1, const Message1& message1)\n" \
+           "{\n" \
+           "    SelectWaiter selectWaiter;\n" \
+           "    SelectWaiterRegistration selectWaiterRegistration0(channel0, selectWaiter, 0);\n" \
+           "    SelectWaiterRegistration selectWaiterRegistration1(channel1, selectWaiter, 1);\n" \
+           "    while (true)\n" in parking
+    assert "        selectWaiter.waitFor();\n    }\n}\n" in parking
+    assert "switch (select_shape_rw_park(selectChannel0, selectMessage0, selectChannel1, selectMessage1)) \\\n" \
+        in parking
+
+    # A select with `default` never blocks, so there is nothing to wait for.
+    with_default: str = source.replace("    }\n}", "        default:\n        {\n        }\n    }\n}")
+    assert translate(with_default, options=GeneratorOptions(wait_strategy=HeaderGenerator.WAIT_PARK)) == \
+        translate(with_default)
+
+
+def test_select_annotation_picks_the_wait_strategy() -> None:
+    source: str = 'int main() {\n' \
+                  '    select[hybrid] {\n' \
+                  '        case message1 <- channel1:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    block, = SelectParser.parse_blocks(source)
+    assert block.annotation == HeaderGenerator.WAIT_HYBRID
+
+    header, cpp = translate(source, options=GeneratorOptions(spin_budget=50))
+    assert "    SelectBackoff selectBackoff(50);\n" in header
+    assert "        if (!selectBackoff.spin())\n        {\n            selectWaiter.waitFor();\n        }\n" in header
+    assert "switch (select_shape_r_hybrid50(selectChannel0, selectMessage0)) \\\n" in header
+    assert "select[hybrid]" not in cpp
+
+    with pytest.raises(ValueError, match="line 2: unknown select annotation `fast`"):
+        translate(source.replace("hybrid", "fast"))
+
+
+def test_case_priorities_give_weighted_polling() -> None:
+    source: str = 'int main() {\n' \
+                  '    select {\n' \
+                  '        case[3] message1 <- channel1:\n' \
+                  '        {\n' \
+                  '            first();\n' \
+                  '        }\n' \
+                  '        case <- channel2:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '        default:\n' \
+                  '        {\n' \
+                  '            nothing();\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    block, = SelectParser.parse_blocks(source)
+    assert block.priorities == [3, 1, 1]
+    assert block.cases[0][:2] == ("message1", "channel1")
+
+    header, _ = translate(source)
+    assert "inline int select_shape_rr_default_round_robin_weights_3_1(" in header
+    assert "    static const unsigned selectSchedule[] = {0, 0, 0, 1};\n" in header
+    assert "    const unsigned selectStart = selectSchedule[SelectOrder::roundRobin(selectTurn, 4)];\n" in header
+    assert "static std::atomic<unsigned> selectTurn(0); \\\n" in header
+    # Each body is written once, after the polling, and `default` runs when no case was ready.
+    assert header.count("first();") == 1
+    assert "while (true)" not in header
+    assert header.index("case 0: \\\n") < header.index("default: \\\n{ \\\n        { \\\n            nothing();")
+
+    with pytest.raises(ValueError, match="line 2: the priority of a case must be at least 1"):
+        translate(source.replace("case[3]", "case[0]"))
+
+
+def test_case_order_option() -> None:
+    source: str = gobyexample[0][0].replace("    channel1 <- str;\n", "    select {\n"
+                                            "        case channel1 <- str:\n"
+                                            "            sent();\n"
+                                            "        case str <- channel1:\n"
+                                            "            received();\n"
+                                            "    }\n")
+    assert translate(source, options=GeneratorOptions(case_order=HeaderGenerator.ORDER_SOURCE)) == translate(source)
+    header, _ = translate(source, options=GeneratorOptions(case_order=HeaderGenerator.ORDER_RANDOM))
+    assert "    const unsigned selectStart = SelectOrder::random(2);\n" in header
+    assert "selectSchedule" not in header and "selectTurn" not in header
+
+    # A single case has nothing to reorder.
+    single: str = source.replace("        case str <- channel1:\n            received();\n", "")
+    assert translate(single, options=GeneratorOptions(case_order=HeaderGenerator.ORDER_RANDOM)) == translate(single)
+
+
+def test_selects_of_the_same_shape_share_their_polling() -> None:
+    select: str = '    select {{\n' \
+                  '        case message1 <- {0}:\n' \
+                  '        {{\n' \
+                  '            got{0}();\n' \
+                  '        }}\n' \
+                  '        case {0} <- message2:\n' \
+                  '        {{\n' \
+                  '            sent{0}();\n' \
+                  '        }}\n' \
+                  '    }}\n'
+    source: str = 'int main() {\n' + select.format("channel1") + select.format("channel2") + '}\n'
+    header, cpp = translate(source)
+    assert header.count("inline int select_shape_rw(") == 1
+    assert header.index("inline int select_shape_rw(") < header.index("#define select_0(")
+    assert header.count("switch (select_shape_rw(selectChannel0, selectMessage0, selectChannel1, selectMessage1))") == 2
+    assert "select_0(channel1, &message1, channel1, message2);" in cpp
+    assert "select_1(channel2, &message1, channel2, message2);" in cpp
+    for body in ("gotchannel1();", "sentchannel1();", "gotchannel2();", "sentchannel2();"):
+        assert header.count(body) == 1
+
+    # A select of another shape gets its own polling.
+    header, _ = translate(source + source.replace("int main", "int other").replace("    }\n", "        default:\n    }\n"))
+    assert header.count("inline int select_shape_rw(") == 1
+    assert header.count("inline int select_shape_rw_default(") == 1
+
+
+def test_channel_impl_rewrites_the_unbounded_channels() -> None:
+    source: str = '#include "common/ChannelUnbounded.h"\n' \
+                  '\n' \
+                  'void produce(ChannelUnbounded<int, 50>& channel) {\n' \
+                  '    // A ChannelUnbounded<int, 50> in a comment\n' \
+                  '    channel <- 1;\n' \
+                  '}\n' \
+                  'int main() {\n' \
+                  '    ChannelUnbounded<std::string, 100> channel1;\n' \
+                  '    const char* name = "ChannelUnbounded<int>";\n' \
+                  '    select {\n' \
+                  '        case message1 <- channel1:\n' \
+                  '        {\n' \
+                  '            ChannelUnbounded<int, 2> local;\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    header, cpp = translate(source)
+    assert "ChannelRing" not in cpp
+    ring_header, ring_cpp = translate(source, options=GeneratorOptions(channel_impl=CppGenerator.CHANNEL_MPMC))
+    assert ring_header == header
+    assert ring_cpp.startswith('#include "common/ChannelUnbounded.h"\n'
+                               '\n'
+                               '#include "common/ChannelRing.h"\n'
+                               '#include "AUTOGENERATED.h"\n')
+    assert "void produce(ChannelRingMPMC<int, 50>& channel) {\n" in ring_cpp
+    assert "    ChannelRingMPMC<std::string, 100> channel1;\n" in ring_cpp
+    # Comments and strings are left alone.
+    assert "// A ChannelUnbounded<int, 50> in a comment\n" in ring_cpp
+    assert '"ChannelUnbounded<int>"' in ring_cpp
+
+    _, spsc_cpp = translate(source, options=GeneratorOptions(channel_impl=CppGenerator.CHANNEL_SPSC))
+    assert spsc_cpp == ring_cpp.replace("ChannelRingMPMC", "ChannelRingSPSC")
+
+
+def test_consecutive_writes_to_a_channel_are_merged() -> None:
+    source: str = 'void send() {\n' \
+                  '    channel1 <- a;\n' \
+                  '    channel1 <- b;\n' \
+                  '    channel2 <- c;\n' \
+                  '    channel2 <- d;\n' \
+                  '\n' \
+                  '    channel2 <- e;\n' \
+                  '    x <- channel1;\n' \
+                  '    channel1 <- f;\n' \
+                  '}\n'
+    _, cpp = translate(source)
+    assert cpp.endswith('void send() {\n'
+                        'channel1.writeMany({a, b}, false);\n'
+                        'channel2.writeMany({c, d}, false);\n'
+                        '\n'
+                        'channel2.write(e, false);\n'
+                        'channel1.read(&x, false);\n'
+                        'channel1.write(f, false);\n'
+                        '}\n')
+
+
+def test_writes_are_merged_only_within_the_same_statement() -> None:
+    source: str = 'void send() {\n' \
+                  '    if (x)\n' \
+                  '        channel1 <- a;\n' \
+                  '    channel1 <- b;\n' \
+                  '    channel1 <- c;\n' \
+                  '    else\n' \
+                  '        // only one\n' \
+                  '        channel1 <- d;\n' \
+                  '    channel1 <- e;\n' \
+                  '}\n'
+    _, cpp = translate(source)
+    assert cpp.endswith('void send() {\n'
+                        '    if (x)\n'
+                        'channel1.write(a, false);\n'
+                        'channel1.writeMany({b, c}, false);\n'
+                        '    else\n'
+                        '        // only one\n'
+                        'channel1.write(d, false);\n'
+                        'channel1.write(e, false);\n'
+                        '}\n')
+
+
+def test_range_loop_drains_a_channel(tmpdir: local.LocalPath) -> None:
+    source: str = 'void drain() {\n' \
+                  '    for (x : range channel1) {\n' \
+                  '        use(x);\n' \
+                  '    }\n' \
+                  '    for (const std::string& name : range names_channel)\n' \
+                  '        use(name);\n' \
+                  '    // for (y : range channel2)\n' \
+                  '    auto range = std::make_pair(1, 2);\n' \
+                  '}\n'
+    loop, other_loop = SelectParser.parse_blocks(source)
+    assert loop == RangeLoop("x", "channel1", 19, 43, 2)
+    assert (other_loop.declaration, other_loop.channel) == ("const std::string& name", "names_channel")
+
+    _, cpp = translate(source)
+    assert cpp.endswith('void drain() {\n'
+                        '    for (auto x : channelRange(channel1)) {\n'
+                        '        use(x);\n'
+                        '    }\n'
+                        '    for (const std::string& name : channelRange(names_channel))\n'
+                        '        use(name);\n'
+                        '    // for (y : range channel2)\n'
+                        '    auto range = std::make_pair(1, 2);\n'
+                        '}\n')
+
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text(source.replace("<-", ""), encoding="utf-8")
+    assert SelectParser.contains_markers(str(input_file))
+
+
+def test_channel_index_finds_declarations_in_included_headers(tmpdir: local.LocalPath) -> None:
+    tmpdir.join("channels.h").write_text(
+        '#pragma once\n'
+        '// ChannelBounded<int> commented;\n'
+        'struct Pipeline {\n'
+        '    ChannelBounded<std::vector<std::pair<int, int>>> results;\n'
+        '    ChannelUnbounded<int, 50> counts, totals;\n'
+        '};\n'
+        'std::vector<ChannelBounded<int>> pool;\n',
+        encoding="utf-8"
+    )
+    source: str = '#include "channels.h"\n' \
+                  '#include "missing.h"\n' \
+                  'void collect(Pipeline& pipeline, ChannelBounded<std::string>& names) {\n' \
+                  '    channel_count <- pipeline.totals;\n' \
+                  '    select {\n' \
+                  '        case pipeline.results <- result:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '        case name <- names:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '        case value <- channel_other:\n' \
+                  '        {\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text(source, encoding="utf-8")
+
+    index: ChannelIndex = ChannelIndex.for_file(str(input_file))
+    assert sorted(declaration.name for declaration in index.declarations) == ["counts", "names", "results", "totals"]
+    assert index.get("pipeline.results") == ChannelDeclaration(
+        "results", ChannelIndex.BOUNDED, "std::vector<std::pair<int, int>>", None, 4
+    )
+    assert index.get("this->counts").capacity == "50"
+    # Not declared where the index can see, the name tells.
+    assert index.is_channel("channel_other") and not index.is_channel("pool")
+
+    header, cpp = translate(source, channels=index)
+    # The name says channel, the declarations say otherwise.
+    assert "pipeline.totals.read(&channel_count, false);\n" in cpp
+    assert "select_0(pipeline.results, result, names, &name, channel_other, &value);" in cpp
+    assert "inline int select_shape_WRr(" in header
+    assert "if (channel0.pollWrite(message0))" in header
+    assert "if (channel1.pollRead(message1))" in header
+    assert "if (channel2.read(message2, false))" in header
+
+
+def test_cached_translation_checks_the_included_headers(tmpdir: local.LocalPath,
+                                                        monkeypatch: pytest.MonkeyPatch) -> None:
+    header_file = tmpdir.join("channels.h")
+    header_file.write_text('ChannelBounded<int> x;\n', encoding="utf-8")
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text('#include "channels.h"\nvoid send() {\n    values <- x;\n}\n', encoding="utf-8")
+    output_file = tmpdir.join(_get_generated_file_name())
+    cache = TranslationCache(str(tmpdir.join("cache")))
+    header_name: str = str(tmpdir.join("AUTOGENERATED.h"))
+    assert translate_file(str(input_file), header_name, cache).status == TRANSLATED
+    assert "x.read(&values, false);\n" in output_file.read_text(encoding="utf-8")
+
+    def _fail(*args: typing.Any) -> None:
+        raise AssertionError("The input was tokenized again.")
+
+    # A hit reads neither the input nor the headers.
+    with monkeypatch.context() as patches:
+        patches.setattr(SelectLexer, "tokens", _fail)
+        assert translate_file(str(input_file), header_name, cache).status == CACHED
+
+    header_file.write_text('ChannelBounded<int> values;\n', encoding="utf-8")
+    assert translate_file(str(input_file), header_name, cache).status == TRANSLATED
+    assert "values.write(x, false);\n" in output_file.read_text(encoding="utf-8")
+
+    # The same input next to other headers isn't the same translation.
+    other = tmpdir.mkdir("other")
+    other.join("channels.h").write_text('ChannelBounded<int> x;\n', encoding="utf-8")
+    input_file.copy(other.join(_get_file_name()))
+    assert translate_file(str(other.join(_get_file_name())), header_name, cache).status == TRANSLATED
+    assert "x.read(&values, false);\n" in other.join(_get_generated_file_name()).read_text(encoding="utf-8")
+
+
+def test_timer_case_waits_for_a_deadline() -> None:
+    select: SelectParser.SelectContent = [
+        ("value", "channel1", "{}\n"),
+        (None, "after(50)", "{}\n"),
+        (None, "after(std::chrono::seconds(5))", "{}\n"),
+    ]
+    shape = HeaderGenerator.get_shape(select, GeneratorOptions(wait_strategy=HeaderGenerator.WAIT_PARK))
+    assert shape.operations == (HeaderGenerator.READ, HeaderGenerator.TIMER, HeaderGenerator.TIMER)
+    polling: str = HeaderGenerator.render_shape(shape)
+    assert "inline int select_shape_rtt_park(Channel0& channel0, Message0 message0, " \
+           "const SelectDeadline::Clock::time_point deadline1, " \
+           "const SelectDeadline::Clock::time_point deadline2)" in polling
+    assert "if (SelectDeadline::hasPassed(deadline1))" in polling
+    # The timers are not channels to wait on, the wait ends at the earliest deadline.
+    assert "selectWaiterRegistration1" not in polling
+    assert "selectWaiter.waitUntil(std::min({deadline1, deadline2}));" in polling
+
+    define: str = HeaderGenerator.render_select(0, select, GeneratorOptions(wait_strategy=HeaderGenerator.WAIT_PARK))
+    assert define.startswith("#define select_0(selectChannel0, selectMessage0)")
+    assert "select_shape_rtt_park(selectChannel0, selectMessage0, SelectDeadline::after(50), " \
+           "SelectDeadline::after(std::chrono::seconds(5)))" in define
+    assert HeaderGenerator.get_define_call(0, select) == "select_0(channel1, &value);"
+
+
+def test_runtime_scenarios_are_translated_for_their_channel_type() -> None:
+    scenarios: typing.List[Scenario] = list(iter_scenarios(
+        CHANNEL_TYPES, (HeaderGenerator.WAIT_PARK,), (1, 3), (1, 2), Scenario(messages=10)
+    ))
+    # A ring channel of one producer and one consumer can't have two consumers.
+    assert len(scenarios) == len(CHANNEL_TYPES) * 4 - 2
+    assert "spsc/park/p3/c2" not in [scenario.name for scenario in scenarios]
+
+    scenario = Scenario(channel_type=CppGenerator.CHANNEL_MPMC, wait_strategy=HeaderGenerator.WAIT_PARK, producers=3)
+    header, cpp = translate(ScenarioGenerator(scenario).generate(), options=scenario.options)
+    assert "ChannelRingMPMC<long long, 1024> channel2;\n" in cpp
+    assert cpp.count("(channel0, &stamp, channel1, &stamp, channel2, &stamp);") == 2
+    # The consumers and the blocked select share the same polling.
+    assert header.count("inline int select_shape_rrrt_park(") == 1
+
+    _, bounded_cpp = translate(ScenarioGenerator(Scenario(channel_type=CHANNEL_BOUNDED)).generate())
+    assert "ChannelBounded<long long> channel0;\n" in bounded_cpp
+
+
+def test_runtime_benchmark_parses_results_and_checks_regressions() -> None:
+    output: str = 'some output\n' \
+                  '{"messages": 1000, "seconds": 0.01, "cpu_seconds": 0.02, "idle_seconds": 0.2, ' \
+                  '"idle_cpu_seconds": 0.002, "p50_ns": 100, "p90_ns": 200, "p99_ns": 400, "max_ns": 900}\n'
+    result: RuntimeResult = parse_result(Scenario(), output)
+    assert result.scenario == "mutex/spin/p1/c1"
+    assert (result.messages_per_second, result.idle_cpu_ratio) == pytest.approx((100000, 0.01))
+
+    baseline: typing.Dict[str, RuntimeResult] = {result.scenario: result}
+    assert not check_runtime_regressions([result._replace(seconds=0.011)], baseline, 0.25)
+    assert check_runtime_regressions([result._replace(seconds=0.02)], baseline, 0.25)
+    assert check_runtime_regressions([result._replace(p99_ns=600)], baseline, 0.25)
+
+
+def test_stable_names_and_depfile_rebuild_only_what_changed(tmpdir: local.LocalPath) -> None:
+    tmpdir.join("channels.h").write_text("ChannelBounded<int> channel1;\n", encoding="utf-8")
+    select: str = '    select {\n' \
+                  '        case value <- channel1:\n' \
+                  '        {\n' \
+                  '            use(value);\n' \
+                  '        }\n' \
+                  '    }\n'
+    other_select: str = select.replace("use(value)", "log(value)")
+    source: str = '#include "channels.h"\n\nvoid run() {\n' + select + other_select + select + '}\n'
+    options = GeneratorOptions(stable_names=True)
+
+    header, cpp = translate(source, options=options)
+    names: typing.List[str] = re.findall(r"(select_[0-9a-f]{12})\(channel1, &value\);", cpp)
+    assert len(names) == 3 and names[0] == names[2] != names[1]
+    # The same select is defined once.
+    assert header.count(f"#define {names[0]}(") == 1
+    # Adding a select doesn't rename the others.
+    _, other_cpp = translate(source.replace("void run() {\n", "void run() {\n" + other_select * 2), options=options)
+    assert set(names) == set(re.findall(r"(select_[0-9a-f]{12})\(channel1, &value\);", other_cpp))
+
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text(source, encoding="utf-8")
+    header_file_name: str = HeaderGenerator.get_output_file_name(str(input_file))
+    translate_file(str(input_file), header_file_name, options=options, depfile=True)
+    with open(get_depfile_name(str(input_file)), "r", encoding="utf-8") as depfile:
+        assert depfile.read() == f"{CppGenerator.get_output_file_name(str(input_file))} {header_file_name}: " \
+                                 f"{input_file} {os.path.realpath(str(tmpdir.join('channels.h')))}\n"
+
+    # Outputs whose content is the same are not written again.
+    source = source.replace("log(value)", "log(value + 1)")
+    os.utime(header_file_name, (0, 0))
+    input_file.write_text(source, encoding="utf-8")
+    translate_file(str(input_file), header_file_name, options=options, depfile=True)
+    assert os.stat(header_file_name).st_mtime != 0
+    os.utime(header_file_name, (0, 0))
+    input_file.write_text(source.replace("void run()", "void start()"), encoding="utf-8")
+    translate_file(str(input_file), header_file_name, options=options, depfile=True)
+    assert os.stat(header_file_name).st_mtime == 0
+
+
+def test_line_directives_and_source_map_point_at_the_input(tmpdir: local.LocalPath) -> None:
+    source: str = '#include "common/ChannelBounded.h"\n' \
+                  'ChannelBounded<int> channel1;\n' \
+                  'void run(int value) {\n' \
+                  '    channel1 <- 1;\n' \
+                  '    select {\n' \
+                  '        case value <- channel1:\n' \
+                  '        {\n' \
+                  '            use(value);\n' \
+                  '        }\n' \
+                  '        default:\n' \
+                  '        {\n' \
+                  '            wait();\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '    done(value);\n' \
+                  '}\n'
+    _, cpp = translate(source, options=GeneratorOptions(line_directives=True), source_file_name='dir\\"a".cpp')
+    lines: typing.List[str] = cpp.splitlines()
+    # The cases are written in place, each body after the line of the input it is on.
+    assert lines[lines.index("            use(value);") - 2] == '#line 7 "dir\\\\\\"a\\".cpp"'
+    assert lines[lines.index("            wait();") - 2] == '#line 11 "dir\\\\\\"a\\".cpp"'
+    assert lines[lines.index("    done(value);") - 1] == '#line 15 "dir\\\\\\"a\\".cpp"'
+
+    input_file = tmpdir.join(_get_file_name())
+    input_file.write_text(source, encoding="utf-8")
+    cache = TranslationCache(str(tmpdir.join("cache")))
+    for _ in range(2):
+        translate_file(str(input_file), cache=cache, source_map=True)
+        with open(get_source_map_name(str(input_file)), "r", encoding="utf-8") as map_file:
+            stored: typing.Dict[str, typing.Any] = json.load(map_file)
+        assert stored["source"] == input_file.basename
+        assert stored["selects"] == [{"name": "select_0", "shape": "select_shape_R_default", "line": 5,
+                                      "cases": [7, 11]}]
+        # Without the directives, the lines still come from the input, except for the included header.
+        source_map: SourceMap = SourceMap.from_dict(stored)
+        source_lines: typing.List[str] = source.splitlines()
+        with open(CppGenerator.get_output_file_name(str(input_file)), "r", encoding="utf-8") as output_file:
+            generated_lines: typing.List[str] = output_file.read().splitlines()
+        for generated_line in (1, generated_lines.index("void run(int value) {") + 1, len(generated_lines)):
+            source_line: int = source_map.get_source_line(generated_line)
+            assert source_lines[source_line - 1] == generated_lines[generated_line - 1]
+
+
+def test_instrumentation_counts_each_select_only_when_compiled_in() -> None:
+    source: str = '#include "common/ChannelBounded.h"\n' \
+                  'ChannelBounded<int> channel1;\n' \
+                  'void run(int value) {\n' \
+                  '    select {\n' \
+                  '        case value <- channel1:\n' \
+                  '        {\n' \
+                  '            use(value);\n' \
+                  '        }\n' \
+                  '    }\n' \
+                  '}\n'
+    header, _ = translate(source)
+    assert "CSP_INSTRUMENT" not in header
+
+    header, _ = translate(source, options=GeneratorOptions(instrumentation=True))
+    assert "inline int select_shape_R_instrumented(CSP_INSTRUMENT(SelectCounters& selectCounters, ) " \
+           "Channel0& channel0, Message0 message0)" in header
+    assert "    CSP_INSTRUMENT(SelectPass selectPass(selectCounters);)\n" in header
+    assert "        CSP_INSTRUMENT(selectPass.round();)\n" in header
+    assert 'CSP_INSTRUMENT(static SelectCounters& selectCounters = InstrumentationRegistry::instance()' \
+           '.addSelect("select_0", __FILE__, __LINE__, 1);) \\\n' \
+           'switch (CSP_INSTRUMENT(selectCounters.fired)(select_shape_R_instrumented(' \
+           'CSP_INSTRUMENT(selectCounters, ) selectChannel0, selectMessage0))) \\\n' in header
+
+    # The cases written in place are counted the same way.
+    _, cpp = translate(source, options=GeneratorOptions(instrumentation=True, line_directives=True))
+    assert 'switch (CSP_INSTRUMENT(selectCounters.fired)(select_shape_R_instrumented(' \
+           'CSP_INSTRUMENT(selectCounters, ) channel1, &value))) {' in cpp
+
+
+def test_compiler_wrapper_pipes_the_translation_to_the_compiler(tmpdir: local.LocalPath) -> None:
+    input_file = tmpdir.join("foo.cpp")
+    input_file.write_text('#include "channels.h"\n'
+                          'void run(int value) {\n'
+                          '    select {\n'
+                          '        case value <- channel1:\n'
+                          '        {\n'
+                          '            use(value);\n'
+                          '        }\n'
+                          '    }\n'
+                          '}\n', encoding="utf-8")
+    tmpdir.join("channels.h").write_text("ChannelBounded<int> channel1;\n", encoding="utf-8")
+    arguments: typing.List[str] = ["g++", "-I", "include.cpp", "-c", str(input_file), "other.o", "-MMD"]
+
+    assert CompilerWrapper.find_sources(arguments) == [4]
+    assert CompilerWrapper.get_command(arguments, 4) == [
+        "g++", "-I", "include.cpp", "-c", "-iquote", str(tmpdir), "-x", "c++", "-", "-x", "none", "other.o", "-MMD",
+        "-o", "foo.o", "-MF", "foo.d", "-MT", "foo.o"
+    ]
+    # The compiler names the outputs of several sources itself.
+    assert CompilerWrapper.get_command(["g++", "-c", str(input_file), "bar.cpp"], 2) == [
+        "g++", "-c", "-iquote", str(tmpdir), "-x", "c++", "-", "-x", "none", "bar.cpp"
+    ]
+    # `-MFake` is the target `-MT` names, not a `-MF`.
+    command: typing.List[str] = CompilerWrapper.get_command(
+        ["g++", "-c", str(input_file), "-ofoo.o", "-MD", "-MT", "-MFake"], 2
+    )
+    assert command[-2:] == ["-MF", "foo.d"] and CompilerWrapper.get_depfile_name(command) == "foo.d"
+
+    # The compiler only knows it read stdin, the dependency file gets the source back.
+    depfile = tmpdir.join("foo.d")
+    depfile.write_text("foo.o: - channels.h \\\n /usr/include/vector\n", encoding="utf-8")
+    CompilerWrapper.rewrite_depfile(str(depfile), "my foo.cpp")
+    assert depfile.read_text(encoding="utf-8") == "foo.o: my\\ foo.cpp channels.h \\\n /usr/include/vector\n"
+
+    compiler_input: str = CompilerWrapper.render_input(str(input_file))
+    lines: typing.List[str] = compiler_input.splitlines()
+    assert lines[:3] == [f'#line 1 "{input_file}"', '#include "channels.h"', '#line 2 "foo_AUTOGENERATED.h"']
+    assert "#define AUTOGENERATED_H" in lines and "#pragma once" not in lines
+    assert "#include" not in compiler_input.split("#define AUTOGENERATED_H")[1]
+    # The translation of the channel known from `channels.h` goes on at the line of the source.
+    assert lines[lines.index("            use(value);") - 2] == f'#line 5 "{input_file}"'
+    assert "select_shape_R(channel1, &value)" in compiler_input
+    assert not tmpdir.join("foo_generated.cpp").exists() and not tmpdir.join("foo_AUTOGENERATED.h").exists()
+
+
+def test_wide_selects_wait_on_a_ready_set() -> None:
+    cases: str = "".join(f'        case value <- channel{index}:\n'
+                         '        {\n'
+                         f'            use({index});\n'
+                         '        }\n' for index in range(3))
+    source: str = "".join(f"ChannelBounded<int> channel{index};\n" for index in range(3)) + \
+                  'void run(int value) {\n    select {\n' + cases + '    }\n' + \
+                  '    select {\n' + cases.replace("channel2", "channel0") + '    }\n' + \
+                  '    select[spin] {\n' + cases + '    }\n}\n'
+    options = GeneratorOptions(ready_threshold=3)
+    shapes: typing.List[str] = [
+        HeaderGenerator.get_shape_name(HeaderGenerator.get_block_shape(block, options, ChannelIndex.for_source(source)))
+        for block in SelectParser.parse_blocks(source)
+    ]
+    # The annotation keeps its own strategy.
+    assert shapes == ["select_shape_RRR_ready", "select_shape_RRR_ready", "select_shape_RRR"]
+
+    header, _ = translate(source, options=options)
+    assert "    SelectReadySet selectWaiter(3);\n" \
+           "    SelectWaiterRegistration selectWaiterRegistration0(channel0, selectWaiter, 0);\n" in header
+    # Only the cases the channels notified are polled again, the select waits for them.
+    assert "        while ((selectCase = selectWaiter.pop()) != -1)\n" in header
+    assert "        selectWaiter.waitReady();\n" in header
+    # Without a channel to notify it, a timer waits as a parked select.
+    timer: typing.List[SelectParser.CaseContent] = [(None, "after(5)", "")]
+    assert HeaderGenerator.get_shape(timer, GeneratorOptions(wait_strategy="ready")).wait_strategy == "park"